@@ -0,0 +1,86 @@
+"""Benchmark hash-maps against the dict-backed MalHashMap they replaced.
+
+Fills a map one assoc at a time, builds one with hash-map in one pass and
+looks up every key, at growing sizes.
+
+Run from impls/mypython: python3 bench/hashmap_assoc.py
+"""
+
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from mal.types import MalHashMap, MalInt, MalObject, MalString, hash_key, hash_map  # noqa: E402
+
+
+class BaselineHashMap:
+    """The copy-on-write dict map, as it was before the HAMT."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Dict[object, Tuple[MalObject, MalObject]] = None):
+        self.value = {} if value is None else value
+
+    def get(self, key: MalObject, default: MalObject = None) -> MalObject:
+        entry = self.value.get(hash_key(key))
+        return default if entry is None else entry[1]
+
+    def assoc(self, kvs: List[MalObject]) -> "BaselineHashMap":
+        data = dict(self.value)
+        for i in range(0, len(kvs), 2):
+            data[hash_key(kvs[i])] = (kvs[i], kvs[i + 1])
+        return BaselineHashMap(data)
+
+    @staticmethod
+    def build(kvs: List[MalObject]) -> "BaselineHashMap":
+        return BaselineHashMap().assoc(kvs)
+
+
+def fill(empty, kvs):
+    m = empty
+    for i in range(0, len(kvs), 2):
+        m = m.assoc(kvs[i:i + 2])
+    return m
+
+
+def lookup(m, keys):
+    for key in keys:
+        m.get(key)
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1e3:9.1f} ms"
+
+
+def bench(size: int) -> None:
+    kvs = []
+    for i in range(size):
+        kvs.append(MalString(f"key-{i}"))
+        kvs.append(MalInt(i))
+    # Fresh key objects, so nothing cached on the originals is reused
+    probes = [MalString(f"key-{i}") for i in range(size)]
+    hamt = hash_map(kvs)
+    baseline = BaselineHashMap.build(kvs)
+    # Copying dicts is quadratic; skip it where it would take minutes
+    if size <= 20_000:
+        baseline_fill = ms(timed(fill, BaselineHashMap(), kvs))
+    else:
+        baseline_fill = "  (skipped)"
+    print(f"{size:>8} keys"
+          f"  assoc: hamt {ms(timed(fill, MalHashMap(), kvs))} baseline {baseline_fill}"
+          f"  hash-map: hamt {ms(timed(hash_map, kvs))} baseline {ms(timed(BaselineHashMap.build, kvs))}"
+          f"  get: hamt {ms(timed(lookup, hamt, probes))} baseline {ms(timed(lookup, baseline, probes))}")
+
+
+if __name__ == "__main__":
+    for size in (100, 1_000, 5_000, 20_000, 100_000):
+        bench(size)
@@ -0,0 +1,52 @@
+"""Benchmark hash-map lookups from 10 to 1,000,000 entries.
+
+Run from impls/mypython: python3 bench/hashmap_lookup.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from mal.core import mal_contains_p, mal_get  # noqa: E402
+from mal.types import MalInt, MalString, hash_map, keyword  # noqa: E402
+
+LOOKUPS = 100_000
+
+
+def bench(size: int) -> None:
+    kvs = []
+    for i in range(size):
+        kvs.append(MalString(f"key-{i}"))
+        kvs.append(MalInt(i))
+    m = hash_map(kvs)
+    d = {f"key-{i}": i for i in range(size)}
+    names = [f"key-{i * 7919 % size}" for i in range(1000)]
+    missing = keyword("missing")
+
+    def get():
+        # Probe keys are fresh objects, as read from a source, so each
+        # lookup hashes its key
+        for name in names:
+            mal_get(m, MalString(name))
+
+    def dict_get():
+        for name in names:
+            d.get(MalString(name).value)
+
+    def contains():
+        for _ in names:
+            mal_contains_p(m, missing)
+
+    n = LOOKUPS // len(names)
+    get_ns = min(timeit.repeat(get, number=n, repeat=3)) / LOOKUPS * 1e9
+    dict_ns = min(timeit.repeat(dict_get, number=n, repeat=3)) / LOOKUPS * 1e9
+    contains_ns = min(timeit.repeat(contains, number=n, repeat=3)) / LOOKUPS * 1e9
+    print(f"{size:>9} entries  get {get_ns:7.1f} ns  (dict {dict_ns:6.1f} ns)  "
+          f"contains? (miss) {contains_ns:7.1f} ns")
+
+
+if __name__ == "__main__":
+    for size in (10, 100, 1_000, 10_000, 100_000, 1_000_000):
+        bench(size)
@@ -0,0 +1,55 @@
+"""Benchmark reader throughput in MB/s on a generated 10 MB source.
+
+Run from impls/mypython: python3 bench/reader_throughput.py [MB]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from mal.reader import Reader, read_form  # noqa: E402
+
+FORMS = [
+    '(def! fib (fn* (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))',
+    '(let* [a 1 b -2.5 c "a \\"quoted\\" string\\n"] (list a b c))',
+    '{:name "mal" :tags [:lisp :python] :count 42}',
+    "`(foo ~bar ~@(baz 1 2 3) 'quux @state)",
+    ";; a comment line\n(println \"hello, world\" nil true false)",
+]
+
+
+def generate(size: int) -> str:
+    """Make about size bytes of mal source, one top-level form per line."""
+    rng = random.Random(0)
+    parts = []
+    n = 0
+    while n < size:
+        form = rng.choice(FORMS)
+        parts.append(form)
+        n += len(form) + 1
+    return "\n".join(parts)
+
+
+def read_all(src: str) -> int:
+    reader = Reader(src)
+    n = 0
+    while reader.skip() is not None:
+        read_form(reader)
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    mb = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    src = generate(int(mb * 1_000_000))
+    size = len(src.encode()) / 1_000_000
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        forms = read_all(src)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{size:.1f} MB  {forms} forms  {best:.2f} s  {size / best:.2f} MB/s")
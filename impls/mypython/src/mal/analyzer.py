@@ -0,0 +1,551 @@
+"""Mal Analyzer
+
+Converts a form into a tree of Python closures once, so that special forms,
+arity checks and macro expansion are resolved before the code runs.
+
+Parameters and let* bindings are resolved to (depth, slot) addresses at
+analysis time and live in fixed-size frames; only globals are looked up
+by name in the Env.
+"""
+
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from .env import Env, Frame
+from .eval import (
+    SPECIAL_FORMS, call_builtin, call_depth_error, compile_quasiquote, mal_apply, mal_macroexpand,
+    mal_quasiquote, unsupported_form,
+)
+from .types import (
+    MalFunction, MalHashMap, MalList, MalObject, MalSymbol, MalVector, ParamPlan, false, nil,
+    symbol,
+)
+
+
+Node = Callable[[Optional[Frame]], MalObject]
+
+
+class _TailCall:
+    """Call left pending by a closure in tail position."""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+
+class _Scope:
+    """Frame layout for the names bound lexically around a form."""
+
+    def __init__(self, names: List[str], outer: Optional["_Scope"] = None):
+        self.slots: Dict[str, int] = {}
+        self.size = 0
+        self.outer = outer
+        for name in names:
+            self.add(name)
+
+    def add(self, name: str) -> int:
+        """Give name a new slot, shadowing any earlier one."""
+        self.slots[name] = self.size
+        self.size += 1
+        return self.size - 1
+
+    def declare(self, name: str) -> int:
+        """Get the slot of name, adding one if needed."""
+        if name not in self.slots:
+            return self.add(name)
+        return self.slots[name]
+
+    def resolve(self, name: str) -> Optional[Tuple[int, int]]:
+        """Get the (depth, slot) address of name, or None for a global."""
+        scope = self
+        depth = 0
+        while scope is not None:
+            if name in scope.slots:
+                return depth, scope.slots[name]
+            scope = scope.outer
+            depth += 1
+        return None
+
+
+
+def _is_local(scope: Optional[_Scope], name: str) -> bool:
+    return scope is not None and scope.resolve(name) is not None
+
+
+class _Body:
+    """Body of a fn* form, shared by the closures made from it.
+
+    The body is analyzed when one of them is first called. By then the
+    body around the fn* form has been analyzed, so every def! in it has a
+    slot in the outer layouts, even one that follows the fn* form."""
+
+    __slots__ = ("env", "ast", "layout", "declared", "node")
+
+    def __init__(self, env: Env, ast: MalObject, layout: _Scope, declared: FrozenSet[str]):
+        self.env = env
+        self.ast = ast
+        self.layout = layout
+        self.declared = declared
+        self.node: Optional[Node] = None
+
+    def analyze(self) -> Node:
+        if self.node is None:
+            self.node = _analyze(self.env, self.ast, self.layout, True, self.declared)
+        return self.node
+
+
+class Closure(MalFunction):
+    """User function whose body is analyzed on its first call."""
+
+    __slots__ = ("node", "code")
+
+    def __init__(self, frame: Optional[Frame], params: MalObject, ast: MalObject, plan: ParamPlan,
+                 code: _Body, is_macro_call=False):
+        super().__init__(frame, params, ast, plan, is_macro_call=is_macro_call)
+        self.node = code.node
+        self.code = code
+
+    def __call__(self, *args):
+        return _invoke(self, args)
+
+    @property
+    def layout(self) -> _Scope:
+        return self.code.layout
+
+    def bind(self, args) -> Frame:
+        """Bind args to the parameters in a new frame, analyzing the body
+        first if needed so the frame has room for its def! slots."""
+        if self.node is None:
+            self.node = self.code.analyze()
+        plan = self.plan
+        if plan.rest is None:
+            if len(args) != plan.arity:
+                raise plan.arity_error(len(args))
+            slots = list(args)
+        else:
+            if len(args) < plan.arity:
+                raise plan.arity_error(len(args))
+            slots = list(args[:plan.arity])
+            slots.append(MalList(list(args[plan.arity:])))
+        size = self.code.layout.size
+        if len(slots) < size:
+            slots.extend([None] * (size - len(slots)))
+        return Frame(slots, self.env)
+
+    def as_macro(self) -> "Closure":
+        """Get a macro sharing this function's body."""
+        return Closure(self.env, self.params, self.body, self.plan, self.code, is_macro_call=True)
+
+
+def _invoke(func, args) -> MalObject:
+    """Apply func to args, running pending tail calls."""
+    while True:
+        if type(func) is Closure:
+            frame = func.bind(args)
+            result = func.node(frame)
+            if type(result) is _TailCall:
+                func = result.func
+                args = result.args
+                continue
+            return result
+        if callable(func):
+            # The common two-argument call skips the call_builtin frame
+            if len(args) == 2:
+                return func(args.pop(0), args.pop())
+            return call_builtin(func, args)
+        raise TypeError(f"{func} is not callable")
+
+
+def _is_macro(env: Env, scope: Optional[_Scope], exp: MalObject) -> bool:
+    head = exp.value[0]
+    if type(head) is not MalSymbol or _is_local(scope, head.value):
+        return False
+    if head.value not in env:
+        return False
+    func = env[head.value]
+    return isinstance(func, MalObject) and isinstance(func, MalFunction) and func.is_macro_call
+
+
+def _analyze_symbol(env: Env, name: str, scope: Optional[_Scope]) -> Node:
+    address = scope.resolve(name) if scope is not None else None
+    if address is None:
+        return lambda frame: env[name]
+    depth, slot = address
+    # A slot is None until its binding runs; the name then still refers to
+    # an outer binding, as it would in a chain of Envs.
+    outer_scope = scope
+    for _ in range(depth + 1):
+        outer_scope = outer_scope.outer
+    outer = _analyze_symbol(env, name, outer_scope)
+    if depth == 0:
+        def run(frame):
+            value = frame.slots[slot]
+            return outer(frame.outer) if value is None else value
+    elif depth == 1:
+        def run(frame):
+            frame = frame.outer
+            value = frame.slots[slot]
+            return outer(frame.outer) if value is None else value
+    else:
+        def run(frame):
+            for _ in range(depth):
+                frame = frame.outer
+            value = frame.slots[slot]
+            return outer(frame.outer) if value is None else value
+    return run
+
+
+def _analyze(env: Env, exp: MalObject, scope: Optional[_Scope], tail: bool,
+             declared: FrozenSet[str]) -> Node:
+    """Analyze exp; macros are looked up in env unless shadowed by scope.
+
+    declared holds the global names whose def! encloses exp, which are
+    known not to be macros."""
+    while type(exp) is MalList and len(exp.value) > 0 and _is_macro(env, scope, exp):
+        exp = mal_apply(env[exp.value[0].value], *exp.value[1:])
+    if type(exp) is MalSymbol:
+        return _analyze_symbol(env, exp.value, scope)
+    if type(exp) is MalVector:
+        if len(exp.value) == 0:
+            return lambda frame: exp
+        items = [_analyze(env, x, scope, False, declared) for x in exp.value]
+        return lambda frame: MalVector([item(frame) for item in items])
+    if type(exp) is MalHashMap:
+        if len(exp.value) == 0:
+            return lambda frame: exp
+        nodes = exp.value.map_values(lambda v: _analyze(env, v, scope, False, declared))
+        return lambda frame: MalHashMap(nodes.map_values(lambda node: node(frame)))
+    if type(exp) is not MalList or len(exp.value) == 0:
+        return lambda frame: exp
+    head = exp.value[0]
+    if type(head) is MalSymbol and not _is_local(scope, head.value):
+        analyzer = _SPECIAL_FORMS.get(head)
+        if analyzer is not None:
+            return analyzer(env, exp, scope, tail, declared)
+        if head in SPECIAL_FORMS:
+            raise unsupported_form(head, "analyze")
+    return _analyze_call(env, exp, scope, tail, declared)
+
+
+def _analyze_def(env, exp, scope, tail, declared):
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalSymbol:
+        raise SyntaxError("first argument must be a symbol")
+    name = exp.value[1].value
+    if scope is not None:
+        # def! inside a function or let* binds in the innermost frame.
+        slot = scope.declare(name)
+        value = _analyze(env, exp.value[2], scope, False, declared)
+
+        def run_local(frame):
+            val = value(frame)
+            if slot >= len(frame.slots):
+                frame.slots.extend([None] * (slot + 1 - len(frame.slots)))
+            frame.slots[slot] = val
+            return val
+        return run_local
+    # The value may refer to the name being defined, which is then known
+    # not to be a macro.
+    value = _analyze(env, exp.value[2], scope, False, declared | {name})
+
+    def run(frame):
+        val = value(frame)
+        env[name] = val
+        return val
+    return run
+
+
+def _analyze_defmacro(env, exp, scope, tail, declared):
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalSymbol:
+        raise SyntaxError("first argument must be a symbol")
+    name = exp.value[1].value
+    value = _analyze(env, exp.value[2], scope, False, declared)
+
+    def run(frame):
+        val = value(frame)
+        if type(val) is not Closure:
+            raise SyntaxError("second argument must be a function")
+        env[name] = val.as_macro()
+        return nil
+    return run
+
+
+def _analyze_let(env, exp, scope, tail, declared):
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalList and type(exp.value[1]) is not MalVector:
+        raise SyntaxError("second argument must be a list or vector")
+    bindings = exp.value[1].value
+    if len(bindings) % 2 != 0:
+        raise SyntaxError("odd number of forms in binding vector")
+    names = []
+    for i in range(0, len(bindings), 2):
+        if type(bindings[i]) is not MalSymbol:
+            raise SyntaxError("binding form must be a symbol")
+        names.append(bindings[i].value)
+    # All names get slots up front, so that functions bound here can refer
+    # to bindings that follow them.
+    inner = _Scope([], scope)
+    for name in names:
+        inner.declare(name)
+    pairs = [(inner.slots[name], _analyze(env, bindings[2 * i + 1], inner, False, declared))
+             for i, name in enumerate(names)]
+    body = _analyze(env, exp.value[2], inner, tail, declared)
+
+    def run(frame):
+        new_frame = Frame([None] * inner.size, frame)
+        slots = new_frame.slots
+        for slot, value in pairs:
+            slots[slot] = value(new_frame)
+        return body(new_frame)
+    return run
+
+
+def _analyze_do(env, exp, scope, tail, declared):
+    if len(exp.value) == 1:
+        return lambda frame: nil
+    if scope is None:
+        # Top-level forms run once, so each one is analyzed just before it
+        # runs; macros defined by earlier forms are then visible to later ones.
+        forms = exp.value[1:]
+
+        def run_toplevel(frame):
+            for form in forms[:-1]:
+                _analyze(env, form, None, False, declared)(frame)
+            return _analyze(env, forms[-1], None, tail, declared)(frame)
+        return run_toplevel
+    body = [_analyze(env, x, scope, False, declared) for x in exp.value[1:-1]]
+    last = _analyze(env, exp.value[-1], scope, tail, declared)
+
+    def run(frame):
+        for node in body:
+            node(frame)
+        return last(frame)
+    return run
+
+
+def _analyze_if(env, exp, scope, tail, declared):
+    if len(exp.value) < 3 or len(exp.value) > 4:
+        raise SyntaxError("wrong number of arguments")
+    condition = _analyze(env, exp.value[1], scope, False, declared)
+    then = _analyze(env, exp.value[2], scope, tail, declared)
+    if len(exp.value) == 4:
+        otherwise = _analyze(env, exp.value[3], scope, tail, declared)
+    else:
+        otherwise = lambda frame: nil
+
+    def run(frame):
+        result = condition(frame)
+        if result is false or result is nil:
+            return otherwise(frame)
+        return then(frame)
+    return run
+
+
+def _analyze_fn(env, exp, scope, tail, declared):
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    params = exp.value[1]
+    if type(params) is not MalList and type(params) is not MalVector:
+        raise SyntaxError("second argument must be a list or vector")
+    plan = ParamPlan(params)
+    # Parameters take the first slots in order; a repeated name refers to
+    # the last argument bound to it.
+    layout = _Scope(plan.names if plan.rest is None else plan.names + [plan.rest], scope)
+    ast = exp.value[2]
+    code = _Body(env, ast, layout, declared)
+    return lambda frame: Closure(frame, params, ast, plan, code)
+
+
+def _analyze_quote(env, exp, scope, tail, declared):
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    form = exp.value[1]
+    return lambda frame: form
+
+
+def _analyze_quasiquote(env, exp, scope, tail, declared):
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    template = exp.value[1]
+    if (type(template) is MalList and len(template.value) == 2
+            and template.value[0] is _UNQUOTE):
+        return _analyze(env, template.value[1], scope, tail, declared)
+    return compile_quasiquote(template, lambda form: _analyze(env, form, scope, False, declared))
+
+
+def _analyze_quasiquoteexpand(env, exp, scope, tail, declared):
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    expansion = mal_quasiquote(exp.value[1])
+    return lambda frame: expansion
+
+
+def _analyze_macroexpand(env, exp, scope, tail, declared):
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    form = exp.value[1]
+    return lambda frame: mal_macroexpand(env, form)
+
+
+def _analyze_call(env, exp, scope, tail, declared):
+    head = exp.value[0]
+    if (type(head) is MalSymbol
+            and not _is_local(scope, head.value)
+            and head.value not in env
+            and head.value not in declared):
+        return _analyze_deferred(env, exp, scope, tail, declared)
+    func = _analyze(env, head, scope, False, declared)
+    args = [_analyze(env, x, scope, False, declared) for x in exp.value[1:]]
+    return _make_call(func, args, tail)
+
+
+def _make_call(func: Node, args: List[Node], tail: bool) -> Node:
+    """Make the node calling func with args.
+
+    Calls with up to three arguments evaluate them inline, and a call that
+    is not in tail position enters a closure inline, so that each level of
+    deep non-tail recursion takes as few Python frames as possible.
+    Arguments are passed to builtins by popping them off a list, so the
+    builtin holds the only reference to each."""
+    if tail:
+        if len(args) == 0:
+            return lambda frame: _TailCall(func(frame), ())
+        if len(args) == 1:
+            arg0, = args
+            return lambda frame: _TailCall(func(frame), [arg0(frame)])
+        if len(args) == 2:
+            arg0, arg1 = args
+            return lambda frame: _TailCall(func(frame), [arg0(frame), arg1(frame)])
+        if len(args) == 3:
+            arg0, arg1, arg2 = args
+            return lambda frame: _TailCall(func(frame), [arg0(frame), arg1(frame), arg2(frame)])
+        return lambda frame: _TailCall(func(frame), [arg(frame) for arg in args])
+    if len(args) == 0:
+        def run(frame):
+            f = func(frame)
+            if type(f) is Closure:
+                bound = f.bind(())
+                result = f.node(bound)
+                return _invoke(result.func, result.args) if type(result) is _TailCall else result
+            return _invoke(f, ())
+    elif len(args) == 1:
+        arg0, = args
+
+        def run(frame):
+            f = func(frame)
+            a = [arg0(frame)]
+            if type(f) is Closure:
+                bound = f.bind(a)
+                result = f.node(bound)
+                return _invoke(result.func, result.args) if type(result) is _TailCall else result
+            return f(a.pop()) if callable(f) else _invoke(f, a)
+    elif len(args) == 2:
+        arg0, arg1 = args
+
+        def run(frame):
+            f = func(frame)
+            a = [arg0(frame), arg1(frame)]
+            if type(f) is Closure:
+                bound = f.bind(a)
+                result = f.node(bound)
+                return _invoke(result.func, result.args) if type(result) is _TailCall else result
+            return f(a.pop(0), a.pop()) if callable(f) else _invoke(f, a)
+    elif len(args) == 3:
+        arg0, arg1, arg2 = args
+
+        def run(frame):
+            f = func(frame)
+            a = [arg0(frame), arg1(frame), arg2(frame)]
+            if type(f) is Closure:
+                bound = f.bind(a)
+                result = f.node(bound)
+                return _invoke(result.func, result.args) if type(result) is _TailCall else result
+            return f(a.pop(0), a.pop(0), a.pop()) if callable(f) else _invoke(f, a)
+    else:
+        def run(frame):
+            f = func(frame)
+            a = [arg(frame) for arg in args]
+            if type(f) is Closure:
+                bound = f.bind(a)
+                result = f.node(bound)
+                return _invoke(result.func, result.args) if type(result) is _TailCall else result
+            return _invoke(f, a)
+    return run
+
+
+def _analyze_deferred(env, exp, scope, tail, declared):
+    """Analyze a call whose head is not defined yet.
+
+    The head may be a macro defined later on, so the form is analyzed the
+    first time it runs."""
+    cell = []
+
+    def run(frame):
+        if not cell:
+            name = exp.value[0].value
+            if name in env and _is_macro(env, scope, exp):
+                cell.append(_analyze(env, exp, scope, tail, declared))
+            else:
+                args = [_analyze(env, x, scope, False, declared) for x in exp.value[1:]]
+                cell.append(_make_call(lambda frame: env[name], args, tail))
+        return cell[0](frame)
+    return run
+
+
+_UNQUOTE = symbol("unquote")
+
+_SPECIAL_FORMS = {
+    symbol("def!"): _analyze_def,
+    symbol("defmacro!"): _analyze_defmacro,
+    symbol("let*"): _analyze_let,
+    symbol("do"): _analyze_do,
+    symbol("if"): _analyze_if,
+    symbol("fn*"): _analyze_fn,
+    symbol("quote"): _analyze_quote,
+    symbol("quasiquote"): _analyze_quasiquote,
+    symbol("quasiquoteexpand"): _analyze_quasiquoteexpand,
+    symbol("macroexpand"): _analyze_macroexpand,
+}
+
+
+def restore_closure(frame: Optional[Frame], params: MalObject, ast: MalObject,
+                    outer: Optional[_Scope], is_macro_call=False) -> Closure:
+    """Make a closure read back from an image; analyze_restored gives it
+    the env its body is analyzed in."""
+    plan = ParamPlan(params)
+    layout = _Scope(plan.names if plan.rest is None else plan.names + [plan.rest], outer)
+    return Closure(frame, params, ast, plan, _Body(None, ast, layout, frozenset()),
+                   is_macro_call=is_macro_call)
+
+
+def analyze_restored(env: Env, closures: List[Closure]) -> None:
+    """Give the closures made by restore_closure the env their bodies are
+    analyzed in, sharing one body between the closures of each fn* form."""
+    forms = {}
+    for closure in closures:
+        key = (id(closure.params), id(closure.body), id(closure.layout.outer))
+        code = forms.get(key)
+        if code is None:
+            code = forms[key] = closure.code
+            code.env = env
+        closure.code = code
+
+
+def analyze(env: Env, exp: MalObject) -> Node:
+    """Analyze exp into a closure; globals are looked up in env."""
+    return _analyze(env, exp, None, False, frozenset())
+
+
+def analyze_eval(env: Env, exp: MalObject) -> MalObject:
+    """Evaluate exp with env by analyzing it first.
+
+    Deep non-tail recursion ends in the call depth error the VM raises."""
+    try:
+        return analyze(env, exp)(None)
+    except RecursionError as e:
+        raise call_depth_error(e) from None
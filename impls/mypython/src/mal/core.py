@@ -1,12 +1,25 @@
 """Mal Core"""
 
-from typing import List, Union
-
-from .env import Env
-from .eval import mal_apply
-from .types import MalAtom, MalObject, MalType, true, false, nil
+import io
+import mmap
+import os
+import stat
+import time
+import weakref
+from collections import OrderedDict
+from itertools import chain, count, islice, repeat
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from . import formcache, image
+from .env import Env, cache_stats
+from .eval import fn_caller, mal_apply, macro_cache_stats
+from .types import (
+    EMPTY_LIST, MalAtom, MalFloat, MalHashMap, MalInt, MalKeyword,
+    MalLazySeq, MalList, MalObject, MalString, MalVector, true, false, nil, alloc_stats, equal, hash_key,
+    hash_map, iter_seq, keyword, lazy_chunk, lazy_from_iter, mal_int,
+)
 from .printer import pr_str
-from .reader import read_str
+from .reader import BufferSource, read_forms_at, read_str
 
 
 CORE_ENV = Env()
@@ -17,97 +30,261 @@ CORE_ENV["false"] = false
 CORE_ENV["nil"] = nil
 
 # Arithmetic
-CORE_ENV["+"] = lambda a, b: MalObject(MalType.INTEGER, a.value + b.value)
-CORE_ENV["-"] = lambda a, b: MalObject(MalType.INTEGER, a.value - b.value)
-CORE_ENV["*"] = lambda a, b: MalObject(MalType.INTEGER, a.value * b.value)
-CORE_ENV["/"] = lambda a, b: MalObject(MalType.INTEGER, int(a.value / b.value))
+#
+# The builtins are variadic; a call with two integers, by far the most
+# common case, skips the generic path and boxes its result with mal_int.
+
+
+def _numbers(args: List[MalObject]) -> List[Union[int, float]]:
+    values = []
+    for x in args:
+        if type(x) is not MalInt and type(x) is not MalFloat:
+            raise TypeError(f"{pr_str(x)} is not a number")
+        values.append(x.value)
+    return values
+
+
+def _box(n: Union[int, float]) -> MalObject:
+    return MalFloat(n) if type(n) is float else mal_int(n)
+
+
+def _int_div(a: int, b: int) -> int:
+    """Divide, truncating toward zero."""
+    q = a // b
+    if q < 0 and q * b != a:
+        q += 1
+    return q
+
+
+def mal_add(*args: List[MalObject]) -> MalObject:
+    if len(args) == 2:
+        a, b = args
+        if type(a) is MalInt and type(b) is MalInt:
+            return mal_int(a.value + b.value)
+    return _box(sum(_numbers(args)))
+
+
+def mal_sub(*args: List[MalObject]) -> MalObject:
+    if len(args) == 2:
+        a, b = args
+        if type(a) is MalInt and type(b) is MalInt:
+            return mal_int(a.value - b.value)
+    if not args:
+        raise TypeError("wrong number of arguments")
+    values = _numbers(args)
+    if len(values) == 1:
+        return _box(-values[0])
+    n = values[0]
+    for x in values[1:]:
+        n -= x
+    return _box(n)
+
+
+def mal_mul(*args: List[MalObject]) -> MalObject:
+    if len(args) == 2:
+        a, b = args
+        if type(a) is MalInt and type(b) is MalInt:
+            return mal_int(a.value * b.value)
+    n = 1
+    for x in _numbers(args):
+        n *= x
+    return _box(n)
+
+
+def mal_div(*args: List[MalObject]) -> MalObject:
+    if len(args) == 2:
+        a, b = args
+        if type(a) is MalInt and type(b) is MalInt:
+            return mal_int(_int_div(a.value, b.value))
+    if not args:
+        raise TypeError("wrong number of arguments")
+    values = _numbers(args)
+    if len(values) == 1:
+        values.insert(0, 1)
+    n = values[0]
+    for x in values[1:]:
+        if type(n) is int and type(x) is int:
+            n = _int_div(n, x)
+        else:
+            n /= x
+    return _box(n)
+
+
+def _int_arg(x: MalObject) -> int:
+    if type(x) is not MalInt:
+        raise TypeError(f"{pr_str(x)} is not an integer")
+    return x.value
+
+
+def mal_even_p(x: MalObject) -> MalObject:
+    return true if _int_arg(x) % 2 == 0 else false
+
+
+def mal_odd_p(x: MalObject) -> MalObject:
+    return true if _int_arg(x) % 2 == 1 else false
+
+
+CORE_ENV["+"] = mal_add
+CORE_ENV["-"] = mal_sub
+CORE_ENV["*"] = mal_mul
+CORE_ENV["/"] = mal_div
+CORE_ENV["even?"] = mal_even_p
+CORE_ENV["odd?"] = mal_odd_p
 
 # List
 
 
 def mal_empty_p(a: MalObject) -> bool:
-    if (a.mal_type == MalType.LIST
-            or a.mal_type == MalType.VECTOR
-            or a.mal_type == MalType.HASHMAP):
+    if type(a) is MalLazySeq:
+        a = a.seq()
+        if type(a) is MalLazySeq:
+            return false
+        if a is nil:
+            return true
+    if type(a) is MalList:
+        return true if a.count() == 0 else false
+    if (type(a) is MalVector
+            or type(a) is MalHashMap):
         if len(a.value) == 0:
             return true
     return false
 
 
 def mal_count_p(a: MalObject) -> int:
-    if a == nil:
-        return MalObject(MalType.INTEGER, 0)
-    if (a.mal_type == MalType.LIST
-            or a.mal_type == MalType.VECTOR):
-        return MalObject(MalType.INTEGER, len(a.value))
-    if a.mal_type == MalType.HASHMAP:
-        return MalObject(MalType.INTEGER, len(a.value) // 2)
+    if a is nil:
+        return mal_int(0)
+    if type(a) is MalList:
+        return mal_int(a.count())
+    if type(a) is MalVector or type(a) is MalHashMap:
+        return mal_int(len(a.value))
+    if type(a) is MalLazySeq:
+        # Walk the seq without holding its head, so the chunks passed can
+        # be freed; the same goes for the other consumers below
+        it = iter_seq(a)
+        del a
+        n = 0
+        for _ in it:
+            n += 1
+        return mal_int(n)
     raise TypeError(f"{a} is not a sequence")
 
 
 def mal_cons(a: MalObject, b: MalObject) -> MalObject:
-    if b == nil:
-        return MalObject(MalType.LIST, [a])
-    if b.mal_type == MalType.LIST or b.mal_type == MalType.VECTOR:
-        return MalObject(MalType.LIST, [a] + b.value)
-    # if b.mal_type == MalType.VECTOR:
-    #     return MalObject(MalType.VECTOR, [a] + b.value)
+    if b is nil:
+        return MalList([a])
+    if type(b) is MalList:
+        return b.cons(a)
+    if type(b) is MalVector:
+        return MalList([a, *b.value])
+    if type(b) is MalLazySeq:
+        return lazy_chunk([a], 0, b)
     raise TypeError(f"{b} is not a sequence")
 
 
 def mal_concat(*args: List[MalObject]) -> MalObject:
+    if any(type(arg) is MalLazySeq for arg in args):
+        return lazy_from_iter(chain.from_iterable(map(iter_seq, args)))
     lst = []
     for arg in args:
-        if arg.mal_type == MalType.LIST or arg.mal_type == MalType.VECTOR:
+        if type(arg) is MalList or type(arg) is MalVector:
             lst += arg.value
         else:
             raise TypeError(f"{arg} is not a sequence")
-    return MalObject(MalType.LIST, lst)
+    return MalList(lst)
 
 
 def mal_vec(a: MalObject) -> MalObject:
-    if a.mal_type == MalType.LIST:
-        return MalObject(MalType.VECTOR, a.value)
-    if a.mal_type == MalType.VECTOR:
+    if type(a) is MalList:
+        return MalVector(a.value)
+    # Vectors are immutable, so they are shared as is
+    if type(a) is MalVector:
         return a
+    if type(a) is MalLazySeq:
+        it = iter_seq(a)
+        del a
+        return MalVector(list(it))
     raise TypeError(f"{a} is not a sequence")
 
 
 def mal_nth(a: MalObject, b: MalObject) -> MalObject:
-    if a.mal_type == MalType.LIST or a.mal_type == MalType.VECTOR:
-        if b.mal_type != MalType.INTEGER:
+    if type(a) is MalList or type(a) is MalVector:
+        if type(b) is not MalInt:
             raise TypeError(f"{b} is not an integer")
+        if type(a) is MalList:
+            if b.value < 0 or b.value >= a.count():
+                raise IndexError(f"{b} is out of range")
+            return a.nth(b.value)
         if b.value < 0 or b.value >= len(a.value):
             raise IndexError(f"{b} is out of range")
         return a.value[b.value]
+    if type(a) is MalLazySeq:
+        if type(b) is not MalInt:
+            raise TypeError(f"{b} is not an integer")
+        it = iter_seq(a)
+        del a
+        for x in islice(it, b.value, None) if b.value >= 0 else ():
+            return x
+        raise IndexError(f"{b} is out of range")
     raise TypeError(f"{a} is not a sequence")
 
 
 def mal_first(a: MalObject) -> MalObject:
-    if a.mal_type == MalType.LIST or a.mal_type == MalType.VECTOR:
+    if type(a) is MalLazySeq:
+        a = a.seq()
+        if type(a) is MalLazySeq:
+            return a.first()
+    if type(a) is MalList:
+        x = a.first()
+        return nil if x is None else x
+    if type(a) is MalVector:
         if len(a.value) == 0:
             return nil
         return a.value[0]
-    if a == nil:
+    if a is nil:
         return nil
     raise TypeError(f"{a} is not a sequence")
 
 
 def mal_rest(a: MalObject) -> MalObject:
-    if a.mal_type == MalType.LIST or a.mal_type == MalType.VECTOR:
+    if type(a) is MalLazySeq:
+        a = a.seq()
+        if type(a) is MalLazySeq:
+            rest = a.next()
+            return EMPTY_LIST if rest is nil else rest
+    if type(a) is MalList:
+        return a.rest()
+    if type(a) is MalVector:
         if len(a.value) == 0:
-            return MalObject(MalType.LIST, [])
-        return MalObject(MalType.LIST, a.value[1:])
-    if a == nil:
-        return MalObject(MalType.LIST, [])
+            return EMPTY_LIST
+        # Later rests of the copy are views of it
+        return MalList(list(a.value)).rest()
+    if a is nil:
+        return EMPTY_LIST
     raise TypeError(f"{a} is not a sequence")
 
 
-CORE_ENV["list"] = lambda *args: MalObject(MalType.LIST, list(args))
-CORE_ENV["list?"] = lambda a: true if a.mal_type == MalType.LIST else false  # nil is not a list
+def mal_conj(a: MalObject, *items: List[MalObject]) -> MalObject:
+    if type(a) is MalVector:
+        return MalVector(a.value.extend(items))
+    if type(a) is MalList:
+        for item in items:
+            a = a.cons(item)
+        return a
+    if type(a) is MalLazySeq:
+        for item in items:
+            a = lazy_chunk([item], 0, a)
+        return a
+    if a is nil:
+        return MalList(list(reversed(items)))
+    raise TypeError(f"{a} is not a sequence")
+
+
+CORE_ENV["list"] = lambda *args: MalList(list(args)) if args else EMPTY_LIST
+CORE_ENV["list?"] = lambda a: true if type(a) is MalList else false  # nil is not a list
 CORE_ENV["empty?"] = mal_empty_p
 CORE_ENV["count"] = mal_count_p
 CORE_ENV["cons"] = mal_cons
+CORE_ENV["conj"] = mal_conj
 CORE_ENV["concat"] = mal_concat
 CORE_ENV["vec"] = mal_vec
 CORE_ENV["nth"] = mal_nth
@@ -115,59 +292,307 @@ CORE_ENV["first"] = mal_first
 CORE_ENV["rest"] = mal_rest
 
 
+# Lazy sequences
+
+
+def mal_seq(a: MalObject) -> MalObject:
+    if type(a) is MalLazySeq:
+        a = a.seq()
+        if type(a) is MalLazySeq:
+            return a
+    if type(a) is MalList:
+        return nil if a.count() == 0 else a
+    if type(a) is MalVector:
+        return nil if len(a.value) == 0 else MalList(list(a.value))
+    if type(a) is MalString:
+        return nil if len(a.value) == 0 else MalList([MalString(c) for c in a.value])
+    if a is nil:
+        return nil
+    raise TypeError(f"{a} is not a sequence")
+
+
+def mal_range(*args: List[MalObject]) -> MalObject:
+    if not args:
+        return lazy_from_iter(map(mal_int, count()))
+    if len(args) > 3:
+        raise TypeError("wrong number of arguments")
+    return lazy_from_iter(map(mal_int, range(*[x.value for x in args])))
+
+
+def mal_lazy_seq(thunk: MalObject) -> MalObject:
+    """Make a lazy seq of the seq returned by calling thunk."""
+    def realize():
+        s = mal_apply(thunk)
+        if type(s) is MalVector:
+            s = MalList(list(s.value))
+        elif s is not nil and type(s) is not MalList and type(s) is not MalLazySeq:
+            raise TypeError(f"{s} is not a sequence")
+        return [], s
+    return MalLazySeq(realize)
+
+
+def mal_take(n: MalObject, a: MalObject) -> MalObject:
+    return lazy_from_iter(islice(iter_seq(a), max(n.value, 0)))
+
+
+def mal_drop(n: MalObject, a: MalObject) -> MalObject:
+    return lazy_from_iter(islice(iter_seq(a), max(n.value, 0), None))
+
+
+# The generators below take iterators rather than seqs, so that they do
+# not hold on to the heads of the seqs they consume.
+
+
+def _map(f: MalObject, its: List[Iterator[MalObject]]) -> Iterator[MalObject]:
+    call = fn_caller(f)
+    if len(its) == 1:
+        yield from map(call, its[0])
+    else:
+        yield from map(call, *its)
+
+
+def mal_map(f: MalObject, *seqs: List[MalObject]) -> MalObject:
+    if not seqs:
+        return map_xf(f)
+    return lazy_from_iter(_map(f, [iter_seq(s) for s in seqs]))
+
+
+def _filter(pred: MalObject, it: Iterator[MalObject]) -> Iterator[MalObject]:
+    call = fn_caller(pred)
+    for x in it:
+        test = call(x)
+        if test is not nil and test is not false:
+            yield x
+
+
+def mal_filter(pred: MalObject, *args: List[MalObject]) -> MalObject:
+    if not args:
+        return filter_xf(pred)
+    if len(args) > 1:
+        raise TypeError("wrong number of arguments")
+    return lazy_from_iter(_filter(pred, iter_seq(args[0])))
+
+
+def _iterate(f: MalObject, x: MalObject) -> Iterator[MalObject]:
+    call = fn_caller(f)
+    while True:
+        yield x
+        x = call(x)
+
+
+def mal_iterate(f: MalObject, x: MalObject) -> MalObject:
+    return lazy_from_iter(_iterate(f, x))
+
+
+def mal_repeat(*args: List[MalObject]) -> MalObject:
+    if len(args) == 1:
+        return lazy_from_iter(repeat(args[0]))
+    if len(args) == 2:
+        return lazy_from_iter(repeat(args[1], max(args[0].value, 0)))
+    raise TypeError("wrong number of arguments")
+
+
+CORE_ENV["seq"] = mal_seq
+CORE_ENV["range"] = mal_range
+CORE_ENV["lazy-seq*"] = mal_lazy_seq
+CORE_ENV["take"] = mal_take
+CORE_ENV["drop"] = mal_drop
+CORE_ENV["map"] = mal_map
+CORE_ENV["filter"] = mal_filter
+CORE_ENV["iterate"] = mal_iterate
+CORE_ENV["repeat"] = mal_repeat
+CORE_ENV["lazy-seq?"] = lambda a: true if type(a) is MalLazySeq else false
+
+
+def _int_options(name: str, opts: List[MalObject], allowed: List[str]) -> Dict[str, int]:
+    """Parse keyword options of a builtin whose values are non-negative ints."""
+    if len(opts) % 2 != 0:
+        raise TypeError(f"odd number of options to {name}")
+    result = {}
+    for i in range(0, len(opts), 2):
+        key, value = opts[i], opts[i + 1]
+        if type(key) is not MalKeyword or key.value not in allowed:
+            raise TypeError(f"unknown {name} option {pr_str(key)}")
+        if type(value) is not MalInt or value.value < 0:
+            raise TypeError(f"{pr_str(key)} must be a non-negative integer")
+        result[key.value] = value.value
+    return result
+
+
+# Reducers and transducers
+#
+# A reducing function takes (), (acc) or (acc x): init, completion and
+# step. A transducer takes a reducing function and returns another one, so
+# a composed pipeline runs every step on an element before the next one
+# is read, without building intermediate seqs.
+
+
+def map_xf(f: MalObject):
+    """Make the transducer of (map f)."""
+    call = fn_caller(f)
+
+    def xf(rf):
+        def step(*args):
+            if len(args) == 2:
+                return rf(args[0], call(args[1]))
+            return rf(*args)
+        return step
+    return xf
+
+
+def filter_xf(pred: MalObject):
+    """Make the transducer of (filter pred)."""
+    call = fn_caller(pred)
+
+    def xf(rf):
+        def step(*args):
+            if len(args) == 2:
+                test = call(args[1])
+                if test is nil or test is false:
+                    return args[0]
+            return rf(*args)
+        return step
+    return xf
+
+
+def completing(f: MalObject):
+    """Make a reducing function of f, whose completion returns acc."""
+    call = fn_caller(f)
+
+    def rf(*args):
+        if len(args) == 2:
+            return call(args[0], args[1])
+        if len(args) == 1:
+            return args[0]
+        return call()
+    return rf
+
+
+def mal_reduce(f: MalObject, *args: List[MalObject]) -> MalObject:
+    call = fn_caller(f)
+    if len(args) == 1:
+        it = iter_seq(args[0])
+        del args
+        acc = next(it, None)
+        if acc is None:
+            return call()
+    elif len(args) == 2:
+        acc = args[0]
+        it = iter_seq(args[1])
+        del args
+    else:
+        raise TypeError("wrong number of arguments")
+    for x in it:
+        acc = call(acc, x)
+    return acc
+
+
+def mal_transduce(xf: MalObject, f: MalObject, *args: List[MalObject]) -> MalObject:
+    rf = fn_caller(xf)(completing(f))
+    if len(args) == 1:
+        acc = rf()
+        it = iter_seq(args[0])
+    elif len(args) == 2:
+        acc = args[0]
+        it = iter_seq(args[1])
+    else:
+        raise TypeError("wrong number of arguments")
+    del args
+    for x in it:
+        acc = rf(acc, x)
+    return rf(acc)
+
+
+def _append(*args):
+    if len(args) == 2:
+        args[0].append(args[1])
+    return args[0] if args else []
+
+
+def mal_into(to: MalObject, *args: List[MalObject]) -> MalObject:
+    if len(args) == 1:
+        it = iter_seq(args[0])
+        del args
+        items = list(it)
+    elif len(args) == 2:
+        rf = fn_caller(args[0])(_append)
+        it = iter_seq(args[1])
+        del args
+        items = []
+        for x in it:
+            items = rf(items, x)
+        items = rf(items)
+    else:
+        raise TypeError("wrong number of arguments")
+    if type(to) is MalHashMap:
+        kvs = []
+        for entry in items:
+            if type(entry) is not MalVector or len(entry.value) != 2:
+                raise TypeError(f"{pr_str(entry)} is not a map entry")
+            kvs.extend(entry.value)
+        return to.assoc(kvs)
+    return mal_conj(to, *items)
+
+
+def mal_comp(*fs: List[MalObject]) -> MalObject:
+    calls = [fn_caller(f) for f in reversed(fs)]
+    if not calls:
+        return lambda x: x
+    if len(calls) == 1:
+        return calls[0]
+    first, rest = calls[0], calls[1:]
+
+    def composed(*args):
+        x = first(*args)
+        for call in rest:
+            x = call(x)
+        return x
+    return composed
+
+
+def mal_apply_p(f: MalObject, *args: List[MalObject]) -> MalObject:
+    if not args:
+        return fn_caller(f)()
+    return fn_caller(f)(*args[:-1], *iter_seq(args[-1]))
+
+
+CORE_ENV["reduce"] = mal_reduce
+CORE_ENV["transduce"] = mal_transduce
+CORE_ENV["into"] = mal_into
+CORE_ENV["comp"] = mal_comp
+CORE_ENV["apply"] = mal_apply_p
+
+
 # Comparison
+
 def mal_equal(a: MalObject, b: MalObject) -> bool:
-    if a.mal_type == b.mal_type:
-        if (a.mal_type == MalType.FLOAT
-                or a.mal_type == MalType.FUNCTION
-                or a.mal_type == MalType.INTEGER
-                or a.mal_type == MalType.KEYWORD
-                or a.mal_type == MalType.STRING
-                or a.mal_type == MalType.SYMBOL):
-            return true if a.value == b.value else false
-        if a.mal_type == MalType.HASHMAP and b.mal_type == MalType.HASHMAP:
-            if len(a.value) != len(b.value):
-                return false
-            # TODO: change here when hashmap is implemented correctly
-            for x, y in zip(a.value, b.value):
-                if not mal_equal(x, y):
-                    return false
-            return true
-    if ((a.mal_type == MalType.LIST or a.mal_type == MalType.VECTOR) and
-        (b.mal_type == MalType.LIST or b.mal_type == MalType.VECTOR)):
-        if len(a.value) != len(b.value):
-            return false
-        for x, y in zip(a.value, b.value):
-            if not mal_equal(x, y):
-                return false
-        return true
-    return false
+    return true if equal(a, b) else false
 
 
 def mal_is_less_than(a: MalObject, b: MalObject) -> bool:
-    if ((a.mal_type == MalType.FLOAT or a.mal_type == MalType.INTEGER)
-            and (b.mal_type == MalType.FLOAT or b.mal_type == MalType.INTEGER)):
+    if ((type(a) is MalFloat or type(a) is MalInt)
+            and (type(b) is MalFloat or type(b) is MalInt)):
         return true if a.value < b.value else false
     raise TypeError(f"{a} and {b} are not comparable")
 
 
 def mal_is_less_than_or_equal(a: MalObject, b: MalObject) -> bool:
-    if ((a.mal_type == MalType.FLOAT or a.mal_type == MalType.INTEGER)
-            and (b.mal_type == MalType.FLOAT or b.mal_type == MalType.INTEGER)):
+    if ((type(a) is MalFloat or type(a) is MalInt)
+            and (type(b) is MalFloat or type(b) is MalInt)):
         return true if a.value <= b.value else false
     raise TypeError(f"{a} and {b} are not comparable")
 
 
 def mal_is_greater_than(a: MalObject, b: MalObject) -> bool:
-    if ((a.mal_type == MalType.FLOAT or a.mal_type == MalType.INTEGER)
-            and (b.mal_type == MalType.FLOAT or b.mal_type == MalType.INTEGER)):
+    if ((type(a) is MalFloat or type(a) is MalInt)
+            and (type(b) is MalFloat or type(b) is MalInt)):
         return true if a.value > b.value else false
     raise TypeError(f"{a} and {b} are not comparable")
 
 
 def mal_is_greater_than_or_equal(a: MalObject, b: MalObject) -> bool:
-    if ((a.mal_type == MalType.FLOAT or a.mal_type == MalType.INTEGER)
-            and (b.mal_type == MalType.FLOAT or b.mal_type == MalType.INTEGER)):
+    if ((type(a) is MalFloat or type(a) is MalInt)
+            and (type(b) is MalFloat or type(b) is MalInt)):
         return true if a.value >= b.value else false
     raise TypeError(f"{a} and {b} are not comparable")
 
@@ -181,12 +606,12 @@ CORE_ENV[">="] = mal_is_greater_than_or_equal
 
 def mal_pr_str(*objs: List[MalObject]) -> MalObject:
     """Get string representation of MalObject."""
-    return MalObject(MalType.STRING, " ".join([pr_str(obj, print_readably=True) for obj in objs]))
+    return MalString(" ".join([pr_str(obj, print_readably=True) for obj in objs]))
 
 
 def mal_str(*objs: List[MalObject]) -> MalObject:
     """Get string representation of MalObject."""
-    return MalObject(MalType.STRING, "".join([pr_str(obj, print_readably=False) for obj in objs]))
+    return MalString("".join([pr_str(obj, print_readably=False) for obj in objs]))
 
 
 def mal_prn(*objs: List[MalObject]) -> MalObject:
@@ -213,12 +638,119 @@ def mal_read_str(s: Union[str, MalObject]) -> MalObject:
     return read_str(s)
 
 
-def mal_slurp(filename: Union[str, MalObject]) -> MalObject:
-    """Read file."""
+# Bytes slurp decodes at a time
+SLURP_CHUNK = 1 << 20
+
+
+def _decode(buf, start: int, end: int) -> str:
+    # Decode a chunk at a time, releasing the pages of an mmap as they are
+    # passed, and grow the text in place; it holds the only reference, so
+    # += resizes it rather than copying it
+    source = BufferSource(buf, start, end)
+    # Translate newlines like a file opened in text mode would
+    newlines = io.IncrementalNewlineDecoder(None, translate=True)
+    text = ""
+    try:
+        while True:
+            chunk = source.read(SLURP_CHUNK)
+            text += newlines.decode(chunk, final=not chunk)
+            if not chunk:
+                return text
+    finally:
+        source.close()
+
+
+def _is_mappable(st: os.stat_result) -> bool:
+    # Pipes can not be mapped, and files such as those in /proc report a
+    # size of 0 but still have contents.
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+
+def _slurp_range(buf, options: Dict[str, int]) -> MalObject:
+    size = len(buf)
+    start = min(options.get("offset", 0), size)
+    end = size if "length" not in options else min(size, start + options["length"])
+    if start == end:
+        return MalString("")
+    # A UTF-8 continuation byte is 0b10xxxxxx
+    if start < size and buf[start] & 0xC0 == 0x80:
+        raise ValueError(f"slurp :offset {start} is inside a UTF-8 character")
+    if end < size and buf[end] & 0xC0 == 0x80:
+        raise ValueError(f"slurp :length ends at byte {end}, inside a UTF-8 character")
+    return MalString(_decode(buf, start, end))
+
+
+def mal_slurp(filename: Union[str, MalObject], *opts: List[MalObject]) -> MalObject:
+    """Read a file, or the :length bytes of it from byte :offset.
+
+    :offset and :length count bytes, not chars, and must not cut a UTF-8
+    character. A regular file is mapped rather than read, and its pages are
+    released as they are decoded, so the only full copy of its contents is
+    the decoded string."""
+    if isinstance(filename, MalObject):
+        filename = filename.value
+    options = _int_options("slurp", opts, ["offset", "length"])
+    with open(filename, "rb") as f:
+        if not _is_mappable(os.fstat(f.fileno())):
+            return _slurp_range(f.read(), options)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return _slurp_range(m, options)
+
+
+def _eval_forms(filename: str, forms: Iterator[Tuple[int, MalObject]],
+                eval_form: Callable[[MalObject], MalObject]) -> None:
+    for line, form in forms:
+        try:
+            eval_form(form)
+        except Exception as e:
+            text = pr_str(form)
+            if len(text) > 60:
+                text = text[:57] + "..."
+            e.add_note(f"in the form at {filename}:{line}: {text}")
+            raise
+
+
+def mal_load_file(filename: Union[str, MalObject], eval_form: Callable[[MalObject], MalObject]) -> MalObject:
+    """Read and evaluate the forms of a file one at a time.
+
+    A regular file is mapped and decoded a chunk at a time as the reader
+    needs it, or not read at all if the form cache has its forms; other
+    files, such as pipes, are read as text. An error
+    raised by a form gets a note naming the file, line and text of that
+    form."""
     if isinstance(filename, MalObject):
         filename = filename.value
-    with open(filename, "r") as f:
-        return MalObject(MalType.STRING, f.read())
+    with open(filename, "rb") as f:
+        st = os.fstat(f.fileno())
+        if not _is_mappable(st):
+            _eval_forms(filename, read_forms_at(io.TextIOWrapper(f, encoding="utf-8")), eval_form)
+            return nil
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            cached = formcache.lookup(filename, st, m) if formcache.ENABLED else None
+            if cached is not None:
+                try:
+                    _eval_forms(filename, cached, eval_form)
+                finally:
+                    cached.close()
+                return nil
+            forms = read_forms_at(m)
+            writer = formcache.Writer(filename, st) if formcache.ENABLED else None
+            try:
+                if writer is None:
+                    _eval_forms(filename, forms, eval_form)
+                    return nil
+                _eval_forms(filename, writer.recording(forms), eval_form)
+                # The mapping follows writes to the file, so an entry is only
+                # stored if the file is the one that was read
+                now = os.fstat(f.fileno())
+                if now.st_mtime_ns == st.st_mtime_ns and now.st_size == st.st_size:
+                    writer.commit(formcache.digest(m))
+            finally:
+                # Release the reader's view of m before m is closed
+                forms.close()
+                if writer is not None:
+                    writer.close()
+    return nil
 
 
 CORE_ENV["read-string"] = mal_read_str
@@ -245,11 +777,225 @@ def mal_swap(a: MalAtom, fn: MalObject, *args: List[MalObject]) -> MalObject:
 
 
 CORE_ENV["atom"] = mal_atom
-CORE_ENV["atom?"] = lambda a: true if a.mal_type == MalType.ATOM else false
+CORE_ENV["atom?"] = lambda a: true if type(a) is MalAtom else false
 CORE_ENV["deref"] = lambda a: a.deref()
 CORE_ENV["reset!"] = mal_reset
 CORE_ENV["swap!"] = mal_swap
 
 
+# Hash map
+
+
+def mal_hash_map(*kvs: List[MalObject]) -> MalObject:
+    return hash_map(list(kvs))
+
+
+def _check_map(a: MalObject) -> None:
+    if type(a) is not MalHashMap:
+        raise TypeError(f"{a} is not a hash-map")
+
+
+def mal_assoc(a: MalObject, *kvs: List[MalObject]) -> MalObject:
+    if type(a) is MalVector:
+        if len(kvs) % 2 != 0:
+            raise TypeError("odd number of arguments for assoc")
+        vec = a.value
+        for i in range(0, len(kvs), 2):
+            if type(kvs[i]) is not MalInt:
+                raise TypeError(f"{kvs[i]} is not an integer")
+            if kvs[i].value < 0 or kvs[i].value > len(vec):
+                raise IndexError(f"{kvs[i]} is out of range")
+            vec = vec.assoc(kvs[i].value, kvs[i + 1])
+        return MalVector(vec)
+    _check_map(a)
+    return a.assoc(kvs)
+
+
+def mal_dissoc(a: MalObject, *keys: List[MalObject]) -> MalObject:
+    _check_map(a)
+    return a.dissoc(keys)
+
+
+def mal_get(a: MalObject, key: MalObject) -> MalObject:
+    if a is nil:
+        return nil
+    _check_map(a)
+    return a.get(key, nil)
+
+
+def mal_contains_p(a: MalObject, key: MalObject) -> MalObject:
+    _check_map(a)
+    return true if a.contains(key) else false
+
+
+def mal_keys(a: MalObject) -> MalObject:
+    _check_map(a)
+    return MalList(a.keys())
+
+
+def mal_vals(a: MalObject) -> MalObject:
+    _check_map(a)
+    return MalList(a.vals())
+
+
+CORE_ENV["hash-map"] = mal_hash_map
+CORE_ENV["map?"] = lambda a: true if type(a) is MalHashMap else false
+CORE_ENV["assoc"] = mal_assoc
+CORE_ENV["dissoc"] = mal_dissoc
+CORE_ENV["get"] = mal_get
+CORE_ENV["contains?"] = mal_contains_p
+CORE_ENV["keys"] = mal_keys
+CORE_ENV["vals"] = mal_vals
+
+
+# Memoization
+
+# Counters of the live memoized functions
+_MEMO_STATS = weakref.WeakKeyDictionary()
+
+
+def mal_memoize(f: MalObject, *opts: List[MalObject]) -> MalObject:
+    """Wrap f in a cache keyed by the structural hash keys of its args.
+
+    :max-size n evicts the least recently used entry once n are held, and
+    :ttl-ms n drops entries n milliseconds after they were computed; the
+    expired entries are swept whenever one is added, so a cache with only
+    a ttl does not grow without bound."""
+    options = _int_options("memoize", opts, ["max-size", "ttl-ms"])
+    max_size = options.get("max-size")
+    ttl = options["ttl-ms"] / 1000 if "ttl-ms" in options else None
+    call = fn_caller(f)
+    cache = OrderedDict()
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def memoized(*args):
+        key = tuple([hash_key(x) for x in args])
+        entry = cache.get(key)
+        if entry is not None:
+            if ttl is None or entry[1] > time.monotonic():
+                stats["hits"] += 1
+                if max_size is not None:
+                    cache.move_to_end(key)
+                return entry[0]
+            del cache[key]
+            stats["evictions"] += 1
+        stats["misses"] += 1
+        result = call(*args)
+        if ttl is None:
+            cache[key] = (result, None)
+        else:
+            now = time.monotonic()
+            # Entries are in the order they were added, and so expire from
+            # the front, unless hits reorder them for :max-size, which bounds
+            # the cache anyway
+            while cache and next(iter(cache.values()))[1] <= now:
+                cache.popitem(last=False)
+                stats["evictions"] += 1
+            cache[key] = (result, now + ttl)
+        if max_size is not None:
+            while len(cache) > max_size:
+                cache.popitem(last=False)
+                stats["evictions"] += 1
+        return result
+
+    stats["size"] = cache.__len__
+    _MEMO_STATS[memoized] = stats
+    return memoized
+
+
+def _memo_counts(stats: Dict) -> Dict[str, int]:
+    return {"hits": stats["hits"], "misses": stats["misses"], "evictions": stats["evictions"],
+            "size": stats["size"]()}
+
+
+def mal_memo_stats(*args: List[MalObject]) -> MalObject:
+    """Get the hits, misses, evictions and size of the cache of a memoized
+    function, or the totals of all of them."""
+    if len(args) == 1:
+        if args[0] not in _MEMO_STATS:
+            raise TypeError(f"{args[0]} is not a memoized function")
+        counts = _memo_counts(_MEMO_STATS[args[0]])
+    elif not args:
+        counts = {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+        for stats in list(_MEMO_STATS.values()):
+            for name, n in _memo_counts(stats).items():
+                counts[name] += n
+    else:
+        raise TypeError("wrong number of arguments")
+    kvs = []
+    for name, n in counts.items():
+        kvs += [keyword(name), mal_int(n)]
+    return hash_map(kvs)
+
+
+CORE_ENV["memoize"] = mal_memoize
+CORE_ENV["memo-stats"] = mal_memo_stats
+
+
+# Introspection
+
+def mal_symbol_cache_stats() -> MalObject:
+    """Get hits, misses and hit rate of the symbol lookup caches."""
+    stats = cache_stats()
+    total = stats["hits"] + stats["misses"]
+    return hash_map([
+        keyword("hits"), mal_int(stats["hits"]),
+        keyword("misses"), mal_int(stats["misses"]),
+        keyword("hit-rate"), MalFloat(stats["hits"] / total if total else 0.0),
+    ])
+
+
+def mal_macro_cache_stats() -> MalObject:
+    """Get the numbers of macro expansions performed and reused."""
+    stats = macro_cache_stats()
+    return hash_map([
+        keyword("expansions"), mal_int(stats["expansions"]),
+        keyword("hits"), mal_int(stats["hits"]),
+    ])
+
+
+def mal_alloc_stats() -> MalObject:
+    """Get the number of integers allocated outside the small-int cache."""
+    stats = alloc_stats()
+    return hash_map([keyword("int-allocs"), mal_int(stats["int-allocs"])])
+
+
+def mal_form_cache_stats() -> MalObject:
+    """Get the counters of the parsed-form cache of load-file."""
+    kvs = []
+    for name, n in formcache.cache_stats().items():
+        kvs += [keyword(name), mal_int(n)]
+    return hash_map(kvs)
+
+
+CORE_ENV["symbol-cache-stats"] = mal_symbol_cache_stats
+CORE_ENV["macro-cache-stats"] = mal_macro_cache_stats
+CORE_ENV["alloc-stats"] = mal_alloc_stats
+CORE_ENV["form-cache-stats"] = mal_form_cache_stats
+
+
+# Images
+
+def mal_save_image(filename: Union[str, MalObject]) -> MalObject:
+    """Save the bindings of the global env to an image file."""
+    if isinstance(filename, MalObject):
+        filename = filename.value
+    image.save_image(filename, CORE_ENV, _BUILTINS)
+    return nil
+
+
+CORE_ENV["save-image"] = mal_save_image
+
+# The builtins as bound before any mal code runs; images refer to them by
+# name.
+_BUILTINS = CORE_ENV.bindings()
+
+
+def define_builtin(name: str, fn: Callable) -> None:
+    """Bind a builtin of the host, such as eval, in the global env."""
+    CORE_ENV[name] = fn
+    _BUILTINS[name] = fn
+
+
 def core_env() -> Env:
     return CORE_ENV
@@ -1,26 +1,113 @@
 """Mal Env"""
 
-from typing import Dict
+from typing import Dict, List, Optional
 
-from .types import MalObject
+from .types import MalObject, symbol
+
+
+# Inline cache counters; only lookups that end in a global env count
+_CACHE_STATS = {"hits": 0, "misses": 0}
 
 
 class Env:
     """Mal Environment"""
 
-    def __init__(self, outer: "Env" = None):
-        self._data: Dict[str, MalObject] = {}
+    # Bumped whenever a macro is bound, so call sites remembered as not
+    # being macro calls are looked at again; see mal_macroexpand
+    macro_version = 0
+    # Names that have ever been bound in a non-global env; lookups of
+    # these are never cached.
+    _local_names = set()
+
+    def __init__(self, outer: "Env" = None, data: Dict[str, MalObject] = None):
+        self._data: Dict[str, MalObject] = {} if data is None else data
         self._outer = outer
+        # Global env at the end of the chain; see find
+        self._root = self if outer is None else outer._root
+        if outer is not None and data is not None and not Env._local_names.issuperset(data):
+            for key in data:
+                _shadow(key)
 
     def __setitem__(self, key: str, value: MalObject):
+        if self._outer is None:
+            # Only the cache of the name being bound can go stale
+            symbol(key).lookup_cache = None
+        elif key not in Env._local_names:
+            _shadow(key)
+        if getattr(value, "is_macro_call", False):
+            Env.macro_version += 1
         self._data[key] = value
 
     def __getitem__(self, key: str) -> MalObject:
-        if key in self._data:
-            return self._data[key]
-        if self._outer is not None and key in self._outer:
-            return self._outer[key]
+        env = self
+        while env is not None:
+            data = env._data
+            if key in data:
+                return data[key]
+            env = env._outer
         raise NameError(f"'{key}' not found")
 
     def __contains__(self, key: str) -> bool:
-        return (key in self._data) or (self._outer is not None and key in self._outer)
+        env = self
+        while env is not None:
+            if key in env._data:
+                return True
+            env = env._outer
+        return False
+
+    def bindings(self) -> Dict[str, MalObject]:
+        """Get a copy of the bindings of this env, without the outer ones."""
+        return dict(self._data)
+
+    def find(self, symbol: MalObject) -> Optional[MalObject]:
+        """Look up a SYMBOL node, caching global bindings on the node.
+
+        Symbols are interned, so the cache is per name. It holds the global
+        env that resolved the symbol, so an env under another global env
+        never gets its value, and it is dropped when the name is bound again
+        in a global env or first bound in a local one. Returns None if the
+        symbol is not bound."""
+        cache = symbol.lookup_cache
+        if cache is not None and cache[0] is self._root:
+            _CACHE_STATS["hits"] += 1
+            return cache[1]
+        key = symbol.value
+        env = self
+        while env is not None:
+            data = env._data
+            if key in data:
+                value = data[key]
+                if env._outer is None:
+                    _CACHE_STATS["misses"] += 1
+                    if key not in Env._local_names:
+                        symbol.lookup_cache = (env, value)
+                return value
+            env = env._outer
+        return None
+
+
+def _shadow(key: str) -> None:
+    # A global lookup of key could now pass through a local binding of it
+    Env._local_names.add(key)
+    symbol(key).lookup_cache = None
+
+
+def cache_stats() -> Dict[str, int]:
+    """Get the hit and miss counts of the symbol lookup caches."""
+    return dict(_CACHE_STATS)
+
+
+def reset_cache_stats() -> None:
+    """Reset the symbol lookup cache counters."""
+    _CACHE_STATS["hits"] = 0
+    _CACHE_STATS["misses"] = 0
+
+
+class Frame:
+    """Fixed-size frame of lexically addressed bindings."""
+
+    __slots__ = ("slots", "outer")
+
+    def __init__(self, slots: List[Optional[MalObject]], outer: Optional["Frame"] = None):
+        self.slots = slots
+        self.outer = outer
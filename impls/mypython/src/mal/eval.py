@@ -1,73 +1,153 @@
 """Mal Eval"""
 
-from .types import MalObject, MalType, true, false, nil
+import os
+from typing import Callable, Dict, List, Optional, Union
+
+from .types import (
+    EMPTY_LIST, MalFloat, MalFunction, MalHashMap, MalInt, MalLazySeq, MalList, MalObject,
+    MalSymbol, MalVector, true, false, nil, iter_seq, symbol,
+)
 from .env import Env
 
 
+# Symbols used by quasiquote
+_CONS = symbol("cons")
+_CONCAT = symbol("concat")
+_VEC = symbol("vec")
+_QUOTE = symbol("quote")
+_UNQUOTE = symbol("unquote")
+_SPLICE_UNQUOTE = symbol("splice-unquote")
+
+
 def mal_quasiquote(ast: MalObject) -> MalObject:
     """Quasiquote ast."""
-    if ast.mal_type == MalType.INTEGER or ast.mal_type == MalType.FLOAT:
+    if type(ast) is MalInt or type(ast) is MalFloat:
         return ast
     # TODO: special object type for true, false, nil
-    if ast == nil or ast == false or ast == true:
+    if ast is nil or ast is false or ast is true:
         return ast
-    if ast.mal_type == MalType.LIST:
+    if type(ast) is MalList:
         if len(ast.value) == 0:
             return ast
-        if ast.value[0].value == "unquote":
+        if ast.value[0] is _UNQUOTE:
             if len(ast.value) != 2:
                 raise SyntaxError("wrong number of arguments")
             return ast.value[1]
-        ret = MalObject(MalType.LIST, [])
+        ret = EMPTY_LIST
         for elem in reversed(ast.value):
-            if elem.mal_type == MalType.LIST:
+            if type(elem) is MalList:
                 if len(elem.value) == 0:
-                    ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "cons"), elem, ret])
+                    ret = MalList([_CONS, elem, ret])
                     continue
-                if elem.value[0].value == "splice-unquote":
+                if elem.value[0] is _SPLICE_UNQUOTE:
                     if len(elem.value) != 2:
                         raise SyntaxError("wrong number of arguments")
-                    ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "concat"), elem.value[1], ret])
+                    ret = MalList([_CONCAT, elem.value[1], ret])
                     continue
-            ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "cons"), mal_quasiquote(elem), ret])
+            ret = MalList([_CONS, mal_quasiquote(elem), ret])
         return ret
-    if ast.mal_type == MalType.VECTOR:
+    if type(ast) is MalVector:
         # if len(ast.value) == 0:
         #     return ast
-        ret = MalObject(MalType.LIST, [])
+        ret = EMPTY_LIST
         for elem in reversed(ast.value):
-            if elem.mal_type == MalType.LIST:
+            if type(elem) is MalList:
                 if len(elem.value) == 0:
-                    ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "cons"), elem, ret])
+                    ret = MalList([_CONS, elem, ret])
                     continue
-                if elem.value[0].value == "splice-unquote":
+                if elem.value[0] is _SPLICE_UNQUOTE:
                     if len(elem.value) != 2:
                         raise SyntaxError("wrong number of arguments")
-                    ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "concat"), elem.value[1], ret])
+                    ret = MalList([_CONCAT, elem.value[1], ret])
                     continue
-            ret = MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "cons"), mal_quasiquote(elem), ret])
-        return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "vec"), ret])
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "quote"), ast])
+            ret = MalList([_CONS, mal_quasiquote(elem), ret])
+        return MalList([_VEC, ret])
+    return MalList([_QUOTE, ast])
+
+
+Builder = Callable[[Env], MalObject]
+
+
+def compile_quasiquote(ast: MalObject, unquoted: Callable[[MalObject], Builder] = None) -> Builder:
+    """Compile quasiquote template ast into a builder taking an env.
+
+    The builder allocates the result directly instead of going through the
+    cons/concat form of mal_quasiquote, and splices ~@ sequences with a
+    single extend. unquoted makes the builder of an unquoted form; by
+    default the form is evaluated with mal_eval."""
+    if unquoted is None:
+        unquoted = _eval_unquoted
+    if type(ast) is MalList:
+        if len(ast.value) == 0:
+            return lambda env: ast
+        if ast.value[0] is _UNQUOTE:
+            if len(ast.value) != 2:
+                raise SyntaxError("wrong number of arguments")
+            return unquoted(ast.value[1])
+        parts = _compile_quasiquote_elements(ast, unquoted)
+        return lambda env: MalList(_build_quasiquote(parts, env))
+    if type(ast) is MalVector:
+        parts = _compile_quasiquote_elements(ast, unquoted)
+        return lambda env: MalVector(_build_quasiquote(parts, env))
+    return lambda env: ast
+
+
+def _eval_unquoted(form: MalObject) -> Builder:
+    return lambda env: mal_eval(env, form)
+
+
+def _compile_quasiquote_elements(ast: MalObject, unquoted) -> list:
+    """Get (splice, builder) pairs for the elements of a template."""
+    parts = []
+    for elem in ast.value:
+        if type(elem) is MalList and len(elem.value) > 0 and elem.value[0] is _SPLICE_UNQUOTE:
+            if len(elem.value) != 2:
+                raise SyntaxError("wrong number of arguments")
+            parts.append((True, unquoted(elem.value[1])))
+        else:
+            parts.append((False, compile_quasiquote(elem, unquoted)))
+    return parts
+
+
+def _build_quasiquote(parts: list, env) -> list:
+    result = []
+    for splice, build in parts:
+        if splice:
+            seq = build(env)
+            if type(seq) is MalLazySeq:
+                result.extend(iter_seq(seq))
+                continue
+            if type(seq) is not MalList and type(seq) is not MalVector:
+                raise TypeError(f"{seq} is not a sequence")
+            result.extend(seq.value)
+        else:
+            result.append(build(env))
+    return result
 
 
 def eval_ast(env: dict, ast: MalObject) -> MalObject:
     """Evaluate ast with env."""
-    if ast.mal_type == MalType.SYMBOL:
+    if type(ast) is MalSymbol:
+        if isinstance(env, Env):
+            value = env.find(ast)
+            if value is None:
+                raise NameError(f"'{ast.value}' not found")
+            return value
         if ast.value in env:
             return env[ast.value]
         raise NameError(f"'{ast.value}' not found")
-    elif ast.mal_type == MalType.LIST:
+    elif type(ast) is MalList:
         if len(ast.value) == 0:
             return ast
-        return MalObject(MalType.LIST, [mal_eval(env, x) for x in ast.value])
-    elif ast.mal_type == MalType.VECTOR:
+        return MalList([mal_eval(env, x) for x in ast.value])
+    elif type(ast) is MalVector:
         if len(ast.value) == 0:
             return ast
-        return MalObject(MalType.VECTOR, [mal_eval(env, x) for x in ast.value])
-    elif ast.mal_type == MalType.HASHMAP:
+        return MalVector([mal_eval(env, x) for x in ast.value])
+    elif type(ast) is MalHashMap:
         if len(ast.value) == 0:
             return ast
-        return MalObject(MalType.HASHMAP, [mal_eval(env, x) for x in ast.value])
+        return MalHashMap(ast.value.map_values(lambda v: mal_eval(env, v)))
     return ast
 
 
@@ -75,166 +155,305 @@ def mal_apply(func, *args):
     """Apply func to args."""
     if callable(func):
         return func(*args)
-    if func.mal_type == MalType.FUNCTION:
-        new_env = Env(outer=func.value[0])
-        i = 0
-        is_rest = False
-        for x in func.value[1].value:
-            if x.mal_type != MalType.SYMBOL:
-                raise SyntaxError(f"{x} is not a symbol")
-            if is_rest:
-                new_env[x.value] = MalObject(MalType.LIST, list(args[i:]))
-                break
-            if x.value == "&":
-                is_rest = True
-                continue
-            new_env[x.value] = args[i]
-            i += 1
-        return mal_eval(new_env, func.value[2])
+    if type(func) is MalFunction:
+        return mal_eval(Env(func.env, func.plan.bind(args)), func.body)
+    raise TypeError(f"{func} is not callable")
+
+
+def fn_caller(func) -> Callable:
+    """Get a Python callable applying func.
+
+    The dispatch of mal_apply is done once, so loops calling the same
+    function many times only pay for the call itself."""
+    if callable(func):
+        return func
+    if type(func) is MalFunction:
+        env = func.env
+        body = func.body
+        bind = func.plan.bind
+        return lambda *args: mal_eval(Env(env, bind(args)), body)
     raise TypeError(f"{func} is not callable")
 
 
+# Cache macro expansions on their call sites. Code that redefines macros
+# at runtime can turn this off, or run with MAL_MACRO_CACHE=0.
+MACRO_CACHE = os.environ.get("MAL_MACRO_CACHE", "1") != "0"
+
+_MACRO_STATS = {"expansions": 0, "hits": 0}
+
+
+class TailEval:
+    """Result of a special form asking mal_eval to go on with exp in env."""
+
+    __slots__ = ("env", "exp")
+
+    def __init__(self, env, exp: MalObject):
+        self.env = env
+        self.exp = exp
+
+
+# Special form handlers by interned head symbol. A handler takes (env, exp)
+# and returns either the value of exp or a TailEval to continue with.
+# The analyzer and the VM compile the built-in forms themselves and reject
+# the others found here when they analyze or compile them.
+SPECIAL_FORMS: Dict[MalSymbol, Callable[[Env, MalObject], Union[MalObject, TailEval]]] = {}
+
+
+def special_form(name: str):
+    """Register the decorated function as the handler of special form name.
+
+    Only the tree engine runs registered forms; the analyze and vm
+    engines raise a SyntaxError for them."""
+    def register(handler):
+        SPECIAL_FORMS[symbol(name)] = handler
+        return handler
+    return register
+
+
+@special_form("def!")
+def _eval_def(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalSymbol:
+        raise SyntaxError("first argument must be a symbol")
+    val = mal_eval(env, exp.value[2])
+    env[exp.value[1].value] = val
+    return val
+
+
+@special_form("defmacro!")
+def _eval_defmacro(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalSymbol:
+        raise SyntaxError("first argument must be a symbol")
+    val = mal_eval(env, exp.value[2])
+    if not isinstance(val, MalFunction):
+        raise SyntaxError("second argument must be a function")
+    env[exp.value[1].value] = val.as_macro()
+    return nil
+
+
+@special_form("let*")
+def _eval_let(env, exp: MalObject) -> TailEval:
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalList and type(exp.value[1]) is not MalVector:
+        raise SyntaxError("second argument must be a list or vector")
+    if len(exp.value[1].value) % 2 != 0:
+        raise SyntaxError("odd number of forms in binding vector")
+    new_env = Env(outer=env)
+    for i in range(0, len(exp.value[1].value), 2):
+        if type(exp.value[1].value[i]) is not MalSymbol:
+            raise SyntaxError("binding form must be a symbol")
+        new_env[exp.value[1].value[i].value] = mal_eval(new_env, exp.value[1].value[i + 1])
+    # TCO
+    # original: return mal_eval(new_env, exp.value[2])
+    return TailEval(new_env, exp.value[2])
+
+
+@special_form("do")
+def _eval_do(env, exp: MalObject) -> Union[MalObject, TailEval]:
+    if len(exp.value) == 1:
+        return nil
+    for v in exp.value[1:-1]:
+        mal_eval(env, v)
+    # TCO
+    # original: return mal_eval(env, exp.value[-1])
+    return TailEval(env, exp.value[-1])
+
+
+@special_form("if")
+def _eval_if(env, exp: MalObject) -> Union[MalObject, TailEval]:
+    if len(exp.value) < 3 or len(exp.value) > 4:
+        raise SyntaxError("wrong number of arguments")
+    condition = mal_eval(env, exp.value[1])
+    if condition is false or condition is nil:
+        if len(exp.value) == 4:
+            # TCO
+            # original: return mal_eval(env, exp.value[3])
+            return TailEval(env, exp.value[3])
+        return nil
+    # TCO
+    # original: return mal_eval(env, exp.value[2])
+    return TailEval(env, exp.value[2])
+
+
+@special_form("fn*")
+def _eval_fn(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 3:
+        raise SyntaxError("wrong number of arguments")
+    if type(exp.value[1]) is not MalList and type(exp.value[1]) is not MalVector:
+        raise SyntaxError("second argument must be a list or vector")
+    return MalFunction(env, exp.value[1], exp.value[2])
+
+
+@special_form("quote")
+def _eval_quote(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    return exp.value[1]
+
+
+@special_form("quasiquote")
+def _eval_quasiquote(env, exp: MalObject) -> Union[MalObject, TailEval]:
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    template = exp.value[1]
+    if (type(template) is MalList and len(template.value) == 2
+            and template.value[0] is _UNQUOTE):
+        # TCO
+        # original: return mal_eval(env, template.value[1])
+        return TailEval(env, template.value[1])
+    # The template is compiled once and the builder kept on the form.
+    build = exp.quasiquote_cache
+    if build is None:
+        build = compile_quasiquote(template)
+        exp.quasiquote_cache = build
+    return build(env)
+
+
+@special_form("quasiquoteexpand")
+def _eval_quasiquoteexpand(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    return mal_quasiquote(exp.value[1])
+
+
+@special_form("macroexpand")
+def _eval_macroexpand(env, exp: MalObject) -> MalObject:
+    if len(exp.value) != 2:
+        raise SyntaxError("wrong number of arguments")
+    return mal_macroexpand(env, exp.value[1])
+
+
 def mal_eval(env, exp: MalObject) -> MalObject:
     """Evaluate exp with env."""
     while True:
         exp = mal_macroexpand(env, exp)
-        if exp.mal_type != MalType.LIST:
+        if type(exp) is not MalList:
             return eval_ast(env, exp)
         if len(exp.value) == 0:
             return exp
         # Special forms
-        if exp.value[0].value == "def!":
-            if len(exp.value) != 3:
-                raise SyntaxError("wrong number of arguments")
-            if exp.value[1].mal_type != MalType.SYMBOL:
-                raise SyntaxError("first argument must be a symbol")
-            val = mal_eval(env, exp.value[2])
-            env[exp.value[1].value] = val
-            return val
-        if exp.value[0].value == "defmacro!":
-            if len(exp.value) != 3:
-                raise SyntaxError("wrong number of arguments")
-            if exp.value[1].mal_type != MalType.SYMBOL:
-                raise SyntaxError("first argument must be a symbol")
-            val = mal_eval(env, exp.value[2])
-            if val.mal_type != MalType.FUNCTION:
-                raise SyntaxError("second argument must be a function")
-            macro = MalObject(MalType.FUNCTION, val.value, is_macro_call=True)
-            env[exp.value[1].value] = macro
-            return nil
-        if exp.value[0].value == "let*":
-            if len(exp.value) != 3:
-                raise SyntaxError("wrong number of arguments")
-            if exp.value[1].mal_type != MalType.LIST and exp.value[1].mal_type != MalType.VECTOR:
-                raise SyntaxError("second argument must be a list or vector")
-            if len(exp.value[1].value) % 2 != 0:
-                raise SyntaxError("odd number of forms in binding vector")
-            new_env = Env(outer=env)
-            for i in range(0, len(exp.value[1].value), 2):
-                if exp.value[1].value[i].mal_type != MalType.SYMBOL:
-                    raise SyntaxError("binding form must be a symbol")
-                new_env[exp.value[1].value[i].value] = mal_eval(new_env, exp.value[1].value[i + 1])
-            # TCO
-            # original: return mal_eval(new_env, exp.value[2])
-            env = new_env
-            exp = exp.value[2]
-            continue
-        if exp.value[0].value == "do":
-            if len(exp.value) == 1:
-                return nil
-            for v in exp.value[1:-1]:
-                mal_eval(env, v)
-            # TCO
-            # original: return mal_eval(env, exp.value[-1])
-            exp = exp.value[-1]
-            continue
-        if exp.value[0].value == "if":
-            if len(exp.value) < 3 or len(exp.value) > 4:
-                raise SyntaxError("wrong number of arguments")
-            condition = mal_eval(env, exp.value[1])
-            if condition == false or condition == nil:
-                if len(exp.value) == 4:
-                    # TCO
-                    # original: return mal_eval(env, exp.value[3])
-                    exp = exp.value[3]
+        head = exp.value[0]
+        if type(head) is MalSymbol:
+            form = SPECIAL_FORMS.get(head)
+            if form is not None:
+                result = form(env, exp)
+                if type(result) is TailEval:
+                    env = result.env
+                    exp = result.exp
                     continue
-                return nil
-            # TCO
-            # original: return mal_eval(env, exp.value[2])
-            exp = exp.value[2]
-            continue
-        if exp.value[0].value == "fn*":
-            if len(exp.value) != 3:
-                raise SyntaxError("wrong number of arguments")
-            if exp.value[1].mal_type != MalType.LIST and exp.value[1].mal_type != MalType.VECTOR:
-                raise SyntaxError("second argument must be a list or vector")
-            new_env = Env(outer=env)
-            return MalObject(MalType.FUNCTION, (new_env, exp.value[1], exp.value[2]))
-        if exp.value[0].value == "quote":
-            if len(exp.value) != 2:
-                raise SyntaxError("wrong number of arguments")
-            return exp.value[1]
-        if exp.value[0].value == "quasiquote":
-            if len(exp.value) != 2:
-                raise SyntaxError("wrong number of arguments")
-            # TCO
-            # original: return mal_quasiquote(exp.value[1])
-            exp = mal_quasiquote(exp.value[1])
-            continue
-        if exp.value[0].value == "quasiquoteexpand":
-            if len(exp.value) != 2:
-                raise SyntaxError("wrong number of arguments")
-            return mal_quasiquote(exp.value[1])
-        if exp.value[0].value == "macroexpand":
-            if len(exp.value) != 2:
-                raise SyntaxError("wrong number of arguments")
-            return mal_macroexpand(env, exp.value[1])
+                return result
         # Function call
-        evaluated = eval_ast(env, exp)
-        func = evaluated.value[0]
-        args = evaluated.value[1:]
+        args = eval_ast(env, exp).value
+        func = args.pop(0)
         # return mal_apply(env, func, *args)
-        if callable(func):
-            return func(*args)
-        if func.mal_type == MalType.FUNCTION:
-            new_env = Env(outer=func.value[0])
-            i = 0
-            is_rest = False
-            for x in func.value[1].value:
-                if x.mal_type != MalType.SYMBOL:
-                    raise SyntaxError(f"{x} is not a symbol")
-                if is_rest:
-                    new_env[x.value] = MalObject(MalType.LIST, list(args[i:]))
-                    break
-                if x.value == "&":
-                    is_rest = True
-                    continue
-                new_env[x.value] = args[i]
-                i += 1
+        if type(func) is MalFunction:
             # TCO
-            # original: return mal_eval(new_env, func.value[2])
-            env = new_env
-            exp = func.value[2]
+            # original: return mal_eval(Env(func.env, func.plan.bind(args)), func.body)
+            env = Env(func.env, func.plan.bind(args))
+            exp = func.body
             continue
+        if callable(func):
+            # The common two-argument call skips the call_builtin frame
+            if len(args) == 2:
+                return func(args.pop(0), args.pop())
+            return call_builtin(func, args)
         raise TypeError(f"{func} is not callable")
 
 
-def is_macro_call(env: Env, ast: MalObject) -> bool:
-    if ast.mal_type != MalType.LIST or len(ast.value) == 0 or ast.value[0].mal_type != MalType.SYMBOL:
-        return False
+def call_builtin(func: Callable, args: List[MalObject]) -> MalObject:
+    """Call the host function func on args, emptying args as they are passed.
+
+    The builtin then holds the only reference to each argument, so one
+    that walks a lazy seq can let go of its head and of the elements it
+    has passed."""
+    n = len(args)
+    if n == 1:
+        return func(args.pop())
+    if n == 2:
+        return func(args.pop(0), args.pop())
+    if n == 3:
+        return func(args.pop(0), args.pop(0), args.pop())
+    if n == 4:
+        return func(args.pop(0), args.pop(0), args.pop(0), args.pop())
+    return func(*args)
+
+
+def unsupported_form(head: MalSymbol, engine: str) -> SyntaxError:
+    """Get the error an engine raises for a registered form it can't run."""
+    return SyntaxError(f"special form {head.value} is not supported by the {engine} engine")
+
+
+def tree_eval(env, exp: MalObject) -> MalObject:
+    """Evaluate exp with env, running out of stack as the VM does.
+
+    mal_eval recurses on the Python stack, so deep non-tail recursion ends
+    in the call depth error the VM raises rather than in Python's."""
+    try:
+        return mal_eval(env, exp)
+    except RecursionError as e:
+        raise call_depth_error(e) from None
+
+
+def call_depth_error(e: RecursionError) -> RecursionError:
+    """Get the call depth error to raise in place of e."""
+    if str(e).startswith("maximum call depth"):
+        return e
+    return RecursionError("maximum call depth exceeded")
+
+
+def _macro_of(env: Env, ast: MalObject) -> Optional[MalFunction]:
+    """Get the macro called by ast, or None if ast is not a macro call."""
+    if type(ast) is not MalList or len(ast.value) == 0 or type(ast.value[0]) is not MalSymbol:
+        return None
     symbol = ast.value[0]
-    if symbol.value not in env:
-        return False
-    func = env[symbol.value]
-    if not isinstance(func, MalObject) or func.mal_type != MalType.FUNCTION:
-        return False
-    return func.is_macro_call
+    if isinstance(env, Env):
+        func = env.find(symbol)
+    else:
+        func = env.get(symbol.value)
+    if not isinstance(func, MalFunction) or not func.is_macro_call:
+        return None
+    return func
+
+
+def is_macro_call(env: Env, ast: MalObject) -> bool:
+    return _macro_of(env, ast) is not None
 
 
 def mal_macroexpand(env: Env, ast: MalObject) -> MalObject:
-    """Macroexpand ast with env."""
-    while True:
-        if not is_macro_call(env, ast):
+    """Macroexpand ast with env.
+
+    Each call site is expanded once and the expansion is cached on it, so
+    the macro does not run again the next time the site is evaluated.
+    Forms that are not macro calls are remembered until a macro is bound
+    somewhere, which bumps Env.macro_version."""
+    cache = ast.macro_cache
+    if cache is not None:
+        if cache[1] is not None:
+            if MACRO_CACHE:
+                _MACRO_STATS["hits"] += 1
+                return cache[1]
+        elif cache[0] == Env.macro_version:
             return ast
-        func = env[ast.value[0].value]
+    original = ast
+    while True:
+        func = _macro_of(env, ast)
+        if func is None:
+            break
         ast = mal_apply(func, *ast.value[1:])
+        _MACRO_STATS["expansions"] += 1
+    if ast is not original:
+        if MACRO_CACHE:
+            original.macro_cache = (None, ast)
+    elif type(ast) is MalList and ast.value and isinstance(env, Env):
+        # Empty lists are skipped: EMPTY_LIST is shared and never written
+        original.macro_cache = (Env.macro_version, None)
+    return ast
+
+
+def macro_cache_stats() -> Dict[str, int]:
+    """Get the numbers of macro expansions performed and reused."""
+    return dict(_MACRO_STATS)
@@ -0,0 +1,303 @@
+"""Mal Parsed-Form Cache
+
+load-file keeps the forms it reads in .malc files under CACHE_DIR, so a
+file that has not changed is not read and parsed again on the next start.
+
+A .malc file is named after a hash of the absolute path of its source.
+It starts with a fixed-size HEADER of
+
+    (MAGIC, VERSION, mtime_ns, size, digest, count, length)
+
+where digest is the BLAKE2b hash of the source bytes, count the number of
+top-level forms and length the size of the records that follow. Each
+form has its own record: a 4-byte length and a marshal dump of
+
+    (line, code)
+
+where line is the first line of the form and code the form in postfix
+order: ints, floats and strs stand for ints, floats and symbols, bytes for
+UTF-8 strings, and (tag, arg) tuples for keywords and for lists, vectors
+and maps built from the last arg values.
+
+Records are written as the forms are read and decoded as they are
+evaluated, so only the form at hand is held in memory either way.
+
+An entry is used as is if the mtime and size of the source still match.
+If only the mtime changed, the source is hashed and the entry is used
+if the digest matches. Entries are written to a temporary file and renamed
+into place, so concurrent writers never leave a torn file behind.
+
+MAL_FORM_CACHE=0 turns the cache off, MAL_FORM_CACHE_DIR moves it, and
+MAL_FORM_CACHE_STATS=1 prints its counters to stderr at exit.
+"""
+
+import atexit
+import hashlib
+import marshal
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+from .types import (
+    EMPTY_LIST, EMPTY_VECTOR, MalFloat, MalHashMap, MalInt, MalKeyword, MalList, MalObject,
+    MalString, MalSymbol, MalVector, hash_map, keyword, mal_int, symbol,
+)
+
+ENABLED = os.environ.get("MAL_FORM_CACHE", "1") != "0"
+CACHE_DIR = os.environ.get("MAL_FORM_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "mypython")
+
+MAGIC = b"MALC"
+# Bumped whenever the layout of the entries changes
+VERSION = 2
+HEADER = struct.Struct("<4sIqQ16sQQ")
+_LENGTH = struct.Struct("<I")
+
+_KEYWORD = 0
+_LIST = 1
+_VECTOR = 2
+_MAP = 3
+
+_STATS = {"hits": 0, "misses": 0, "rehashes": 0, "writes": 0, "errors": 0}
+
+Forms = Iterator[Tuple[int, MalObject]]
+
+
+def cache_path(path: str) -> str:
+    """Get the .malc file of the source file path."""
+    name = hashlib.blake2b(os.path.abspath(path).encode("utf-8", "surrogatepass"),
+                           digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, name + ".malc")
+
+
+def digest(data) -> bytes:
+    """Get the content hash of a bytes-like source."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _encode(form: MalObject, code: list) -> None:
+    # Walk with an explicit stack; children are pushed in reverse so they
+    # come out in order, and a collection's tag follows its children.
+    pending = [form]
+    while pending:
+        x = pending.pop()
+        t = type(x)
+        if t is MalSymbol:
+            code.append(x.value)
+        elif t is MalInt:
+            code.append(x.value)
+        elif t is MalString:
+            code.append(x.value.encode("utf-8", "surrogatepass"))
+        elif t is MalKeyword:
+            code.append((_KEYWORD, x.value))
+        elif t is MalFloat:
+            code.append(x.value)
+        elif t is tuple:
+            code.append(x)
+        elif t is MalList or t is MalVector:
+            items = list(x.value)
+            pending.append((_LIST if t is MalList else _VECTOR, len(items)))
+            pending.extend(reversed(items))
+        elif t is MalHashMap:
+            kvs = []
+            for k, v in x.items():
+                kvs += [k, v]
+            pending.append((_MAP, len(kvs)))
+            pending.extend(reversed(kvs))
+        else:
+            raise TypeError(f"{x!r} can not be cached")
+
+
+def _decode(code: list) -> MalObject:
+    stack = []
+    push = stack.append
+    for x in code:
+        t = type(x)
+        if t is str:
+            push(symbol(x))
+        elif t is int:
+            push(mal_int(x))
+        elif t is bytes:
+            push(MalString(x.decode("utf-8", "surrogatepass")))
+        elif t is float:
+            push(MalFloat(x))
+        else:
+            tag, arg = x
+            if tag == _KEYWORD:
+                push(keyword(arg))
+                continue
+            start = len(stack) - arg
+            items = stack[start:]
+            del stack[start:]
+            if tag == _LIST:
+                push(MalList(items) if items else EMPTY_LIST)
+            elif tag == _VECTOR:
+                push(MalVector(items) if items else EMPTY_VECTOR)
+            else:
+                push(hash_map(items))
+    if len(stack) != 1:
+        raise ValueError("corrupt form cache entry")
+    return stack[0]
+
+
+def _records(f: BinaryIO, count: int) -> Forms:
+    try:
+        for _ in range(count):
+            n, = _LENGTH.unpack(f.read(_LENGTH.size))
+            line, code = marshal.loads(f.read(n))
+            yield line, _decode(code)
+    except (EOFError, TypeError, ValueError, struct.error) as e:
+        raise ValueError("corrupt form cache entry") from e
+    finally:
+        f.close()
+
+
+def lookup(path: str, st: os.stat_result, data=None) -> Optional[Forms]:
+    """Get an iterator over the cached forms of path, whose stat is st, or
+    None.
+
+    The forms are decoded one at a time as the iterator is advanced. data,
+    the bytes of the source if it is at hand, is hashed when the mtime of
+    the entry is stale."""
+    try:
+        f = open(cache_path(path), "rb")
+    except OSError:
+        _STATS["misses"] += 1
+        return None
+    try:
+        header = HEADER.unpack(f.read(HEADER.size))
+        magic, version, mtime_ns, size, entry_digest, count, length = header
+        if (magic != MAGIC or version != VERSION or size != st.st_size
+                or os.fstat(f.fileno()).st_size != HEADER.size + length):
+            header = None
+        elif mtime_ns != st.st_mtime_ns:
+            if data is None or digest(data) != entry_digest:
+                header = None
+            else:
+                _STATS["rehashes"] += 1
+                _restamp(path, st, f, entry_digest, count, length)
+        if header is not None:
+            _STATS["hits"] += 1
+            return _records(f, count)
+    except (OSError, struct.error):
+        pass
+    f.close()
+    _STATS["misses"] += 1
+    return None
+
+
+def _restamp(path: str, st: os.stat_result, f: BinaryIO, source_digest: bytes, count: int,
+             length: int) -> None:
+    # Copy the records of the entry f to a new entry stamped with st
+    writer = Writer(path, st)
+    if writer.file is None:
+        return
+    try:
+        shutil.copyfileobj(f, writer.file)
+    except OSError:
+        _STATS["errors"] += 1
+        writer.close()
+    else:
+        writer.count = count
+        writer.length = length
+        writer.commit(source_digest)
+    finally:
+        f.seek(HEADER.size)
+
+
+class Writer:
+    """Writer of a new entry for path, whose stat is st.
+
+    Forms are added as they are read, and the entry replaces any previous
+    one atomically when it is committed. A writer that failed, or was
+    given a form that can not be cached, drops the entry."""
+
+    def __init__(self, path: str, st: os.stat_result):
+        self.path = path
+        self.st = st
+        self.count = 0
+        self.length = 0
+        self.file: Optional[BinaryIO] = None
+        self.tmp = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, self.tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            self.file = os.fdopen(fd, "wb")
+            self.file.write(bytes(HEADER.size))
+        except OSError:
+            _STATS["errors"] += 1
+            self.close()
+
+    def add(self, line: int, form: MalObject) -> None:
+        """Write the record of form, which starts on line."""
+        if self.file is None:
+            return
+        code = []
+        try:
+            _encode(form, code)
+            record = marshal.dumps((line, code))
+            self.file.write(_LENGTH.pack(len(record)))
+            self.file.write(record)
+        except TypeError:
+            self.close()
+            return
+        except (OSError, ValueError):
+            _STATS["errors"] += 1
+            self.close()
+            return
+        self.count += 1
+        self.length += _LENGTH.size + len(record)
+
+    def recording(self, forms: Forms) -> Forms:
+        """Yield the (line, form) pairs of forms, adding each first."""
+        for line, form in forms:
+            self.add(line, form)
+            yield line, form
+
+    def commit(self, source_digest: bytes) -> None:
+        """Write the header and rename the entry into place."""
+        if self.file is None:
+            return
+        st = self.st
+        try:
+            self.file.seek(0)
+            self.file.write(HEADER.pack(MAGIC, VERSION, st.st_mtime_ns, st.st_size, source_digest,
+                                        self.count, self.length))
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp, cache_path(self.path))
+            self.tmp = None
+            _STATS["writes"] += 1
+        except OSError:
+            _STATS["errors"] += 1
+        self.close()
+
+    def close(self) -> None:
+        """Drop the entry unless it was committed."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.tmp is not None:
+            try:
+                os.unlink(self.tmp)
+            except OSError:
+                pass
+            self.tmp = None
+
+
+def cache_stats() -> Dict[str, int]:
+    """Get the hit, miss, rehash, write and error counts of the cache."""
+    return dict(_STATS)
+
+
+def _print_stats() -> None:
+    stats = ", ".join(f"{n} {name}" for name, n in _STATS.items())
+    print(f"form cache ({CACHE_DIR}): {stats}", file=sys.stderr)
+
+
+if os.environ.get("MAL_FORM_CACHE_STATS", "0") != "0":
+    atexit.register(_print_stats)
@@ -0,0 +1,236 @@
+"""Mal Hash Array Mapped Trie
+
+Persistent map used by MalHashMap. Each level of the trie consumes five
+bits of the key hash, so get, assoc and dissoc touch O(log32 n) nodes and
+share everything else with the map they were derived from.
+
+Entries are (hash, hkey, key, value) tuples, where hkey is the hash_key
+of key. Hashes are computed by the caller rather than with hash(hkey), so
+the layout, and the order entries are walked in, can be made the same in
+every process.
+"""
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BITS = 5
+MASK = (1 << BITS) - 1
+# Hashes are taken modulo 2**64; keys whose hashes agree on all 64 bits
+# end up in a _Collision bucket.
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+Entry = Tuple[int, object, object, object]
+
+
+class _Node:
+    """Bitmap-indexed node; items holds entries and child nodes."""
+
+    __slots__ = ("bitmap", "items")
+
+    def __init__(self, bitmap: int, items: list):
+        self.bitmap = bitmap
+        self.items = items
+
+
+class _Collision:
+    """Bucket of entries whose hashes are equal."""
+
+    __slots__ = ("hash", "items")
+
+    def __init__(self, h: int, items: List[Entry]):
+        self.hash = h
+        self.items = items
+
+
+_EMPTY_NODE = _Node(0, [])
+
+
+def _pair(a: Entry, b: Entry, shift: int):
+    """Make the subtree holding two entries with different hkeys."""
+    if shift >= HASH_BITS:
+        return _Collision(a[0], [a, b])
+    i = (a[0] >> shift) & MASK
+    j = (b[0] >> shift) & MASK
+    if i == j:
+        return _Node(1 << i, [_pair(a, b, shift + BITS)])
+    if i < j:
+        return _Node((1 << i) | (1 << j), [a, b])
+    return _Node((1 << i) | (1 << j), [b, a])
+
+
+def _assoc(node, shift: int, entry: Entry):
+    """Get node with entry added; the second value is True for a new key."""
+    if type(node) is _Collision:
+        items = node.items
+        for i, e in enumerate(items):
+            if e[1] == entry[1]:
+                return _Collision(node.hash, items[:i] + [entry] + items[i + 1:]), False
+        return _Collision(node.hash, items + [entry]), True
+    bit = 1 << ((entry[0] >> shift) & MASK)
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    items = node.items
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, items[:idx] + [entry] + items[idx:]), True
+    item = items[idx]
+    if type(item) is tuple:
+        if item[1] == entry[1]:
+            if item[3] is entry[3] and item[2] is entry[2]:
+                return node, False
+            child, added = entry, False
+        else:
+            child, added = _pair(item, entry, shift + BITS), True
+    else:
+        child, added = _assoc(item, shift + BITS, entry)
+        if child is item:
+            return node, False
+    items = list(items)
+    items[idx] = child
+    return _Node(node.bitmap, items), added
+
+
+def _dissoc(node, shift: int, h: int, hkey):
+    """Get node without hkey, None if it becomes empty, or node itself if
+    hkey is missing."""
+    if type(node) is _Collision:
+        items = [e for e in node.items if e[1] != hkey]
+        if len(items) == len(node.items):
+            return node
+        if len(items) == 1:
+            return items[0]
+        return _Collision(node.hash, items)
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return node
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    item = node.items[idx]
+    if type(item) is tuple:
+        if item[1] != hkey:
+            return node
+        child = None
+    else:
+        child = _dissoc(item, shift + BITS, h, hkey)
+        if child is item:
+            return node
+    items = list(node.items)
+    if child is None:
+        del items[idx]
+        if not items:
+            return None
+        # A node left with a single entry is folded into its parent
+        if len(items) == 1 and type(items[0]) is tuple and shift > 0:
+            return items[0]
+        return _Node(node.bitmap & ~bit, items)
+    items[idx] = child
+    return _Node(node.bitmap, items)
+
+
+def _build(entries: List[Entry], shift: int):
+    """Build the subtree holding entries, which have distinct hkeys."""
+    if shift >= HASH_BITS:
+        return _Collision(entries[0][0], entries)
+    buckets: Dict[int, List[Entry]] = {}
+    for entry in entries:
+        i = (entry[0] >> shift) & MASK
+        bucket = buckets.get(i)
+        if bucket is None:
+            buckets[i] = [entry]
+        else:
+            bucket.append(entry)
+    bitmap = 0
+    items = []
+    for i in sorted(buckets):
+        bitmap |= 1 << i
+        bucket = buckets[i]
+        items.append(bucket[0] if len(bucket) == 1 else _build(bucket, shift + BITS))
+    return _Node(bitmap, items)
+
+
+def _map_values(node, fn):
+    if type(node) is _Collision:
+        return _Collision(node.hash, [(e[0], e[1], e[2], fn(e[3])) for e in node.items])
+    return _Node(node.bitmap, [
+        (item[0], item[1], item[2], fn(item[3])) if type(item) is tuple else _map_values(item, fn)
+        for item in node.items
+    ])
+
+
+def _walk(node) -> Iterator[Entry]:
+    for item in node.items:
+        if type(item) is tuple:
+            yield item
+        else:
+            yield from _walk(item)
+
+
+class Hamt:
+    """Persistent map from hkeys to (key, value) pairs."""
+
+    __slots__ = ("root", "count")
+
+    def __init__(self, root: _Node = _EMPTY_NODE, count: int = 0):
+        self.root = root
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def build(data: Dict[object, Tuple[int, object, object]]) -> "Hamt":
+        """Build a map from a dict of hkey -> (hash, key, value) in one pass."""
+        if not data:
+            return EMPTY
+        entries = [(h & HASH_MASK, hkey, key, value) for hkey, (h, key, value) in data.items()]
+        root = _build(entries, 0)
+        return Hamt(root, len(entries))
+
+    def get(self, h: int, hkey) -> Optional[Entry]:
+        """Get the (hash, hkey, key, value) entry of hkey, whose hash is h,
+        or None."""
+        full = h = h & HASH_MASK
+        node = self.root
+        while True:
+            if type(node) is _Collision:
+                for e in node.items:
+                    if e[1] == hkey:
+                        return e
+                return None
+            bitmap = node.bitmap
+            bit = 1 << (h & MASK)
+            if not bitmap & bit:
+                return None
+            item = node.items[(bitmap & (bit - 1)).bit_count()]
+            if type(item) is tuple:
+                if item[0] == full and item[1] == hkey:
+                    return item
+                return None
+            node = item
+            h >>= BITS
+
+    def assoc(self, h: int, hkey, key, value) -> "Hamt":
+        """Get a map with hkey, whose hash is h, bound to (key, value)."""
+        root, added = _assoc(self.root, 0, (h & HASH_MASK, hkey, key, value))
+        if root is self.root:
+            return self
+        return Hamt(root, self.count + 1 if added else self.count)
+
+    def dissoc(self, h: int, hkey) -> "Hamt":
+        """Get a map without hkey, whose hash is h."""
+        root = _dissoc(self.root, 0, h & HASH_MASK, hkey)
+        if root is self.root:
+            return self
+        if root is None:
+            return EMPTY
+        return Hamt(root, self.count - 1)
+
+    def entries(self) -> Iterator[Entry]:
+        """Iterate over (hash, hkey, key, value) entries."""
+        return _walk(self.root)
+
+    def map_values(self, fn) -> "Hamt":
+        """Get a map with the same keys and fn applied to each value."""
+        if self.count == 0:
+            return self
+        return Hamt(_map_values(self.root, fn), self.count)
+
+
+EMPTY = Hamt()
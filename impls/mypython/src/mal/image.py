@@ -0,0 +1,220 @@
+"""Mal Heap Image
+
+save_image writes the bindings of the global env to a file, and
+load_image binds them again in the global env of a fresh interpreter, so
+a program can start from the state left by its libraries without
+evaluating them again.
+
+An image is MAGIC and a line naming the engine that made it, followed
+by pickles of the number of bindings and of each (name, value) binding,
+written with one pickler so values shared between bindings are shared
+again when read back. Values are saved as they are built:
+
+- symbols, keywords and small ints go through symbol, keyword and
+  mal_int, so they are interned again;
+- lists, vectors and hash-maps are rebuilt from their elements, which
+  drops the caches attached to them and rehashes map keys;
+- functions keep their params, body and env; analyzer closures are
+  analyzed again and VM functions compiled again on their first call;
+- the global env and the builtin functions bound in it are saved by
+  name and resolved against the env the image is loaded into.
+
+Host functions that are not builtins, such as memoized functions
+or transducers, and lazy seqs that are not fully realized can not be
+saved.
+"""
+
+import os
+import pickle
+import tempfile
+from typing import Dict, List
+
+from .analyzer import Closure, _Scope, analyze_restored, restore_closure
+from .env import Env, Frame
+from .types import (
+    EMPTY_LIST, EMPTY_VECTOR, MalAtom, MalFloat, MalFunction, MalHashMap, MalInt, MalKeyword,
+    MalLazySeq, MalList, MalObject, MalString, MalSymbol, MalVector, hash_map, keyword, lazy_chunk,
+    mal_int, symbol,
+)
+from .vm import FnTemplate, VMClosure
+
+# Changed whenever the way values are saved changes
+MAGIC = b"mypython image 1\n"
+
+# Functions are saved in the form the engine runs them in, so an image
+# only loads under the engine that saved it.
+ENGINE = os.environ.get("MAL_ENGINE", "tree")
+
+_GLOBALS = ("globals",)
+
+
+def _list(items: List[MalObject]) -> MalList:
+    return MalList(items) if items else EMPTY_LIST
+
+
+def _vector(items: List[MalObject]) -> MalVector:
+    return MalVector(items) if items else EMPTY_VECTOR
+
+
+def _bind(env: Env, data: Dict[str, MalObject]) -> None:
+    # Bindings go through __setitem__ so the names of local envs are known
+    # to the inline caches.
+    for key, value in data.items():
+        env[key] = value
+
+
+def _reduce_lazy_seq(s: MalLazySeq):
+    items = []
+    while type(s) is MalLazySeq:
+        if s._realize is not None:
+            raise TypeError("a lazy seq that is not fully realized can not be saved")
+        items.extend(s._items[s._offset:])
+        s = s._rest
+    return lazy_chunk, (items, 0, s)
+
+
+def _reduce_hash_map(m: MalHashMap):
+    kvs = []
+    for k, v in m.items():
+        kvs += [k, v]
+    return hash_map, (kvs,)
+
+
+_REDUCERS = {
+    MalSymbol: lambda x: (symbol, (x.value,)),
+    MalKeyword: lambda x: (keyword, (x.value,)),
+    MalInt: lambda x: (mal_int, (x.value,)),
+    MalFloat: lambda x: (MalFloat, (x.value,)),
+    MalString: lambda x: (MalString, (x.value,)),
+    MalList: lambda x: (_list, (list(x.value),)),
+    MalVector: lambda x: (_vector, (list(x.value),)),
+    MalHashMap: _reduce_hash_map,
+    MalLazySeq: _reduce_lazy_seq,
+    MalFunction: lambda x: (MalFunction, (x.env, x.params, x.body, None, x.is_macro_call)),
+    Closure: lambda x: (restore_closure, (x.env, x.params, x.body, x.layout.outer, x.is_macro_call)),
+    VMClosure: lambda x: (VMClosure, (x.template, x.env, x.is_macro_call)),
+    FnTemplate: lambda x: (FnTemplate, (x.params, x.ast, None, x.scope)),
+    Env: lambda x: (Env, (x._outer,), x.bindings(), None, None, _bind),
+}
+
+# Objects saved with their slots or __dict__ as they are
+_PLAIN = (MalAtom, Frame, _Scope)
+
+# Everything an image may refer to by name
+_GLOBAL_NAMES = {
+    (x.__module__, x.__qualname__): x
+    for x in (
+        symbol, keyword, mal_int, MalFloat, MalString, _list, _vector, hash_map, lazy_chunk,
+        MalFunction, restore_closure, VMClosure, FnTemplate, Env, _bind, *_PLAIN,
+    )
+}
+
+
+def _is_global(obj) -> bool:
+    name = (getattr(obj, "__module__", None), getattr(obj, "__qualname__", None))
+    return _GLOBAL_NAMES.get(name) is obj
+
+
+class _Pickler(pickle.Pickler):
+
+    def __init__(self, f, env: Env, builtins: Dict[int, str]):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.env = env
+        self.builtins = builtins
+
+    def persistent_id(self, obj):
+        if obj is self.env:
+            return _GLOBALS
+        if isinstance(obj, MalObject) or isinstance(obj, type) or not callable(obj):
+            return None
+        name = self.builtins.get(id(obj))
+        if name is not None:
+            return ("builtin", name)
+        if _is_global(obj):
+            return None
+        raise TypeError(f"{obj!r} is not a builtin and can not be saved")
+
+    def reducer_override(self, obj):
+        reduce = _REDUCERS.get(type(obj))
+        if reduce is not None:
+            return reduce(obj)
+        if type(obj) in _PLAIN or _is_global(obj):
+            return NotImplemented
+        raise TypeError(f"{obj!r} can not be saved")
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def __init__(self, f, env: Env):
+        super().__init__(f)
+        self.env = env
+        self.builtins = env.bindings()
+        self.closures: List[Closure] = []
+
+    def persistent_load(self, pid):
+        if pid == _GLOBALS:
+            return self.env
+        name = pid[1]
+        value = self.builtins.get(name)
+        if value is None or isinstance(value, MalObject):
+            raise pickle.UnpicklingError(f"image refers to the unknown builtin {name}")
+        return value
+
+    def find_class(self, module, name):
+        x = _GLOBAL_NAMES.get((module, name))
+        if x is None:
+            raise pickle.UnpicklingError(f"image refers to the unknown global {module}.{name}")
+        if x is restore_closure:
+            return self._restore_closure
+        return x
+
+    def _restore_closure(self, *args) -> Closure:
+        closure = restore_closure(*args)
+        self.closures.append(closure)
+        return closure
+
+
+def save_image(path: str, env: Env, builtins: Dict[str, object]) -> None:
+    """Save the bindings of the global env to path.
+
+    Host functions are saved by their name in builtins, the bindings of
+    env before any mal code ran."""
+    names = {id(value): name for name, value in builtins.items() if not isinstance(value, MalObject)}
+    bindings = env.bindings()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(ENGINE.encode() + b"\n")
+            pickler = _Pickler(f, env, names)
+            pickler.dump(len(bindings))
+            for name, value in bindings.items():
+                try:
+                    pickler.dump((name, value))
+                except (TypeError, pickle.PicklingError) as e:
+                    raise TypeError(f"can't save {name} in an image: {e}") from None
+        os.replace(tmp, path)
+        tmp = None
+    finally:
+        if tmp is not None:
+            os.unlink(tmp)
+
+
+def load_image(path: str, env: Env) -> None:
+    """Bind the globals saved in the image at path in env, the global env
+    of an interpreter that has its builtins but has not run any mal code."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an image of this interpreter")
+        engine = f.readline().decode(errors="replace").rstrip("\n")
+        if engine != ENGINE:
+            raise ValueError(f"{path} was saved by the {engine} engine, not by {ENGINE}")
+        unpickler = _Unpickler(f, env)
+        count = unpickler.load()
+        bindings = [unpickler.load() for _ in range(count)]
+    for name, value in bindings:
+        env[name] = value
+    # Closure bodies are analyzed on first call, once the macros they use
+    # are bound
+    analyze_restored(env, unpickler.closures)
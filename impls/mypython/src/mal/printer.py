@@ -1,6 +1,9 @@
 """Mal Printer"""
 
-from .types import MalObject, MalType
+from .types import (
+    MalAtom, MalFunction, MalHashMap, MalKeyword, MalLazySeq, MalList, MalObject, MalString,
+    MalVector,
+)
 
 
 def _escape(s: str) -> str:
@@ -10,20 +13,22 @@ def _escape(s: str) -> str:
 
 def pr_str(mal_object: MalObject, print_readably: bool = True) -> str:
     """Print string representation of MalObject."""
-    if mal_object.mal_type == MalType.STRING:
+    if type(mal_object) is MalString:
         if print_readably:
             return f'"{_escape(mal_object.value)}"'
         return mal_object.value
-    elif mal_object.mal_type == MalType.KEYWORD:
+    elif type(mal_object) is MalKeyword:
         return f":{mal_object.value}"
-    elif mal_object.mal_type == MalType.LIST:
+    elif type(mal_object) is MalList or type(mal_object) is MalLazySeq:
         return f"({' '.join([pr_str(x, print_readably=print_readably) for x in mal_object.value])})"
-    elif mal_object.mal_type == MalType.VECTOR:
+    elif type(mal_object) is MalVector:
         return f"[{' '.join([pr_str(x, print_readably=print_readably) for x in mal_object.value])}]"
-    elif mal_object.mal_type == MalType.HASHMAP:
-        return f"{{{' '.join([pr_str(x, print_readably=print_readably) for x in mal_object.value])}}}"
-    elif mal_object.mal_type == MalType.FUNCTION:
+    elif type(mal_object) is MalHashMap:
+        items = [f"{pr_str(k, print_readably=print_readably)} {pr_str(v, print_readably=print_readably)}"
+                 for k, v in mal_object.items()]
+        return f"{{{' '.join(items)}}}"
+    elif isinstance(mal_object, MalFunction):
         return f"<function {mal_object.value}>"
-    elif mal_object.mal_type == MalType.ATOM:
+    elif type(mal_object) is MalAtom:
         return f"(atom {pr_str(mal_object.value, print_readably=print_readably)})"
     return str(mal_object.value)
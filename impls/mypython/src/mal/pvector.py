@@ -0,0 +1,188 @@
+"""Mal Persistent Vector
+
+Immutable vector used by MalVector: a 32-way trie of leaf arrays plus a
+tail array holding the last (up to 32) elements. conj appends to the tail
+and only touches the trie once every 32 elements; nth and assoc walk
+O(log32 n) levels and copy only the path they change.
+
+Nodes are Python lists that are never mutated once shared.
+"""
+
+from typing import Iterator, Sequence
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+def _new_path(shift: int, node: list) -> list:
+    while shift > 0:
+        node = [node]
+        shift -= BITS
+    return node
+
+
+def _push_tail(cnt: int, shift: int, parent: list, tail: list) -> list:
+    """Copy the path to the slot of the new leaf tail and put it there."""
+    node = list(parent)
+    idx = ((cnt - 1) >> shift) & MASK
+    if shift == BITS:
+        child = tail
+    elif idx < len(parent):
+        child = _push_tail(cnt, shift - BITS, parent[idx], tail)
+    else:
+        child = _new_path(shift - BITS, tail)
+    if idx < len(node):
+        node[idx] = child
+    else:
+        node.append(child)
+    return node
+
+
+def _assoc(shift: int, node: list, i: int, value) -> list:
+    node = list(node)
+    if shift == 0:
+        node[i & MASK] = value
+    else:
+        idx = (i >> shift) & MASK
+        node[idx] = _assoc(shift - BITS, node[idx], i, value)
+    return node
+
+
+def _pop_tail(cnt: int, shift: int, node: list):
+    """Copy node without its last leaf; None if that leaves it empty."""
+    idx = ((cnt - 2) >> shift) & MASK
+    if shift > BITS:
+        child = _pop_tail(cnt, shift - BITS, node[idx])
+        if child is None and idx == 0:
+            return None
+        node = list(node)
+        if child is None:
+            del node[idx]
+        else:
+            node[idx] = child
+        return node
+    if idx == 0:
+        return None
+    return node[:idx]
+
+
+class PVector:
+    """Persistent vector"""
+
+    __slots__ = ("cnt", "shift", "root", "tail")
+
+    def __init__(self, cnt: int = 0, shift: int = BITS, root: list = None, tail: list = None):
+        self.cnt = cnt
+        self.shift = shift
+        self.root = [] if root is None else root
+        self.tail = [] if tail is None else tail
+
+    @staticmethod
+    def from_list(items: Sequence) -> "PVector":
+        """Build a vector holding items in one pass."""
+        cnt = len(items)
+        if cnt <= WIDTH:
+            return PVector(cnt, BITS, [], list(items))
+        tail_off = ((cnt - 1) >> BITS) << BITS
+        nodes = [items[i:i + WIDTH] for i in range(0, tail_off, WIDTH)]
+        shift = BITS
+        while len(nodes) > WIDTH:
+            nodes = [nodes[i:i + WIDTH] for i in range(0, len(nodes), WIDTH)]
+            shift += BITS
+        return PVector(cnt, shift, nodes, list(items[tail_off:]))
+
+    def _tail_off(self) -> int:
+        if self.cnt < WIDTH:
+            return 0
+        return ((self.cnt - 1) >> BITS) << BITS
+
+    def _leaf(self, i: int) -> list:
+        if i >= self._tail_off():
+            return self.tail
+        node = self.root
+        level = self.shift
+        while level > 0:
+            node = node[(i >> level) & MASK]
+            level -= BITS
+        return node
+
+    def __len__(self):
+        return self.cnt
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return list(self)[i]
+        if i < 0:
+            i += self.cnt
+        if i < 0 or i >= self.cnt:
+            raise IndexError("vector index out of range")
+        return self._leaf(i)[i & MASK]
+
+    def __iter__(self) -> Iterator:
+        tail_off = self._tail_off()
+        for i in range(0, tail_off, WIDTH):
+            yield from self._leaf(i)
+        yield from self.tail
+
+    def __reversed__(self) -> Iterator:
+        for i in range(self.cnt - 1, -1, -1):
+            yield self[i]
+
+    def __repr__(self):
+        return f"PVector({list(self)!r})"
+
+    def conj(self, value) -> "PVector":
+        """Get a vector with value appended."""
+        cnt = self.cnt
+        if cnt - self._tail_off() < WIDTH:
+            return PVector(cnt + 1, self.shift, self.root, self.tail + [value])
+        # The tail is full; push it into the trie
+        shift = self.shift
+        if (cnt >> BITS) > (1 << shift):
+            root = [self.root, _new_path(shift, self.tail)]
+            shift += BITS
+        else:
+            root = _push_tail(cnt, shift, self.root, self.tail)
+        return PVector(cnt + 1, shift, root, [value])
+
+    def assoc(self, i: int, value) -> "PVector":
+        """Get a vector with element i replaced by value; i may be count."""
+        if i == self.cnt:
+            return self.conj(value)
+        if i < 0 or i > self.cnt:
+            raise IndexError("vector index out of range")
+        if i >= self._tail_off():
+            tail = list(self.tail)
+            tail[i & MASK] = value
+            return PVector(self.cnt, self.shift, self.root, tail)
+        return PVector(self.cnt, self.shift, _assoc(self.shift, self.root, i, value), self.tail)
+
+    def pop(self) -> "PVector":
+        """Get a vector without its last element."""
+        cnt = self.cnt
+        if cnt == 0:
+            raise IndexError("can't pop empty vector")
+        if cnt == 1:
+            return EMPTY
+        if cnt - self._tail_off() > 1:
+            return PVector(cnt - 1, self.shift, self.root, self.tail[:-1])
+        tail = self._leaf(cnt - 2)
+        root = _pop_tail(cnt, self.shift, self.root)
+        shift = self.shift
+        if root is None:
+            root = []
+        if shift > BITS and len(root) == 1:
+            root = root[0]
+            shift -= BITS
+        return PVector(cnt - 1, shift, root, tail)
+
+    def extend(self, values) -> "PVector":
+        """Get a vector with values appended."""
+        vec = self
+        for value in values:
+            vec = vec.conj(value)
+        return vec
+
+
+EMPTY = PVector()
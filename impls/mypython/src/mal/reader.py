@@ -1,194 +1,362 @@
-"""Reader module."""
+"""Reader module.
 
+A single-pass scanner over the source string: read_form dispatches on the
+first character of each form and builds MalObjects directly, with no
+token list in between. Regular expressions are only used to find where
+a run of blanks, an atom or a string ends.
+"""
+
+import codecs
+import mmap
 import re
-from typing import List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Tuple, Union
+
+from .types import (
+    EMPTY_LIST, EMPTY_VECTOR, MalFloat, MalList, MalObject, MalString, MalSymbol, MalVector, nil,
+    true, false, hash_map, keyword, mal_int, symbol,
+)
+
 
-from .types import MalObject, MalType, nil, true, false
+# Whitespace, commas and comments
+SKIP_PAT = re.compile(r"(?:[\s,]+|;[^\n]*)*")
+ATOM_PAT = re.compile(r"""[^\s\[\]{}()'"`@,;]+""")
+STRING_PAT = re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+ESCAPE_PAT = re.compile(r"\\(.)", re.DOTALL)
+FLOAT_PAT = re.compile(r"-?(?:[0-9]+\.[0-9]+|\.[0-9]+)")
 
+_BLANKS = frozenset(" \t\r\n\f\v,;")
+_ESCAPES = {"n": "\n", "\\": "\\", '"': '"'}
+_CONSTANTS = {"true": true, "false": false, "nil": nil}
 
-TOKEN_PAT = re.compile(r"""[\s,]*(~@|[\[\]{}()'`~^@]|"(?:[\\].|[^\\"])*"?|;.*|[^\s\[\]{}()'"`@,;]+)""")
-NUMBER_PAT = re.compile(r"""^-?([0-9]+(\.[0-9]+)?|(\.[0-9]+))$""")
+# Number of chars read_forms asks a file for at a time
+READ_CHUNK = 1 << 16
 
 
 class Reader:
-    """Reader class."""
-
-    def __init__(self, tokens: List[str]):
-        """Initialize reader."""
-        self.tokens = tokens
-        self.position = 0
-
-    def __enter__(self):
-        """Enter context."""
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        """Exit context."""
-        pass
-
-    def __iter__(self):
-        """Iterate over tokens."""
-        return self
-
-    def __next__(self):
-        """Get next token."""
-        if self.position >= len(self.tokens):
-            raise StopIteration
-        token = self.tokens[self.position]
-        self.position += 1
-        return token
-
-    def peek(self) -> Optional[str]:
-        """Peek at next token."""
-        if self.position >= len(self.tokens):
-            return None
-        return self.tokens[self.position]
-
-
-def tokenize(s: str) -> List[str]:
-    """Tokenize string."""
-    return re.findall(TOKEN_PAT, s)
-
-
-def read_sequence(reader: Reader, start: str, end: str) -> MalObject:
-    """Read a sequence."""
-    assert next(reader) == start
-    ret = []
-    token = reader.peek()
-    while token != end:
-        if token is None:
-            raise SyntaxError("unexpected EOF while reading")
-        ret.append(read_form(reader))
-        token = reader.peek()
-    next(reader)
-    return ret
+    """Position of the scanner in src.
+
+    Lines are counted lazily: location() counts the newlines between the
+    last position it was asked about and the new one. src starts at
+    first_line and first_column. hit_eof is set when a form is cut short by
+    the end of src.
+    """
+
+    __slots__ = (
+        "src", "pos", "hit_eof", "_first_line", "_first_column", "_line", "_line_start",
+        "_counted",
+    )
+
+    def __init__(self, src: str, first_line: int = 1, first_column: int = 1):
+        self.src = src
+        self.pos = 0
+        self.hit_eof = False
+        self._first_line = first_line
+        self._first_column = first_column
+        self._line = first_line
+        self._line_start = 0
+        self._counted = 0
+
+    def location(self, pos: Optional[int] = None) -> Tuple[int, int]:
+        """Get the 1-based (line, column) of pos, or of the next char."""
+        if pos is None:
+            pos = self.pos
+        if pos < self._counted:
+            self._line, self._line_start, self._counted = self._first_line, 0, 0
+        src = self.src
+        self._line += src.count("\n", self._counted, pos)
+        nl = src.rfind("\n", self._counted, pos)
+        if nl >= 0:
+            self._line_start = nl + 1
+        self._counted = pos
+        if self._line == self._first_line:
+            return self._line, pos + self._first_column
+        return self._line, pos - self._line_start + 1
+
+    def error(self, message: str, pos: Optional[int] = None) -> SyntaxError:
+        """Make a SyntaxError for message at pos, or at the next char."""
+        line, column = self.location(pos)
+        return SyntaxError(f"{message} (line {line}, column {column})")
+
+    def eof_error(self, message: str, pos: Optional[int] = None) -> SyntaxError:
+        """Make a SyntaxError for a form cut short by the end of src."""
+        self.hit_eof = True
+        return self.error(message, pos)
+
+    def skip(self) -> Optional[str]:
+        """Skip blanks and comments; get the next char, or None at EOF."""
+        src = self.src
+        pos = self.pos
+        if pos < len(src) and src[pos] not in _BLANKS:
+            return src[pos]
+        pos = self.pos = SKIP_PAT.match(src, pos).end()
+        return src[pos] if pos < len(src) else None
+
+
+def read_sequence(reader: Reader, end: str) -> List[MalObject]:
+    """Read forms up to the closing end char."""
+    src = reader.src
+    size = len(src)
+    start = reader.pos
+    reader.pos += 1
+    items = []
+    while True:
+        # Reader.skip, inlined
+        pos = reader.pos
+        if pos < size and src[pos] in _BLANKS:
+            pos = reader.pos = SKIP_PAT.match(src, pos).end()
+        if pos >= size:
+            raise reader.eof_error(f"unexpected EOF while reading. expected '{end}'", start)
+        c = src[pos]
+        if c == end:
+            reader.pos = pos + 1
+            return items
+        items.append(_DISPATCH.get(c, read_atom)(reader))
 
 
 def read_list(reader: Reader) -> MalObject:
     """Read a list."""
-    return MalObject(MalType.LIST, read_sequence(reader, "(", ")"))
+    items = read_sequence(reader, ")")
+    return MalList(items) if items else EMPTY_LIST
 
 
 def read_vector(reader: Reader) -> MalObject:
     """Read a vector."""
-    return MalObject(MalType.VECTOR, read_sequence(reader, "[", "]"))
+    items = read_sequence(reader, "]")
+    return MalVector(items) if items else EMPTY_VECTOR
 
 
 def read_hashmap(reader: Reader) -> MalObject:
     """Read a hashmap."""
-    return MalObject(MalType.HASHMAP, read_sequence(reader, "{", "}"))
-
+    start = reader.pos
+    kvs = read_sequence(reader, "}")
+    if len(kvs) % 2 != 0:
+        raise reader.error("odd number of forms in a hashmap", start)
+    return hash_map(kvs)
+
+
+def _unescape_char(match: "re.Match") -> str:
+    c = _ESCAPES.get(match.group(1))
+    if c is None:
+        raise SyntaxError(f"unknown escape \\{match.group(1)}")
+    return c
+
+
+def read_string(reader: Reader) -> MalObject:
+    """Read a string, decoding its escapes in one pass."""
+    m = STRING_PAT.match(reader.src, reader.pos)
+    if m is None:
+        raise reader.eof_error("unexpected EOF while reading. expected '\"'")
+    s = m.group(1)
+    if "\\" in s:
+        try:
+            s = ESCAPE_PAT.sub(_unescape_char, s)
+        except SyntaxError as e:
+            # Point at the escape rather than at the start of the string
+            bad = next(x for x in ESCAPE_PAT.finditer(m.group(1)) if x.group(1) not in _ESCAPES)
+            raise reader.error(str(e), m.start(1) + bad.start())
+    reader.pos = m.end()
+    return MalString(s)
 
-def _unescape(s: str) -> str:
-    t = (s.replace(r"\\", "\u029e")
-         .replace(r'\"', '"')
-         .replace(r"\n", "\n")
-         # .replace(r"\t", "\t")
-         # .replace(r"\r", "\r")
-         # .replace(r"\b", "\b")
-         # .replace(r"\f", "\f")
-         )
-    if t.find("\\") >= 0:
-        raise SyntaxError(f"unbalanced \\ \"{s}\"")
-    return t.replace("\u029e", "\\")
 
+def _reader_macro(name: str) -> Callable[[Reader], MalObject]:
+    """Make the reader of a prefix char that wraps the next form in (name form)."""
+    sym = symbol(name)
 
-def read_quote(reader: Reader) -> MalObject:
-    """Read quote."""
-    assert next(reader) == "'"
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "quote"), read_form(reader)])
+    def read_wrapped(reader: Reader) -> MalObject:
+        reader.pos += 1
+        return MalList([sym, read_form(reader)])
+    return read_wrapped
 
 
-def read_quasiquote(reader: Reader) -> MalObject:
-    """Read quasiquote."""
-    assert next(reader) == "`"
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "quasiquote"), read_form(reader)])
+read_quote = _reader_macro("quote")
+read_quasiquote = _reader_macro("quasiquote")
+_read_unquote = _reader_macro("unquote")
+read_splice_unquote = _reader_macro("splice-unquote")
 
 
 def read_unquote(reader: Reader) -> MalObject:
-    """Read unquote."""
-    assert next(reader) == "~"
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "unquote"), read_form(reader)])
-
-
-def read_splice_unquote(reader: Reader) -> MalObject:
-    """Read splice-unquote."""
-    assert next(reader) == "~@"
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "splice-unquote"), read_form(reader)])
+    """Read unquote or splice-unquote."""
+    if reader.src.startswith("~@", reader.pos):
+        reader.pos += 1
+        return read_splice_unquote(reader)
+    return _read_unquote(reader)
 
 
 def read_deref(reader: Reader) -> MalObject:
     """Read deref."""
-    assert next(reader) == "@"
-    token = read_atom(reader)
-    if token.mal_type != MalType.SYMBOL:
-        raise SyntaxError(f"unexpected token: {token} after @")
-    return MalObject(MalType.LIST, [MalObject(MalType.SYMBOL, "deref"), token])
+    reader.pos += 1
+    start = reader.pos
+    form = read_atom(reader)
+    if type(form) is not MalSymbol:
+        raise reader.error(f"unexpected token: {reader.src[start:reader.pos]} after @", start)
+    return MalList([symbol("deref"), form])
+
+
+def read_with_meta(reader: Reader) -> MalObject:
+    """Read ^meta form as (with-meta form meta)."""
+    reader.pos += 1
+    meta = read_form(reader)
+    return MalList([symbol("with-meta"), read_form(reader), meta])
+
+
+def _unbalanced(reader: Reader) -> MalObject:
+    raise reader.error(f"unbalanced {reader.src[reader.pos]}")
 
 
 def read_atom(reader: Reader) -> MalObject:
-    """Read an atom."""
-    token = next(reader)
-    if token[0] == '"':
-        if len(token) == 1 or token[-1] != '"':
-            raise SyntaxError(f"unexpected EOF while reading. expected '\"', got '{token}'")
-        return MalObject(MalType.STRING, _unescape(token[1:-1]))
-    if token[0] == ":":
+    """Read a number, keyword, constant or symbol."""
+    if reader.pos >= len(reader.src):
+        raise reader.eof_error("unexpected EOF while reading")
+    m = ATOM_PAT.match(reader.src, reader.pos)
+    if m is None:
+        raise reader.error(f"unexpected character {reader.src[reader.pos]!r}")
+    token = m.group()
+    reader.pos = m.end()
+    c = token[0]
+    if c == ":":
         if len(token) == 1:
-            raise SyntaxError(f"unexpected EOF while reading. got '{token}'")
-        return MalObject(MalType.KEYWORD, token[1:])
-    if NUMBER_PAT.match(token):
-        try:
-            return MalObject(MalType.INTEGER, int(token))
-        except ValueError:
-            try:
-                return MalObject(MalType.FLOAT, float(token))
-            except ValueError:
-                raise SyntaxError(f"invalid number: {token}")
-    if token == "true":
-        return true
-    if token == "false":
-        return false
-    # In mal, nil and false are different.
-    if token == "nil":
-        return nil
-    return MalObject(MalType.SYMBOL, token)
-
-
-def read_form(reader: Reader):
-    """Read from reader."""
-    while True:
-        token = reader.peek()
-        if token == "(":
-            return read_list(reader)
-        if token == "[":
-            return read_vector(reader)
-        if token == "{":
-            return read_hashmap(reader)
-        elif token == ")":
-            raise SyntaxError("unbalanced )")
-        elif token == "]":
-            raise SyntaxError("unbalanced ]")
-        elif token == "}":
-            raise SyntaxError("unbalanced }")
-        elif token == "'":
-            return read_quote(reader)
-        elif token == "`":
-            return read_quasiquote(reader)
-        elif token == "~":
-            return read_unquote(reader)
-        elif token == "~@":
-            return read_splice_unquote(reader)
-        elif token == "@":
-            return read_deref(reader)
-        elif token[0] == ";":
-            next(reader)
-            continue
-        else:
-            return read_atom(reader)
+            raise reader.eof_error("unexpected EOF while reading keyword")
+        return keyword(token[1:])
+    if c in "0123456789" or (c in "-." and len(token) > 1 and token[1] in "0123456789."):
+        digits = token[1:] if c == "-" else token
+        if digits.isdigit() and digits.isascii():
+            return mal_int(int(token))
+        if FLOAT_PAT.fullmatch(token):
+            return MalFloat(float(token))
+    constant = _CONSTANTS.get(token)
+    if constant is not None:
+        return constant
+    return symbol(token)
+
+
+_DISPATCH: Dict[str, Callable[[Reader], MalObject]] = {
+    "(": read_list,
+    "[": read_vector,
+    "{": read_hashmap,
+    ")": _unbalanced,
+    "]": _unbalanced,
+    "}": _unbalanced,
+    '"': read_string,
+    "'": read_quote,
+    "`": read_quasiquote,
+    "~": read_unquote,
+    "@": read_deref,
+    "^": read_with_meta,
+}
+
+
+def read_form(reader: Reader) -> MalObject:
+    """Read the next form."""
+    c = reader.skip()
+    if c is None:
+        raise reader.eof_error("unexpected EOF while reading")
+    return _DISPATCH.get(c, read_atom)(reader)
 
 
 def read_str(s: str) -> MalObject:
-    """Read string."""
-    tokens = tokenize(s)
-    return read_form(Reader(tokens))
+    """Read the first form of s."""
+    return read_form(Reader(s))
+
+
+class BufferSource:
+    """Text file interface over a bytes-like buffer such as an mmap.
+
+    The buffer is decoded as UTF-8 one read at a time, so no decoded copy
+    of the whole buffer is ever made. The pages of an mmap are released
+    once they have been decoded, so they do not stay resident either.
+    Only the bytes from start to end are decoded."""
+
+    def __init__(self, buf, start: int = 0, end: Optional[int] = None):
+        self.view = memoryview(buf)[:end]
+        self.pos = start
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.mmap = buf if isinstance(buf, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED") else None
+        self.released = start - start % mmap.PAGESIZE
+
+    def read(self, size: int) -> str:
+        """Decode the next size bytes; "" only at the end of the buffer."""
+        while True:
+            chunk = self.view[self.pos:self.pos + size]
+            self.pos += len(chunk)
+            text = self.decoder.decode(chunk, final=not chunk)
+            chunk.release()
+            if self.mmap is not None:
+                end = self.pos - self.pos % mmap.PAGESIZE
+                if end > self.released:
+                    self.mmap.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+                    self.released = end
+            # A chunk can end inside a multi-byte char and decode to nothing
+            if text or self.pos >= len(self.view):
+                return text
+
+    def close(self) -> None:
+        self.view.release()
+
+
+Source = Union[str, TextIO, bytes, bytearray, memoryview, mmap.mmap]
+
+
+def read_forms_at(source: Source) -> Iterator[Tuple[int, MalObject]]:
+    """Yield (line, form) for each top-level form of a string, text file or
+    bytes-like buffer (such as an mmap) holding UTF-8.
+
+    A file or buffer is read READ_CHUNK chars at a time, and each form is
+    yielded as soon as it is complete, so only the form being read is held
+    in memory as text.
+    """
+    if isinstance(source, str):
+        reader = Reader(source)
+        while reader.skip() is not None:
+            start = reader.pos
+            form = read_form(reader)
+            yield reader.location(start)[0], form
+        return
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        source = BufferSource(source)
+        try:
+            yield from read_forms_at(source)
+        finally:
+            source.close()
+        return
+    buf = ""
+    line = column = 1
+    size = READ_CHUNK
+    done = False
+    while not done:
+        chunk = source.read(size)
+        done = not chunk
+        buf += chunk
+        reader = Reader(buf, line, column)
+        progress = False
+        while True:
+            blank = reader.pos
+            if reader.skip() is None:
+                # A comment that ends the buffer may go on in the next chunk
+                if not done:
+                    reader.pos = max(blank, buf.rfind("\n", blank) + 1)
+                break
+            start = reader.pos
+            try:
+                form = read_form(reader)
+            except SyntaxError:
+                if done or not reader.hit_eof:
+                    raise
+                reader.pos = start
+                break
+            # An atom that ends the buffer may go on in the next chunk
+            if reader.pos >= len(buf) and not done:
+                reader.pos = start
+                break
+            progress = True
+            yield reader.location(start)[0], form
+        line, column = reader.location()
+        buf = buf[reader.pos:]
+        # Read a form longer than a chunk in fewer, larger reads
+        size = READ_CHUNK if progress else size * 2
+
+
+def read_forms(source: Source) -> Iterator[MalObject]:
+    """Yield the top-level forms of a string, text file or buffer one at a
+    time."""
+    for _, form in read_forms_at(source):
+        yield form
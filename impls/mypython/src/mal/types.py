@@ -1,6 +1,13 @@
 """Mal Types"""
 
+import os
+import zlib
 from enum import Enum
+from itertools import islice, zip_longest
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from .hamt import EMPTY as EMPTY_HAMT, Hamt
+from .pvector import EMPTY as EMPTY_PVECTOR, PVector
 
 
 class MalType(Enum):
@@ -12,6 +19,7 @@ class MalType(Enum):
     HASHMAP = "HASHMAP"
     INTEGER = "INTEGER"
     KEYWORD = "KEYWORD"
+    LAZY_SEQ = "LAZY_SEQ"
     LIST = "LIST"
     STRING = "STRING"
     SYMBOL = "SYMBOL"
@@ -19,50 +27,736 @@ class MalType(Enum):
 
 
 class MalObject:
-    """Mal Object"""
+    """Mal Object
+
+    Each mal type has its own subclass; mal_type is kept as a class
+    attribute for code that dispatches on the MalType tag.
+    """
+
+    __slots__ = ("value",)
 
-    def __init__(self, mal_type, value, is_macro_call=False):
-        self._mal_type = mal_type
-        self._value = value
-        self._is_macro_call = is_macro_call
+    mal_type: MalType = None
+    is_macro_call = False
+    # Inline cache of a SYMBOL node, see Env.find
+    lookup_cache = None
+    # Macro expansion cache of a LIST node, see mal_macroexpand
+    macro_cache = None
+    # Compiled quasiquote template of a LIST node, see compile_quasiquote
+    quasiquote_cache = None
+
+    def __init__(self, value):
+        self.value = value
 
     def __repr__(self):
-        return f"MalObject({self._mal_type}, {self._value}, {self._is_macro_call})"
+        return f"{type(self).__name__}({self.value!r})"
 
-    @property
-    def mal_type(self):
-        """Mal Type"""
-        return self._mal_type
+    def __eq__(self, other):
+        return equal(self, other)
 
-    @property
-    def value(self):
-        """Value"""
-        return self._value
+    def __hash__(self):
+        return hash(self.value)
+
+
+class MalList(MalObject):
+    """Mal List
+
+    A list made by rest or cons shares structure with its source: _lazy
+    is (base, start) for a view of base from start, or (first, rest,
+    count) for a cons cell. Its value list is only built when something
+    asks for it.
+    """
+
+    __slots__ = ("macro_cache", "quasiquote_cache", "_lazy", "_hash")
+
+    mal_type = MalType.LIST
+
+    def __init__(self, value: List[MalObject]):
+        self.value = value
+        self.macro_cache = None
+        self.quasiquote_cache = None
+        self._lazy = None
+        self._hash = None
+
+    def __hash__(self):
+        return collection_hash(self)
+
+    def __getattr__(self, name):
+        # Only reached when the value slot of a lazy list is still unset
+        if name != "value":
+            raise AttributeError(name)
+        items = []
+        lst = self
+        while True:
+            lazy = lst._lazy
+            if lazy is None:
+                items.extend(lst.value)
+                break
+            if len(lazy) == 2:
+                items.extend(lazy[0][lazy[1]:])
+                break
+            items.append(lazy[0])
+            lst = lazy[1]
+        self.value = items
+        return items
+
+    def count(self) -> int:
+        lazy = self._lazy
+        if lazy is None:
+            return len(self.value)
+        if len(lazy) == 2:
+            return len(lazy[0]) - lazy[1]
+        return lazy[2]
+
+    def first(self) -> Optional[MalObject]:
+        """Get the first element, or None if the list is empty."""
+        lazy = self._lazy
+        if lazy is None:
+            return self.value[0] if self.value else None
+        if len(lazy) == 2:
+            return lazy[0][lazy[1]] if lazy[1] < len(lazy[0]) else None
+        return lazy[0]
+
+    def rest(self) -> "MalList":
+        lazy = self._lazy
+        if lazy is None:
+            return _list_view(self.value, 1) if self.value else self
+        if len(lazy) == 2:
+            return _list_view(lazy[0], lazy[1] + 1) if lazy[1] < len(lazy[0]) else self
+        return lazy[1]
+
+    def nth(self, i: int) -> MalObject:
+        lst = self
+        while True:
+            lazy = lst._lazy
+            if lazy is None:
+                return lst.value[i]
+            if len(lazy) == 2:
+                return lazy[0][lazy[1] + i]
+            if i == 0:
+                return lazy[0]
+            lst = lazy[1]
+            i -= 1
+
+    def cons(self, first: MalObject) -> "MalList":
+        """Get a list of first followed by this list."""
+        lst = MalList.__new__(MalList)
+        lst.macro_cache = None
+        lst.quasiquote_cache = None
+        lst._lazy = (first, self, self.count() + 1)
+        lst._hash = None
+        return lst
+
+
+# Shared empty list; lists are never mutated once built
+EMPTY_LIST = MalList([])
+
+
+def _list_view(base: List[MalObject], start: int) -> MalList:
+    lst = MalList.__new__(MalList)
+    lst.macro_cache = None
+    lst.quasiquote_cache = None
+    lst._lazy = (base, start)
+    lst._hash = None
+    return lst
+
+
+# Number of elements realized at a time from a generator
+CHUNK_SIZE = 32
+
+
+class MalLazySeq(MalObject):
+    """Mal Lazy Sequence
+
+    Until it is needed, _realize holds a function returning (items, rest):
+    a list of elements and the seq (lazy, list or nil) that follows them.
+    Once realized, the seq is _items from _offset followed by _rest.
+    """
+
+    __slots__ = ("_realize", "_items", "_offset", "_rest", "_hash")
+
+    mal_type = MalType.LAZY_SEQ
+
+    def __init__(self, realize: Callable[[], Tuple[List[MalObject], MalObject]]):
+        self._realize = realize
+        self._items = None
+        self._offset = 0
+        self._rest = None
+        self._hash = None
+
+    def __hash__(self):
+        return collection_hash(self)
+
+    def __getattr__(self, name):
+        # Sequence code that reads value gets the realized elements
+        if name != "value":
+            raise AttributeError(name)
+        return list(iter_seq(self))
+
+    def __repr__(self):
+        return "MalLazySeq(...)"
+
+    def seq(self) -> MalObject:
+        """Realize up to the first element.
+
+        Returns the lazy seq holding it, or the list or nil the seq ends
+        with if there is none."""
+        s = self
+        while type(s) is MalLazySeq:
+            if s._realize is not None:
+                s._items, s._rest = s._realize()
+                s._realize = None
+            if s._offset < len(s._items):
+                return s
+            s = s._rest
+        return s
+
+    def first(self) -> MalObject:
+        """Get the first element of a seq returned by seq()."""
+        return self._items[self._offset]
+
+    def next(self) -> MalObject:
+        """Get the elements after the first of a seq returned by seq()."""
+        if self._offset + 1 < len(self._items):
+            return lazy_chunk(self._items, self._offset + 1, self._rest)
+        return self._rest
+
+
+def lazy_chunk(items: List[MalObject], offset: int, rest: MalObject) -> MalLazySeq:
+    """Make a realized lazy seq of items from offset followed by rest."""
+    s = MalLazySeq.__new__(MalLazySeq)
+    s._realize = None
+    s._items = items
+    s._offset = offset
+    s._rest = rest
+    s._hash = None
+    return s
+
+
+def lazy_from_iter(it: Iterator[MalObject]) -> MalLazySeq:
+    """Make a lazy seq drawing CHUNK_SIZE elements at a time from it."""
+    def realize():
+        items = list(islice(it, CHUNK_SIZE))
+        if len(items) < CHUNK_SIZE:
+            return items, nil
+        return items, lazy_from_iter(it)
+    return MalLazySeq(realize)
+
+
+def iter_seq(s: MalObject) -> Iterator[MalObject]:
+    """Iterate over a list, vector, lazy seq, hash-map ([key value]
+    vectors) or nil, realizing lazy seqs chunk by chunk without holding on
+    to the chunks already visited."""
+    while True:
+        if type(s) is MalLazySeq:
+            s = s.seq()
+            if type(s) is MalLazySeq:
+                items = s._items
+                for i in range(s._offset, len(items)):
+                    yield items[i]
+                s = s._rest
+                continue
+        if type(s) is MalList or type(s) is MalVector:
+            yield from s.value
+            return
+        if type(s) is MalHashMap:
+            for k, v in s.items():
+                yield MalVector([k, v])
+            return
+        if s is nil:
+            return
+        raise TypeError(f"{s} is not a sequence")
+
+
+class MalVector(MalObject):
+    """Mal Vector
+
+    value is a persistent PVector; a list passed in is copied into one.
+    """
+
+    __slots__ = ("_hash",)
+
+    mal_type = MalType.VECTOR
+
+    def __init__(self, value: Union[PVector, List[MalObject]] = EMPTY_PVECTOR):
+        self.value = value if type(value) is PVector else PVector.from_list(value)
+        self._hash = None
+
+    def __hash__(self):
+        return collection_hash(self)
+
+
+EMPTY_VECTOR = MalVector()
+
+
+class MalHashMap(MalObject):
+    """Mal Hash Map
+
+    value is a persistent Hamt mapping the hash_key of each key to its
+    (key, value) pair, laid out by the key_hash of the key.
+    """
+
+    __slots__ = ("_hash",)
+
+    mal_type = MalType.HASHMAP
+
+    def __init__(self, value: Hamt = EMPTY_HAMT):
+        self.value = value
+        self._hash = None
+
+    def __hash__(self):
+        return collection_hash(self)
+
+    def __len__(self):
+        return len(self.value)
+
+    def get(self, key: MalObject, default: MalObject = None) -> MalObject:
+        entry = self.value.get(key_hash(key), hash_key(key))
+        return default if entry is None else entry[3]
+
+    def contains(self, key: MalObject) -> bool:
+        return self.value.get(key_hash(key), hash_key(key)) is not None
+
+    def items(self) -> Iterator[Tuple[MalObject, MalObject]]:
+        for _, _, key, value in self.value.entries():
+            yield key, value
+
+    def keys(self) -> List[MalObject]:
+        return [e[2] for e in self.value.entries()]
+
+    def vals(self) -> List[MalObject]:
+        return [e[3] for e in self.value.entries()]
+
+    def assoc(self, kvs: List[MalObject]) -> "MalHashMap":
+        """Get a map with the alternating keys and values of kvs added."""
+        _check_pairs(kvs)
+        hamt = self.value
+        for i in range(0, len(kvs), 2):
+            key = kvs[i]
+            hamt = hamt.assoc(key_hash(key), hash_key(key), key, kvs[i + 1])
+        return MalHashMap(hamt)
+
+    def dissoc(self, keys: List[MalObject]) -> "MalHashMap":
+        """Get a map without keys."""
+        hamt = self.value
+        for key in keys:
+            hamt = hamt.dissoc(key_hash(key), hash_key(key))
+        return EMPTY_MAP if hamt is EMPTY_HAMT else MalHashMap(hamt)
+
+
+EMPTY_MAP = MalHashMap()
+
+
+def hash_key(obj: MalObject):
+    """Get a Python dict key for obj; mal values that are equal get equal keys."""
+    t = type(obj)
+    if t is MalString or t is MalInt:
+        return obj.value
+    if t is MalFloat:
+        # Keep 1.0 apart from 1
+        return (MalFloat, obj.value)
+    # Collections hash and compare by value; symbols and keywords are
+    # interned and the other types compare by identity
+    return obj
+
+
+# Seeds that keep the key_hash of a string apart from those of a keyword
+# and a symbol with the same name
+_STRING_SEED = 1
+_KEYWORD_SEED = 2
+_SYMBOL_SEED = 3
+
+
+def _name_hash(seed: int, name: str) -> int:
+    # CRC-32 and Adler-32 are computed in C, at a fraction of the cost of a
+    # cryptographic hash; together they fill the 64 bits a Hamt uses
+    data = name.encode("utf-8", "surrogatepass")
+    return zlib.crc32(data, seed) | zlib.adler32(data, seed) << 32
+
+
+def key_hash(obj: MalObject) -> int:
+    """Get the hash that lays out hash-maps; mal values that are equal get
+    equal hashes.
+
+    Unlike hash() of a str, it is the same in every process, so maps built
+    from numbers, strings, keywords, symbols and collections of them are
+    walked, and printed, in the same order every time. It is cached on
+    strings, and computed when keywords and symbols are interned."""
+    t = type(obj)
+    if t is MalString:
+        h = obj._key_hash
+        if h is None:
+            h = obj._key_hash = _name_hash(_STRING_SEED, obj.value)
+        return h
+    if t is MalKeyword or t is MalSymbol:
+        return obj._key_hash
+    if t is MalInt or t is MalFloat:
+        return hash(obj.value)
+    if t in _COLLECTIONS:
+        return collection_hash(obj)
+    return hash(obj)
+
+
+_SEQUENTIAL = (MalList, MalVector, MalLazySeq)
+_COLLECTIONS = (MalList, MalVector, MalLazySeq, MalHashMap)
 
-    @property
-    def is_macro_call(self):
-        """Is macro call"""
-        return self._is_macro_call
+
+def _children(obj: MalObject) -> Iterator[MalObject]:
+    if type(obj) is MalHashMap:
+        for _, _, key, value in obj.value.entries():
+            yield key
+            yield value
+    else:
+        yield from iter_seq(obj)
+
+
+def collection_hash(obj: MalObject) -> int:
+    """Get the hash of a list, vector, lazy seq or hash-map.
+
+    Equal lists, vectors and lazy seqs hash alike, and like key_hash the
+    hash is the same in every process. Hashes are cached on the
+    collections, and nested collections are hashed innermost first from an
+    explicit stack rather than by recursion."""
+    if obj._hash is not None:
+        return obj._hash
+    pending = [obj]
+    order = []
+    while pending:
+        x = pending.pop()
+        order.append(x)
+        for child in _children(x):
+            if type(child) in _COLLECTIONS and child._hash is None:
+                pending.append(child)
+    for x in reversed(order):
+        if x._hash is not None:
+            continue
+        if type(x) is MalHashMap:
+            x._hash = hash(frozenset([(h, key_hash(v)) for h, _, _, v in x.value.entries()]))
+        else:
+            x._hash = hash(tuple([key_hash(c) for c in iter_seq(x)]))
+    return obj._hash
+
+
+# The shared empty collections are hashed up front, so nothing writes to
+# them once built
+EMPTY_LIST._hash = EMPTY_VECTOR._hash = hash(())
+
+
+def _count(s: MalObject) -> int:
+    return s.count() if type(s) is MalList else len(s.value)
+
+
+_END = object()
+
+
+def equal(a: MalObject, b: MalObject) -> bool:
+    """Compare a and b by value, using an explicit stack for nested
+    collections. Cached hashes that differ reject unequal collections
+    without looking at their elements."""
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        ta = type(a)
+        tb = type(b)
+        if ta in _SEQUENTIAL:
+            if tb not in _SEQUENTIAL:
+                return False
+            if a._hash is not None and b._hash is not None and a._hash != b._hash:
+                return False
+            if ta is MalLazySeq or tb is MalLazySeq:
+                for x, y in zip_longest(iter_seq(a), iter_seq(b), fillvalue=_END):
+                    if x is _END or y is _END:
+                        return False
+                    stack.append((x, y))
+            else:
+                if _count(a) != _count(b):
+                    return False
+                stack.extend(zip(a.value, b.value))
+        elif ta is MalHashMap:
+            if tb is not MalHashMap or len(a.value) != len(b.value):
+                return False
+            if a._hash is not None and b._hash is not None and a._hash != b._hash:
+                return False
+            other = b.value
+            for h, hkey, _, x in a.value.entries():
+                entry = other.get(h, hkey)
+                if entry is None:
+                    return False
+                stack.append((x, entry[3]))
+        elif ta is not tb or not (ta is MalInt or ta is MalString or ta is MalFloat):
+            # Other types are equal only if they are identical
+            return False
+        elif a.value != b.value:
+            return False
+    return True
+
+
+def _check_pairs(kvs: List[MalObject]) -> None:
+    if len(kvs) % 2 != 0:
+        raise TypeError("odd number of arguments for a hash-map")
+
+
+def hash_map(kvs: List[MalObject]) -> MalHashMap:
+    """Make a hash-map from alternating keys and values in one pass."""
+    _check_pairs(kvs)
+    if not kvs:
+        return EMPTY_MAP
+    data = {}
+    for i in range(0, len(kvs), 2):
+        key = kvs[i]
+        data[hash_key(key)] = (key_hash(key), key, kvs[i + 1])
+    return MalHashMap(Hamt.build(data))
+
+
+class MalInt(MalObject):
+    """Mal Integer"""
+
+    __slots__ = ()
+
+    mal_type = MalType.INTEGER
+
+
+# Boxed integers in [SMALL_INT_MIN, SMALL_INT_MAX] are preallocated and
+# shared, so loop counters and small results do not allocate.
+SMALL_INT_MIN = int(os.environ.get("MAL_SMALL_INT_MIN", "-128"))
+SMALL_INT_MAX = int(os.environ.get("MAL_SMALL_INT_MAX", "4096"))
+_SMALL_INTS = [MalInt(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+# Counts of the integers boxed by mal_int that were not in the cache.
+# Cache hits are not counted, to keep them cheap; compare a run with the
+# cache shrunk (MAL_SMALL_INT_MAX=-129) to see the reduction.
+_ALLOC_STATS = {"int-allocs": 0}
+
+
+def mal_int(n: int) -> MalInt:
+    """Get the boxed integer n, sharing the preallocated small ones."""
+    if SMALL_INT_MIN <= n <= SMALL_INT_MAX:
+        return _SMALL_INTS[n - SMALL_INT_MIN]
+    _ALLOC_STATS["int-allocs"] += 1
+    return MalInt(n)
+
+
+def alloc_stats() -> Dict[str, int]:
+    """Get the number of integers allocated outside the cache."""
+    return dict(_ALLOC_STATS)
+
+
+def reset_alloc_stats() -> None:
+    """Reset the allocation counters."""
+    for name in _ALLOC_STATS:
+        _ALLOC_STATS[name] = 0
+
+
+class MalFloat(MalObject):
+    """Mal Float"""
+
+    __slots__ = ()
+
+    mal_type = MalType.FLOAT
+
+
+class MalString(MalObject):
+    """Mal String"""
+
+    __slots__ = ("_key_hash",)
+
+    mal_type = MalType.STRING
+
+    def __init__(self, value: str):
+        self.value = value
+        self._key_hash = None
+
+
+class MalKeyword(MalObject):
+    """Mal Keyword"""
+
+    __slots__ = ("_key_hash",)
+
+    mal_type = MalType.KEYWORD
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, value: str):
+        self.value = value
+        self._key_hash = _name_hash(_KEYWORD_SEED, value)
+
+
+class MalSymbol(MalObject):
+    """Mal Symbol"""
+
+    __slots__ = ("lookup_cache", "_key_hash")
+
+    mal_type = MalType.SYMBOL
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, value: str):
+        self.value = value
+        self.lookup_cache = None
+        self._key_hash = _name_hash(_SYMBOL_SEED, value)
+
+
+# Intern tables; all occurrences of a symbol or keyword name share one
+# object, so they can be compared by identity.
+_SYMBOLS: Dict[str, MalSymbol] = {}
+_KEYWORDS: Dict[str, MalKeyword] = {}
+
+
+def symbol(name: str) -> MalSymbol:
+    """Get the interned symbol called name."""
+    sym = _SYMBOLS.get(name)
+    if sym is None:
+        sym = _SYMBOLS[name] = MalSymbol(name)
+    return sym
+
+
+def keyword(name: str) -> MalKeyword:
+    """Get the interned keyword called name."""
+    kw = _KEYWORDS.get(name)
+    if kw is None:
+        kw = _KEYWORDS[name] = MalKeyword(name)
+    return kw
 
 
 # Special objects
-true = MalObject(MalType.SYMBOL, "true")
-false = MalObject(MalType.SYMBOL, "false")
-nil = MalObject(MalType.SYMBOL, "nil")
+true = symbol("true")
+false = symbol("false")
+nil = symbol("nil")
 
 
 class MalAtom(MalObject):
     """"Mal Atom"""
 
+    __slots__ = ()
+
+    mal_type = MalType.ATOM
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
     def __init__(self, value: MalObject = None):
-        super().__init__(MalType.ATOM, value)
+        self.value = value
 
     def deref(self) -> MalObject:
-        return self._value
+        return self.value
 
     def reset(self, new_value: MalObject) -> None:
-        self._value = new_value
+        self.value = new_value
 
     # def swap(self, fn: MalObject, *args: List[MalObject]) -> MalObject:
-    #     self._value = mal_apply(fn, self._value, *args)
-    #     return self._value
+    #     self.value = mal_apply(fn, self.value, *args)
+    #     return self.value
+
+
+class ParamPlan:
+    """Plan for binding arguments to a parameter list.
+
+    It is computed once, when fn* is evaluated, and holds the parameter
+    names, the fixed arity and the name of the rest parameter if any.
+    """
+
+    __slots__ = ("names", "arity", "rest", "bind")
+
+    def __init__(self, params: MalObject):
+        names = []
+        rest = None
+        is_rest = False
+        for x in params.value:
+            if type(x) is not MalSymbol:
+                raise SyntaxError(f"{x} is not a symbol")
+            if is_rest:
+                rest = x.value
+                break
+            if x.value == "&":
+                is_rest = True
+                continue
+            names.append(x.value)
+        self.names = names
+        self.arity = len(names)
+        self.rest = rest
+        if rest is not None:
+            self.bind = self._bind_rest
+        elif self.arity == 0:
+            self.bind = self._bind0
+        elif self.arity == 1:
+            self.bind = self._bind1
+        elif self.arity == 2:
+            self.bind = self._bind2
+        elif self.arity == 3:
+            self.bind = self._bind3
+        else:
+            self.bind = self._bind_n
+
+    def arity_error(self, count: int) -> TypeError:
+        """Get the error for a call with count arguments."""
+        if self.rest is not None:
+            return TypeError(f"wrong number of arguments: expected at least {self.arity}, got {count}")
+        return TypeError(f"wrong number of arguments: expected {self.arity}, got {count}")
+
+    def _bind0(self, args) -> Dict[str, MalObject]:
+        if len(args) != 0:
+            raise self.arity_error(len(args))
+        return {}
+
+    def _bind1(self, args) -> Dict[str, MalObject]:
+        if len(args) != 1:
+            raise self.arity_error(len(args))
+        return {self.names[0]: args[0]}
+
+    def _bind2(self, args) -> Dict[str, MalObject]:
+        if len(args) != 2:
+            raise self.arity_error(len(args))
+        names = self.names
+        return {names[0]: args[0], names[1]: args[1]}
+
+    def _bind3(self, args) -> Dict[str, MalObject]:
+        if len(args) != 3:
+            raise self.arity_error(len(args))
+        names = self.names
+        return {names[0]: args[0], names[1]: args[1], names[2]: args[2]}
+
+    def _bind_n(self, args) -> Dict[str, MalObject]:
+        if len(args) != self.arity:
+            raise self.arity_error(len(args))
+        return dict(zip(self.names, args))
+
+    def _bind_rest(self, args) -> Dict[str, MalObject]:
+        if len(args) < self.arity:
+            raise self.arity_error(len(args))
+        data = dict(zip(self.names, args))
+        data[self.rest] = MalList(list(args[self.arity:]))
+        return data
+
+
+class MalFunction(MalObject):
+    """Mal user-defined function"""
+
+    __slots__ = ("env", "params", "body", "plan", "is_macro_call")
+
+    mal_type = MalType.FUNCTION
+
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, env, params: MalObject, body: MalObject, plan: ParamPlan = None,
+                 is_macro_call=False):
+        self.env = env
+        self.params = params
+        self.body = body
+        self.plan = ParamPlan(params) if plan is None else plan
+        self.is_macro_call = is_macro_call
+
+    def __repr__(self):
+        return f"MalFunction({self.params}, {self.body}, {self.is_macro_call})"
+
+    @property
+    def value(self):
+        """Value"""
+        return self
+
+    def as_macro(self) -> "MalFunction":
+        """Get a macro with the same parameters and body."""
+        return MalFunction(self.env, self.params, self.body, self.plan, is_macro_call=True)
@@ -0,0 +1,418 @@
+"""Mal VM
+
+Compiles mal forms into a compact instruction stream and runs it in a flat
+stack-based dispatch loop, so calls between mal functions do not recurse
+in Python.
+
+Pending calls are kept on a heap-allocated frame stack, so deep non-tail
+recursion is bounded by MAX_DEPTH (MAL_MAX_DEPTH in the environment)
+rather than by the Python recursion limit.
+"""
+
+import os
+from array import array
+from typing import FrozenSet, List, Optional
+
+from .env import Env
+from .eval import (
+    SPECIAL_FORMS, call_builtin, call_depth_error, mal_apply, mal_macroexpand, mal_quasiquote, unsupported_form,
+)
+from .types import (
+    MalFunction, MalHashMap, MalList, MalObject, MalSymbol, MalVector, ParamPlan, false, nil,
+    hash_map, symbol,
+)
+
+
+# Maximum number of pending calls
+MAX_DEPTH = int(os.environ.get("MAL_MAX_DEPTH", "100000"))
+
+# Pending calls of all the runs on the Python stack. A run entered from a
+# builtin, such as apply or map calling back into mal, stacks itself and
+# its calls on those of the run below it, so MAX_DEPTH bounds them together.
+_FRAMES = []
+
+# Opcodes; every instruction is an opcode followed by one operand.
+LOAD = 0            # push env[consts[arg]]
+CONST = 1           # push consts[arg]
+CALL = 2            # call with arg arguments
+TAIL_CALL = 3       # call with arg arguments, replacing the current frame
+RETURN = 4          # return the top of the stack
+JUMP_IF_FALSE = 5   # pop, jump to arg if false or nil
+JUMP = 6            # jump to arg
+POP = 7             # discard the top of the stack
+DEF = 8             # env[consts[arg]] = top of the stack
+DEFMACRO = 9        # env[consts[arg]] = macro from the top of the stack, push nil
+BIND = 10           # pop into env[consts[arg]]
+ENTER_ENV = 11      # env = Env(outer=env)
+LEAVE_ENV = 12      # env = env.outer
+MAKE_FN = 13        # push a function from template consts[arg]
+BUILD_VECTOR = 14   # pop arg values into a vector
+BUILD_HASHMAP = 15  # pop arg values into a hashmap
+MACROEXPAND = 16    # push macroexpansion of consts[arg] in env
+
+OPNAMES = [
+    "LOAD", "CONST", "CALL", "TAIL_CALL", "RETURN", "JUMP_IF_FALSE", "JUMP",
+    "POP", "DEF", "DEFMACRO", "BIND", "ENTER_ENV", "LEAVE_ENV", "MAKE_FN",
+    "BUILD_VECTOR", "BUILD_HASHMAP", "MACROEXPAND",
+]
+
+
+class Code:
+    """Compiled instruction stream with its constant pool."""
+
+    def __init__(self):
+        self.ops = array("l")
+        self.consts: List[object] = []
+        self._indices = {}
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        """Append an instruction and return its position."""
+        self.ops.append(op)
+        self.ops.append(arg)
+        return len(self.ops) - 2
+
+    def const(self, value) -> int:
+        """Get the index of value in the constant pool."""
+        key = value if type(value) is str else id(value)
+        if key not in self._indices:
+            self._indices[key] = len(self.consts)
+            self.consts.append(value)
+        return self._indices[key]
+
+    def patch(self, pos: int) -> None:
+        """Point the jump at pos to the next instruction."""
+        self.ops[pos + 1] = len(self.ops)
+
+    def dis(self) -> str:
+        """Disassemble the instruction stream."""
+        lines = []
+        for pc in range(0, len(self.ops), 2):
+            op, arg = self.ops[pc], self.ops[pc + 1]
+            if op in (LOAD, CONST, DEF, DEFMACRO, BIND, MAKE_FN, MACROEXPAND):
+                lines.append(f"{pc:4d} {OPNAMES[op]:<14} {arg} ({self.consts[arg]!r})")
+            else:
+                lines.append(f"{pc:4d} {OPNAMES[op]:<14} {arg}")
+        return "\n".join(lines)
+
+
+class FnTemplate:
+    """Parameters and body of a fn* form; the body is compiled on first call."""
+
+    def __init__(self, params: MalObject, ast: MalObject, plan: Optional[ParamPlan],
+                 scope: FrozenSet[str]):
+        self.params = params
+        self.ast = ast
+        self.plan = ParamPlan(params) if plan is None else plan
+        self.scope = scope
+        self.code: Optional[Code] = None
+
+    def compile(self, env: Env) -> Code:
+        if self.code is None:
+            self.code = Compiler(env).compile_body(self.ast, self.scope)
+        return self.code
+
+
+class VMClosure(MalFunction):
+    """User function run by the VM."""
+
+    __slots__ = ("template",)
+
+    def __init__(self, template: FnTemplate, env: Env, is_macro_call=False):
+        super().__init__(env, template.params, template.ast, template.plan, is_macro_call=is_macro_call)
+        self.template = template
+
+    def __call__(self, *args):
+        return run(self.template.compile(self.env), Env(self.env, self.plan.bind(args)))
+
+    def as_macro(self) -> "VMClosure":
+        """Get a macro sharing this function's template."""
+        return VMClosure(self.template, self.env, is_macro_call=True)
+
+
+class Compiler:
+    """Compiles forms; macros are looked up in env at compile time."""
+
+    def __init__(self, env: Env):
+        self.env = env
+        self.code = Code()
+
+    def compile_body(self, exp: MalObject, scope: FrozenSet[str]) -> Code:
+        self.compile(exp, scope, True)
+        return self.code
+
+    def is_macro(self, exp: MalObject, scope: FrozenSet[str]) -> bool:
+        head = exp.value[0]
+        if type(head) is not MalSymbol or head.value in scope or head.value not in self.env:
+            return False
+        func = self.env[head.value]
+        return isinstance(func, MalObject) and isinstance(func, MalFunction) and func.is_macro_call
+
+    def compile(self, exp: MalObject, scope: FrozenSet[str], tail: bool) -> None:
+        """Emit code leaving the value of exp on the stack, or returning it in tail position."""
+        code = self.code
+        while type(exp) is MalList and len(exp.value) > 0 and self.is_macro(exp, scope):
+            exp = mal_apply(self.env[exp.value[0].value], *exp.value[1:])
+        if type(exp) is MalSymbol:
+            code.emit(LOAD, code.const(exp.value))
+        elif type(exp) is MalVector and len(exp.value) > 0:
+            for x in exp.value:
+                self.compile(x, scope, False)
+            code.emit(BUILD_VECTOR, len(exp.value))
+        elif type(exp) is MalHashMap and len(exp.value) > 0:
+            for k, v in exp.items():
+                code.emit(CONST, code.const(k))
+                self.compile(v, scope, False)
+            code.emit(BUILD_HASHMAP, 2 * len(exp.value))
+        elif type(exp) is not MalList or len(exp.value) == 0:
+            code.emit(CONST, code.const(exp))
+        else:
+            head = exp.value[0]
+            if type(head) is MalSymbol and head.value not in scope:
+                form = _SPECIAL_FORMS.get(head)
+                if form is not None:
+                    form(self, exp, scope, tail)
+                    return
+                if head in SPECIAL_FORMS:
+                    raise unsupported_form(head, "vm")
+            self.compile(head, scope, False)
+            for x in exp.value[1:]:
+                self.compile(x, scope, False)
+            code.emit(TAIL_CALL if tail else CALL, len(exp.value) - 1)
+            return
+        if tail:
+            code.emit(RETURN)
+
+    def compile_def(self, exp, scope, tail):
+        if len(exp.value) != 3:
+            raise SyntaxError("wrong number of arguments")
+        if type(exp.value[1]) is not MalSymbol:
+            raise SyntaxError("first argument must be a symbol")
+        self.compile(exp.value[2], scope, False)
+        self.code.emit(DEF, self.code.const(exp.value[1].value))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_defmacro(self, exp, scope, tail):
+        if len(exp.value) != 3:
+            raise SyntaxError("wrong number of arguments")
+        if type(exp.value[1]) is not MalSymbol:
+            raise SyntaxError("first argument must be a symbol")
+        self.compile(exp.value[2], scope, False)
+        self.code.emit(DEFMACRO, self.code.const(exp.value[1].value))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_let(self, exp, scope, tail):
+        if len(exp.value) != 3:
+            raise SyntaxError("wrong number of arguments")
+        if type(exp.value[1]) is not MalList and type(exp.value[1]) is not MalVector:
+            raise SyntaxError("second argument must be a list or vector")
+        bindings = exp.value[1].value
+        if len(bindings) % 2 != 0:
+            raise SyntaxError("odd number of forms in binding vector")
+        self.code.emit(ENTER_ENV)
+        for i in range(0, len(bindings), 2):
+            if type(bindings[i]) is not MalSymbol:
+                raise SyntaxError("binding form must be a symbol")
+            scope = scope | {bindings[i].value}
+            self.compile(bindings[i + 1], scope, False)
+            self.code.emit(BIND, self.code.const(bindings[i].value))
+        self.compile(exp.value[2], scope, tail)
+        if not tail:
+            self.code.emit(LEAVE_ENV)
+
+    def compile_do(self, exp, scope, tail):
+        if len(exp.value) == 1:
+            self.code.emit(CONST, self.code.const(nil))
+            if tail:
+                self.code.emit(RETURN)
+            return
+        for x in exp.value[1:-1]:
+            self.compile(x, scope, False)
+            self.code.emit(POP)
+        self.compile(exp.value[-1], scope, tail)
+
+    def compile_if(self, exp, scope, tail):
+        if len(exp.value) < 3 or len(exp.value) > 4:
+            raise SyntaxError("wrong number of arguments")
+        code = self.code
+        self.compile(exp.value[1], scope, False)
+        to_else = code.emit(JUMP_IF_FALSE)
+        self.compile(exp.value[2], scope, tail)
+        to_end = None if tail else code.emit(JUMP)
+        code.patch(to_else)
+        if len(exp.value) == 4:
+            self.compile(exp.value[3], scope, tail)
+        else:
+            code.emit(CONST, code.const(nil))
+            if tail:
+                code.emit(RETURN)
+        if to_end is not None:
+            code.patch(to_end)
+
+    def compile_fn(self, exp, scope, tail):
+        if len(exp.value) != 3:
+            raise SyntaxError("wrong number of arguments")
+        params = exp.value[1]
+        if type(params) is not MalList and type(params) is not MalVector:
+            raise SyntaxError("second argument must be a list or vector")
+        plan = ParamPlan(params)
+        inner = scope | set(plan.names) | ({plan.rest} if plan.rest is not None else set())
+        template = FnTemplate(params, exp.value[2], plan, inner)
+        self.code.emit(MAKE_FN, self.code.const(template))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_quote(self, exp, scope, tail):
+        if len(exp.value) != 2:
+            raise SyntaxError("wrong number of arguments")
+        self.code.emit(CONST, self.code.const(exp.value[1]))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_quasiquote(self, exp, scope, tail):
+        if len(exp.value) != 2:
+            raise SyntaxError("wrong number of arguments")
+        self.compile(mal_quasiquote(exp.value[1]), scope, tail)
+
+    def compile_quasiquoteexpand(self, exp, scope, tail):
+        if len(exp.value) != 2:
+            raise SyntaxError("wrong number of arguments")
+        self.code.emit(CONST, self.code.const(mal_quasiquote(exp.value[1])))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_macroexpand(self, exp, scope, tail):
+        if len(exp.value) != 2:
+            raise SyntaxError("wrong number of arguments")
+        self.code.emit(MACROEXPAND, self.code.const(exp.value[1]))
+        if tail:
+            self.code.emit(RETURN)
+
+
+_DO = symbol("do")
+
+_SPECIAL_FORMS = {
+    symbol("def!"): Compiler.compile_def,
+    symbol("defmacro!"): Compiler.compile_defmacro,
+    symbol("let*"): Compiler.compile_let,
+    symbol("do"): Compiler.compile_do,
+    symbol("if"): Compiler.compile_if,
+    symbol("fn*"): Compiler.compile_fn,
+    symbol("quote"): Compiler.compile_quote,
+    symbol("quasiquote"): Compiler.compile_quasiquote,
+    symbol("quasiquoteexpand"): Compiler.compile_quasiquoteexpand,
+    symbol("macroexpand"): Compiler.compile_macroexpand,
+}
+
+
+def run(code: Code, env: Env) -> MalObject:
+    """Run code in env until it returns."""
+    frames = _FRAMES
+    if len(frames) >= MAX_DEPTH:
+        raise RecursionError(f"maximum call depth of {MAX_DEPTH} exceeded")
+    # The run counts as a pending call itself
+    frames.append(None)
+    base = len(frames)
+    stack = []
+    ops = code.ops
+    consts = code.consts
+    pc = 0
+    try:
+        while True:
+            op = ops[pc]
+            arg = ops[pc + 1]
+            pc += 2
+            if op == LOAD:
+                stack.append(env[consts[arg]])
+            elif op == CONST:
+                stack.append(consts[arg])
+            elif op == CALL or op == TAIL_CALL:
+                args = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                func = stack.pop()
+                if type(func) is VMClosure:
+                    if op == CALL:
+                        if len(frames) >= MAX_DEPTH:
+                            raise RecursionError(f"maximum call depth of {MAX_DEPTH} exceeded")
+                        frames.append((ops, consts, pc, env))
+                    code = func.template.compile(func.env)
+                    env = Env(func.env, func.plan.bind(args))
+                    ops = code.ops
+                    consts = code.consts
+                    pc = 0
+                    continue
+                if callable(func):
+                    # Pop the args as they are passed, so the builtin holds
+                    # the only reference to each
+                    if arg == 2:
+                        stack.append(func(args.pop(0), args.pop()))
+                    else:
+                        stack.append(call_builtin(func, args))
+                else:
+                    raise TypeError(f"{func} is not callable")
+                if op == TAIL_CALL:
+                    if len(frames) == base:
+                        return stack.pop()
+                    ops, consts, pc, env = frames.pop()
+            elif op == RETURN:
+                if len(frames) == base:
+                    return stack.pop()
+                ops, consts, pc, env = frames.pop()
+            elif op == JUMP_IF_FALSE:
+                value = stack.pop()
+                if value is false or value is nil:
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+            elif op == POP:
+                stack.pop()
+            elif op == BIND:
+                env[consts[arg]] = stack.pop()
+            elif op == ENTER_ENV:
+                env = Env(outer=env)
+            elif op == LEAVE_ENV:
+                env = env._outer
+            elif op == MAKE_FN:
+                stack.append(VMClosure(consts[arg], env))
+            elif op == DEF:
+                env[consts[arg]] = stack[-1]
+            elif op == DEFMACRO:
+                func = stack.pop()
+                if type(func) is not VMClosure:
+                    raise SyntaxError("second argument must be a function")
+                env[consts[arg]] = func.as_macro()
+                stack.append(nil)
+            elif op == BUILD_VECTOR or op == BUILD_HASHMAP:
+                items = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                stack.append(MalVector(items) if op == BUILD_VECTOR else hash_map(items))
+            elif op == MACROEXPAND:
+                stack.append(mal_macroexpand(env, consts[arg]))
+            else:
+                raise RuntimeError(f"unknown opcode {op}")
+    finally:
+        del frames[base - 1:]
+
+
+def compile_form(env: Env, exp: MalObject) -> Code:
+    """Compile exp into code returning its value."""
+    return Compiler(env).compile_body(exp, frozenset())
+
+
+def vm_eval(env: Env, exp: MalObject) -> MalObject:
+    """Evaluate exp with env on the VM.
+
+    Running out of the Python stack, through builtins that call back into
+    mal, ends in the call depth error too."""
+    # Top-level forms of a do are compiled one at a time, so that macros
+    # defined by earlier forms apply to later ones.
+    while (type(exp) is MalList and len(exp.value) > 1
+           and exp.value[0] is _DO):
+        for form in exp.value[1:-1]:
+            vm_eval(env, form)
+        exp = exp.value[-1]
+    try:
+        return run(compile_form(env, exp), env)
+    except RecursionError as e:
+        raise call_depth_error(e) from None
@@ -1,17 +1,17 @@
 import sys
 import traceback
 
-from mal.types import MalObject, MalType
+from mal.types import MalObject, mal_int
 from mal.eval import mal_eval
 from mal.reader import read_str
 from mal.printer import pr_str
 
 
 REPL_ENV = {
-    "+": lambda a, b: MalObject(MalType.INTEGER, a.value + b.value),
-    "-": lambda a, b: MalObject(MalType.INTEGER, a.value - b.value),
-    "*": lambda a, b: MalObject(MalType.INTEGER, a.value * b.value),
-    "/": lambda a, b: MalObject(MalType.INTEGER, int(a.value / b.value)),
+    "+": lambda a, b: mal_int(a.value + b.value),
+    "-": lambda a, b: mal_int(a.value - b.value),
+    "*": lambda a, b: mal_int(a.value * b.value),
+    "/": lambda a, b: mal_int(int(a.value / b.value)),
 }
 
 
@@ -1,7 +1,7 @@
 import sys
 import traceback
 
-from mal.types import MalObject, MalType
+from mal.types import MalObject, mal_int
 from mal.eval import mal_eval
 from mal.env import Env
 from mal.reader import read_str
@@ -26,10 +26,10 @@ def mal_rep(s: str, env: Env) -> str:
 
 def create_env() -> Env:
     env = Env()
-    env["+"] = lambda a, b: MalObject(MalType.INTEGER, a.value + b.value)
-    env["-"] = lambda a, b: MalObject(MalType.INTEGER, a.value - b.value)
-    env["*"] = lambda a, b: MalObject(MalType.INTEGER, a.value * b.value)
-    env["/"] = lambda a, b: MalObject(MalType.INTEGER, int(a.value / b.value))
+    env["+"] = lambda a, b: mal_int(a.value + b.value)
+    env["-"] = lambda a, b: mal_int(a.value - b.value)
+    env["*"] = lambda a, b: mal_int(a.value * b.value)
+    env["/"] = lambda a, b: mal_int(int(a.value / b.value))
     return env
 
 
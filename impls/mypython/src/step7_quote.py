@@ -1,8 +1,8 @@
 import sys
 import traceback
 
-from mal.core import core_env
-from mal.types import MalObject, MalType
+from mal.core import core_env, mal_load_file
+from mal.types import MalList, MalObject, MalString
 from mal.eval import mal_eval
 from mal.env import Env
 from mal.reader import read_str
@@ -28,20 +28,22 @@ def mal_rep(s: str, env: Env) -> str:
 def prelude(env: Env):
     mal_rep("(def! not (fn* (a) (if a false true)))", env)
     env["eval"] = lambda ast: mal_eval(env, ast)
-    mal_rep("""(def! load-file (fn* (f) (eval (read-string (str "(do " (slurp f) "\nnil)")))))""", env)
+    env["load-file"] = lambda f: mal_load_file(f, env["eval"])
 
 
 if __name__ == "__main__":
     env = core_env()
     prelude(env)
 
-    args = MalObject(MalType.LIST, [MalObject(MalType.STRING, x) for x in sys.argv[2:]])
+    args = MalList([MalString(x) for x in sys.argv[2:]])
     env["*ARGV*"] = args
     if len(sys.argv) > 1:
         try:
             mal_rep(f"(load-file \"{sys.argv[1]}\")", env)
         except Exception as e:
             print(e)
+            for note in getattr(e, "__notes__", ()):
+                print(note)
             #print("".join(traceback.format_exception(*sys.exc_info())))
         mal_quit()
 
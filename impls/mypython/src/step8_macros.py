@@ -1,12 +1,24 @@
+import os
 import sys
 import traceback
 
-from mal.core import core_env
-from mal.types import MalObject, MalType
-from mal.eval import mal_eval
+from mal.analyzer import analyze_eval
+from mal.core import core_env, define_builtin, mal_load_file
+from mal.types import MalList, MalObject, MalString
+from mal.eval import tree_eval
 from mal.env import Env
+from mal.image import load_image
 from mal.reader import read_str
 from mal.printer import pr_str
+from mal.vm import vm_eval
+
+
+ENGINES = {
+    "tree": tree_eval,
+    "analyze": analyze_eval,
+    "vm": vm_eval,
+}
+EVAL = ENGINES[os.environ.get("MAL_ENGINE", "tree")]
 
 
 def mal_read(s: str) -> MalObject:
@@ -22,27 +34,45 @@ def mal_quit():
 
 
 def mal_rep(s: str, env: Env) -> str:
-    return mal_print(mal_eval(env, mal_read(s)))
+    return mal_print(EVAL(env, mal_read(s)))
+
+
+def host_builtins(env: Env):
+    define_builtin("eval", lambda ast: EVAL(env, ast))
+    define_builtin("load-file", lambda f: mal_load_file(f, env["eval"]))
 
 
 def prelude(env: Env):
     mal_rep("(def! not (fn* (a) (if a false true)))", env)
-    env["eval"] = lambda ast: mal_eval(env, ast)
-    mal_rep("""(def! load-file (fn* (f) (eval (read-string (str "(do " (slurp f) "\nnil)")))))""", env)
+    host_builtins(env)
     mal_rep("""(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw "odd number of forms to cond")) (cons 'cond (rest (rest xs)))))))""", env)
+    mal_rep("(defmacro! lazy-seq (fn* (& body) `(lazy-seq* (fn* () (do ~@body)))))", env)
 
 
 if __name__ == "__main__":
+    argv = sys.argv[1:]
     env = core_env()
-    prelude(env)
+    if argv[:1] == ["--image"] and len(argv) > 1:
+        # The image holds the prelude and everything defined after it
+        host_builtins(env)
+        try:
+            load_image(argv[1], env)
+        except Exception as e:
+            print(f"can't load image: {e}", file=sys.stderr)
+            sys.exit(1)
+        argv = argv[2:]
+    else:
+        prelude(env)
 
-    args = MalObject(MalType.LIST, [MalObject(MalType.STRING, x) for x in sys.argv[2:]])
+    args = MalList([MalString(x) for x in argv[1:]])
     env["*ARGV*"] = args
-    if len(sys.argv) > 1:
+    if argv:
         try:
-            mal_rep(f"(load-file \"{sys.argv[1]}\")", env)
+            mal_rep(f"(load-file \"{argv[0]}\")", env)
         except Exception as e:
             print(e)
+            for note in getattr(e, "__notes__", ()):
+                print(note)
             #print("".join(traceback.format_exception(*sys.exc_info())))
         mal_quit()
 
@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
+
+
+@pytest.fixture
+def mal(tmp_path):
+    """Run step8_macros on the given args in a fresh interpreter.
+
+    The form cache lives in tmp_path, so runs do not share it with the
+    user's."""
+    def run(*args, stdin=None, **environ):
+        env = dict(os.environ, MAL_FORM_CACHE_DIR=str(tmp_path / "cache"), **environ)
+        return subprocess.run([sys.executable, os.path.join(SRC, "step8_macros.py"), *args],
+                              input=stdin, env=env, capture_output=True, text=True)
+    return run
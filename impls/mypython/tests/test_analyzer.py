@@ -0,0 +1,48 @@
+from mal.analyzer import analyze_eval
+from mal.core import core_env
+from mal.env import Env
+from mal.printer import pr_str
+from mal.reader import read_str
+
+
+def rep(env, src):
+    return pr_str(analyze_eval(env, read_str(src)), True)
+
+
+def test_declared_names_stay_in_their_def():
+    a = Env(core_env())
+    b = Env(core_env())
+    # Expanding m while the def! of g is analyzed in a analyzes code in b
+    # that calls a g of its own
+    a["hook"] = lambda: analyze_eval(b, read_str("(def! h (fn* [] (g 1)))"))
+    rep(a, "(defmacro! m (fn* [] (do (hook) nil)))")
+    rep(a, "(def! g (m))")
+    rep(b, "(defmacro! g (fn* [x] (list 'quote (list x))))")
+    assert rep(b, "(h)") == "(1)"
+
+
+def test_recursive_def():
+    env = Env(core_env())
+    rep(env, "(def! f (fn* [n] (if (= n 0) 0 (+ 1 (f (- n 1))))))")
+    assert rep(env, "(f 10)") == "10"
+
+
+LATER_DEFS = """
+(def! y 99)
+(def! f (fn* [] (do (def! g (fn* [] y)) (def! y 5) (g))))
+(prn (f))
+(def! h (fn* [] (do (def! g (fn* [] z)) (def! z 6) (g))))
+(prn (h))
+(prn (let* [a 1] (do (def! g (fn* [] (+ a w))) (def! w 7) (g))))
+(def! k (fn* [] (do (def! g (fn* [] y)) (def! r (g)) (def! y 5) (list r (g)))))
+(prn (k))
+"""
+
+
+def test_closures_see_later_local_defs(mal, tmp_path):
+    src = tmp_path / "later.mal"
+    src.write_text(LATER_DEFS)
+    outputs = {engine: mal(str(src), MAL_ENGINE=engine).stdout
+               for engine in ("tree", "analyze", "vm")}
+    assert outputs["tree"] == "5\n6\n8\n(99 5)\n"
+    assert outputs["analyze"] == outputs["vm"] == outputs["tree"]
@@ -0,0 +1,77 @@
+from mal.env import Env, cache_stats
+from mal.types import symbol
+
+
+def test_cache_is_per_global_env():
+    a = Env()
+    a["zz"] = 1
+    b = Env()
+    b["zz"] = 2
+    zz = symbol("zz")
+    assert a.find(zz) == 1
+    assert b.find(zz) == 2
+    assert Env(Env(a)).find(zz) == 1
+    assert Env(b).find(zz) == 2
+
+
+def test_cache_sees_new_bindings():
+    env = Env()
+    env["yy"] = 1
+    yy = symbol("yy")
+    assert env.find(yy) == 1
+    env["yy"] = 2
+    assert env.find(yy) == 2
+
+
+def test_local_bindings_shadow_globals():
+    env = Env()
+    env["xx"] = 1
+    xx = symbol("xx")
+    assert env.find(xx) == 1
+    assert Env(env, {"xx": 2}).find(xx) == 2
+    assert env.find(xx) == 1
+
+
+def stats_delta(f):
+    before = cache_stats()
+    result = f()
+    after = cache_stats()
+    return result, {name: after[name] - before[name] for name in after}
+
+
+def test_binding_one_name_keeps_the_other_caches():
+    env = Env()
+    env["ww"] = 1
+    ww = symbol("ww")
+    env.find(ww)
+    env["unrelated"] = 2
+    assert stats_delta(lambda: env.find(ww)) == (1, {"hits": 1, "misses": 0})
+
+
+def test_only_global_lookups_are_counted():
+    env = Env()
+    env["vv"] = 1
+    local = Env(env, {"uu": 2})
+    assert stats_delta(lambda: local.find(symbol("uu"))) == (2, {"hits": 0, "misses": 0})
+    assert stats_delta(lambda: local.find(symbol("vv"))) == (1, {"hits": 0, "misses": 1})
+    assert stats_delta(lambda: local.find(symbol("vv"))) == (1, {"hits": 1, "misses": 0})
+
+
+def test_first_local_binding_drops_the_global_cache():
+    env = Env()
+    env["tt"] = 1
+    tt = symbol("tt")
+    assert env.find(tt) == 1
+    inner = Env(env)
+    inner["tt"] = 2
+    assert tt.lookup_cache is None
+    assert inner.find(tt) == 2
+    assert Env(inner).find(tt) == 2
+    assert env.find(tt) == 1
+
+
+def test_fib_lookups_hit(mal, tmp_path):
+    src = tmp_path / "fib.mal"
+    src.write_text("(def! fib (fn* [n] (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))\n"
+                   "(fib 15)\n(prn (> (get (symbol-cache-stats) :hit-rate) 0.99))\n")
+    assert mal(str(src), MAL_ENGINE="tree").stdout == "true\n"
@@ -0,0 +1,146 @@
+import pytest
+
+from mal import eval as mal_eval_module
+from mal.analyzer import analyze_eval
+from mal.core import core_env
+from mal.env import Env
+from mal.eval import (
+    SPECIAL_FORMS, TailEval, compile_quasiquote, macro_cache_stats, mal_quasiquote, special_form,
+    tree_eval,
+)
+from mal.printer import pr_str
+from mal.reader import read_str
+from mal.types import MalList, MalVector, nil, symbol
+from mal.vm import vm_eval
+
+
+@pytest.fixture
+def when():
+    @special_form("when")
+    def _eval_when(env, exp):
+        test = tree_eval(env, exp.value[1])
+        if test is nil or test is symbol("false"):
+            return nil
+        return TailEval(env, MalList([symbol("do")] + exp.value[2:]))
+    yield
+    del SPECIAL_FORMS[symbol("when")]
+
+
+def test_registered_form_runs_on_tree_engine(when):
+    env = Env(core_env())
+    assert pr_str(tree_eval(env, read_str("(when (= 1 1) (def! w 2) (+ w 1))"))) == "3"
+    assert tree_eval(env, read_str("(when nil (undefined))")) is nil
+    f = tree_eval(env, read_str("(fn* [n] (when (> n 0) (+ n 1)))"))
+    assert pr_str(tree_eval(env, MalList([f, read_str("4")]))) == "5"
+
+
+@pytest.mark.parametrize("evaluate, engine", [(analyze_eval, "analyze"), (vm_eval, "vm")])
+def test_registered_form_is_rejected_by_other_engines(when, evaluate, engine):
+    env = Env(core_env())
+    message = f"special form when is not supported by the {engine} engine"
+    with pytest.raises(SyntaxError, match=message):
+        evaluate(env, read_str("(when true 1)"))
+    # fn* bodies are analyzed on their first call
+    evaluate(env, read_str("(def! f (fn* [n] (when (> n 0) (+ n 1))))"))
+    with pytest.raises(SyntaxError, match=message):
+        evaluate(env, read_str("(f 1)"))
+
+
+def test_builtin_forms_are_registered():
+    for name in ("def!", "defmacro!", "let*", "do", "if", "fn*", "quote", "quasiquote",
+                 "quasiquoteexpand", "macroexpand"):
+        assert symbol(name) in SPECIAL_FORMS
+
+
+def run(env, src):
+    return pr_str(tree_eval(env, read_str(src)))
+
+
+def stats_after(env, src, times=1):
+    """Evaluate src times, returning the last result and the changes to the
+    macro cache counters."""
+    before = macro_cache_stats()
+    for _ in range(times):
+        result = run(env, src)
+    after = macro_cache_stats()
+    return result, {name: after[name] - before[name] for name in after}
+
+
+@pytest.fixture
+def macro_env():
+    env = Env(core_env())
+    run(env, "(defmacro! plus10 (fn* [x] `(+ ~x 10)))")
+    run(env, "(def! f (fn* [n] (plus10 n)))")
+    return env
+
+
+def test_expansions_are_cached_on_the_call_site(macro_env):
+    assert stats_after(macro_env, "(f 1)", 5) == ("11", {"expansions": 1, "hits": 4})
+    # A new site is expanded once of its own
+    assert stats_after(macro_env, "(plus10 2)") == ("12", {"expansions": 1, "hits": 0})
+
+
+def test_cached_expansion_outlives_a_redefined_macro(macro_env):
+    run(macro_env, "(f 1)")
+    run(macro_env, "(defmacro! plus10 (fn* [x] `(+ ~x 100)))")
+    assert run(macro_env, "(f 1)") == "11"
+
+
+def test_sites_that_were_not_macro_calls_see_later_macros():
+    env = Env(core_env())
+    run(env, "(def! m (fn* [x] x))")
+    run(env, "(def! g (fn* [] (m 1)))")
+    assert run(env, "(g)") == "1"
+    run(env, "(defmacro! m (fn* [x] `(+ ~x 10)))")
+    assert run(env, "(g)") == "11"
+
+
+def test_cache_can_be_turned_off(macro_env, monkeypatch):
+    monkeypatch.setattr(mal_eval_module, "MACRO_CACHE", False)
+    assert stats_after(macro_env, "(f 1)", 3) == ("11", {"expansions": 3, "hits": 0})
+    run(macro_env, "(defmacro! plus10 (fn* [x] `(+ ~x 100)))")
+    assert run(macro_env, "(f 1)") == "101"
+
+
+def test_cache_is_off_with_mal_macro_cache_0(mal, tmp_path):
+    src = tmp_path / "macro.mal"
+    src.write_text("(defmacro! m (fn* [x] x))\n(def! f (fn* [] (m 1)))\n(f) (f) (f)\n"
+                   "(prn (get (macro-cache-stats) :hits))\n")
+    assert mal(str(src)).stdout == "2\n"
+    assert mal(str(src), MAL_MACRO_CACHE="0").stdout == "0\n"
+
+
+TEMPLATES = [
+    "1", "x", ":k", "nil", '"s"', "()", "[]", "{:a x}",
+    "(a b c)", "[a b c]", "(a ~x)", "[~x ~@xs]", "(~@xs)", "(~@v ~@xs)",
+    "(a (b [c ~x] ()) ~@(map (fn* [n] (* n 10)) xs))", "[[~@v] (~x) []]", "(~@(range 3) ~@())",
+    "(~x ~@(list) [~@v])", "(quote ~x)", "(a (unquote x))",
+]
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_quasiquote_builder_matches_the_expansion(template):
+    env = Env(core_env())
+    run(env, "(do (def! x 7) (def! xs (list 1 2)) (def! v [3 4]))")
+    ast = read_str(template)
+    built = compile_quasiquote(ast)(env)
+    expanded = tree_eval(env, mal_quasiquote(ast))
+    assert pr_str(built, True) == pr_str(expanded, True)
+    # concat can make a lazy seq where the builder makes a list, but a
+    # vector template gives a vector either way
+    assert (type(built) is MalVector) == (type(expanded) is MalVector)
+
+
+def test_quasiquote_builder_shares_unquoted_values():
+    env = Env(core_env())
+    run(env, "(def! v [1 2])")
+    built = compile_quasiquote(read_str("(a ~v)"))(env)
+    assert built.value[1] is env.find(symbol("v"))
+
+
+def test_quasiquote_splice_errors():
+    env = Env(core_env())
+    with pytest.raises(TypeError, match="is not a sequence"):
+        compile_quasiquote(read_str("(~@1)"))(env)
+    with pytest.raises(SyntaxError, match="wrong number of arguments"):
+        compile_quasiquote(read_str("((splice-unquote a b))"))
@@ -0,0 +1,121 @@
+import os
+import time
+
+import pytest
+
+from mal import formcache
+from mal.core import mal_load_file
+from mal.printer import pr_str
+
+SOURCE = '(def! a {:k [1 2.5 "s"]})\n(prn (list a \'b))\n'
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(formcache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(formcache, "ENABLED", True)
+    return tmp_path
+
+
+def load(path):
+    """Load path, returning the printed forms and the changes to the counters."""
+    before = formcache.cache_stats()
+    forms = []
+    mal_load_file(str(path), forms.append)
+    after = formcache.cache_stats()
+    counts = {name: after[name] - before[name] for name in after if after[name] != before[name]}
+    return [pr_str(form, True) for form in forms], counts
+
+
+def source(cache, text=SOURCE):
+    path = cache / "src.mal"
+    path.write_text(text)
+    return path
+
+
+def test_miss_then_hit(cache):
+    path = source(cache)
+    forms, counts = load(path)
+    assert counts == {"misses": 1, "writes": 1}
+    cached, counts = load(path)
+    assert counts == {"hits": 1}
+    assert cached == forms
+
+
+def test_touched_file_is_rehashed(cache):
+    path = source(cache)
+    forms, _ = load(path)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cached, counts = load(path)
+    assert counts == {"hits": 1, "rehashes": 1, "writes": 1}
+    assert cached == forms
+    _, counts = load(path)
+    assert counts == {"hits": 1}
+
+
+def test_changed_file_is_read_again(cache):
+    path = source(cache)
+    load(path)
+    st = os.stat(path)
+    path.write_text(SOURCE.replace("1 2.5", "3 4.5"))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    forms, counts = load(path)
+    assert counts == {"misses": 1, "writes": 1}
+    assert forms[0] == '(def! a {:k [3 4.5 "s"]})'
+
+
+def test_corrupt_entry_is_a_miss(cache):
+    path = source(cache)
+    forms, _ = load(path)
+    with open(formcache.cache_path(str(path)), "r+b") as f:
+        f.truncate(os.path.getsize(f.name) // 2)
+    cached, counts = load(path)
+    assert counts == {"misses": 1, "writes": 1}
+    assert cached == forms
+
+
+def test_file_changed_while_loading_is_not_stored(cache):
+    path = source(cache)
+
+    def rewrite(form):
+        path.write_text(SOURCE + "(prn 1)\n")
+
+    mal_load_file(str(path), rewrite)
+    assert not os.path.exists(formcache.cache_path(str(path)))
+
+
+def test_cache_dir_from_environment(mal, tmp_path):
+    path = tmp_path / "src.mal"
+    path.write_text(SOURCE)
+    first = mal(str(path), MAL_FORM_CACHE_STATS="1")
+    second = mal(str(path), MAL_FORM_CACHE_STATS="1")
+    assert first.stdout == second.stdout == "({:k [1 2.5 \"s\"]} b)\n"
+    assert "0 hits, 1 misses" in first.stderr
+    assert "1 hits, 0 misses" in second.stderr
+    assert os.listdir(tmp_path / "cache") == [os.path.basename(formcache.cache_path(str(path)))]
+
+
+def test_cached_forms_are_decoded_lazily(cache):
+    path = source(cache, SOURCE * 3)
+    load(path)
+    forms = formcache.lookup(str(path), os.stat(path))
+    assert pr_str(next(forms)[1], True) == '(def! a {:k [1 2.5 "s"]})'
+    assert [line for line, _ in forms] == [2, 3, 4, 5, 6]
+
+
+def test_warm_load_is_not_slower_than_uncached(cache, monkeypatch):
+    path = source(cache, "".join(f'(def! x{i} {{:a [{i} 2.5 "s{i}" :k]}})\n' for i in range(5000)))
+
+    def best_time():
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            mal_load_file(str(path), lambda form: None)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    load(path)
+    warm = best_time()
+    monkeypatch.setattr(formcache, "ENABLED", False)
+    assert warm <= best_time()
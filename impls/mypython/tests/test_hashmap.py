@@ -0,0 +1,108 @@
+import pytest
+
+from mal.core import mal_assoc, mal_contains_p, mal_dissoc, mal_get, mal_keys, mal_vals
+from mal.hamt import EMPTY as EMPTY_HAMT
+from mal.types import (
+    EMPTY_MAP, MalFloat, MalList, MalString, MalVector, false, hash_map, key_hash, keyword, mal_int,
+    nil, symbol, true,
+)
+
+
+def test_print_order_is_the_same_in_every_process(mal, tmp_path):
+    src = tmp_path / "map.mal"
+    src.write_text('(prn {:a 1 :b 2 :c 3 "d" 4 [1 "x"] 5 {:n "m"} 6 1.5 7})\n'
+                   '(prn (assoc (hash-map) "k1" 1 "k2" 2 :k3 3 \'k4 4))\n')
+    outputs = {mal(str(src), PYTHONHASHSEED=str(seed)).stdout for seed in range(6)}
+    assert len(outputs) == 1
+    # Errors are printed too, so check both maps made it out
+    first, second = outputs.pop().splitlines()
+    assert len(first.split()) == 16
+    assert sorted(second.strip("{}").split()) == ['"k1"', '"k2"', "1", "2", "3", "4", ":k3", "k4"]
+
+
+def test_key_hashes_are_structural():
+    assert key_hash(MalString("d")) == key_hash(MalString("d"))
+    assert len({key_hash(MalString("d")), key_hash(keyword("d")), key_hash(symbol("d"))}) == 3
+    a = hash_map([keyword("a"), mal_int(1), MalString("b"), mal_int(2)])
+    b = hash_map([MalString("b"), mal_int(2), keyword("a"), mal_int(1)])
+    assert key_hash(a) == key_hash(b)
+    assert a == b
+
+
+def test_key_hash_is_cached_on_fresh_strings():
+    s = MalString("fresh")
+    assert s._key_hash is None
+    h = key_hash(s)
+    assert s._key_hash == h == key_hash(MalString("fresh"))
+
+
+def test_assoc_get_and_dissoc_keep_old_versions():
+    keys = [MalString(f"k{i}") for i in range(2000)]
+    maps = [EMPTY_MAP]
+    for i, key in enumerate(keys):
+        maps.append(mal_assoc(maps[-1], key, mal_int(i)))
+    full = maps[-1]
+    assert len(full) == 2000
+    assert all(mal_get(full, MalString(f"k{i}")) == mal_int(i) for i in range(2000))
+    assert mal_get(maps[1000], keys[1500]) is nil
+    assert mal_contains_p(maps[1000], keys[999]) is true
+    assert mal_contains_p(maps[1000], keys[1000]) is false
+
+    half = mal_dissoc(full, *keys[::2])
+    assert len(half) == 1000
+    assert mal_contains_p(half, keys[0]) is false
+    assert mal_get(half, keys[1]) == mal_int(1)
+    assert len(full) == 2000 and mal_get(full, keys[0]) == mal_int(0)
+    assert mal_dissoc(half, *keys) is EMPTY_MAP
+    assert mal_dissoc(half, keyword("absent")).value is half.value
+
+
+def test_replacing_a_value_keeps_the_count():
+    m = mal_assoc(EMPTY_MAP, keyword("a"), mal_int(1), keyword("a"), mal_int(2))
+    assert len(m) == 1
+    assert mal_get(m, keyword("a")) == mal_int(2)
+
+
+def test_keys_and_vals_pair_up():
+    m = hash_map([keyword("a"), mal_int(1), MalString("b"), mal_int(2), symbol("c"), mal_int(3)])
+    keys, vals = mal_keys(m), mal_vals(m)
+    assert type(keys) is MalList and type(vals) is MalList
+    assert dict(zip(keys.value, vals.value)) == {keyword("a"): mal_int(1), MalString("b"): mal_int(2),
+                                                 symbol("c"): mal_int(3)}
+    assert mal_keys(EMPTY_MAP).value == [] and mal_vals(EMPTY_MAP).value == []
+
+
+def test_keys_compare_by_value_and_type():
+    m = hash_map([mal_int(1), keyword("int"), MalFloat(1.0), keyword("float"),
+                  MalString("a"), keyword("string"), keyword("a"), keyword("keyword"),
+                  MalVector([mal_int(1)]), keyword("vector")])
+    assert len(m) == 5
+    assert mal_get(m, mal_int(1)) is keyword("int")
+    assert mal_get(m, MalFloat(1.0)) is keyword("float")
+    assert mal_get(m, symbol("a")) is nil
+    # Equal sequences are equal keys, whichever kind they are
+    assert mal_get(m, MalList([mal_int(1)])) is keyword("vector")
+
+
+def test_colliding_hashes():
+    hamt = EMPTY_HAMT
+    for i in range(5):
+        hamt = hamt.assoc(42, f"k{i}", f"k{i}", i)
+    assert len(hamt) == 5
+    assert [hamt.get(42, f"k{i}")[3] for i in range(5)] == [0, 1, 2, 3, 4]
+    assert hamt.get(42, "k5") is None
+    assert hamt.get(42 + 1, "k0") is None
+    for i in range(5):
+        hamt = hamt.dissoc(42, f"k{i}")
+        assert len(hamt) == 4 - i
+        assert hamt.get(42, f"k{i}") is None
+    assert hamt is EMPTY_HAMT
+
+
+def test_lookups_on_things_that_are_not_maps():
+    assert mal_get(nil, keyword("a")) is nil
+    for f in (mal_get, mal_contains_p, mal_dissoc):
+        with pytest.raises(TypeError, match="is not a hash-map"):
+            f(MalList([]), keyword("a"))
+    with pytest.raises(TypeError, match="is not a hash-map"):
+        mal_keys(nil)
@@ -0,0 +1,88 @@
+import pytest
+
+LIB = """
+(def! counter (atom 0))
+(def! inc! (fn* () (swap! counter + 1)))
+(def! shared [counter {:k counter}])
+(defmacro! unless (fn* (c & body) `(if ~c nil (do ~@body))))
+(def! make-adder (fn* (n) (fn* (x) (+ x n))))
+(def! add5 (make-adder 5))
+(def! make-counter (fn* () (let* [c (atom 0)] (fn* () (swap! c + 1)))))
+(def! next-id (make-counter))
+(next-id)
+(def! fact (fn* (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+(def! data {:a [1 2 3] "k" (list 1.5 :kw 'sym) :n nil :big 123456789012345678901})
+(def! realized (take 3 (range)))
+(count realized)
+(def! plus +)
+(inc!)
+(save-image IMAGE)
+"""
+
+USE = """
+(prn (deref counter) (inc!) (deref (nth shared 0)) (deref (get (nth shared 1) :k)))
+(prn (unless false 1 2) (add5 10) (next-id) (next-id) (fact 20) (plus 1 2))
+(prn data realized (= data {:a [1 2 3] "k" (list 1.5 :kw 'sym) :n nil :big 123456789012345678901}))
+(prn (cond false 1 :else 2) (not nil) (eval '(+ 1 2)))
+"""
+
+EXPECTED = [
+    "1 2 2 2",
+    "2 15 2 3 2432902008176640000 3",
+    "(0 1 2) true",
+    "2 true 3",
+]
+
+
+@pytest.mark.parametrize("engine", ["tree", "analyze", "vm"])
+def test_round_trip(mal, tmp_path, engine):
+    image = tmp_path / "app.img"
+    lib = tmp_path / "lib.mal"
+    lib.write_text(LIB.replace("IMAGE", f'"{image}"'))
+    use = tmp_path / "use.mal"
+    use.write_text(USE)
+    saved = mal(str(lib), MAL_ENGINE=engine)
+    assert saved.stdout == "" and image.exists()
+    result = mal("--image", str(image), str(use), MAL_ENGINE=engine)
+    lines = result.stdout.splitlines()
+    assert lines[0] == EXPECTED[0]
+    assert lines[1] == EXPECTED[1]
+    assert lines[2].startswith("{") and lines[2].endswith(EXPECTED[2])
+    assert lines[3] == EXPECTED[3]
+
+
+@pytest.mark.parametrize("value, message", [
+    ("(memoize (fn* [x] x))", "is not a builtin and can not be saved"),
+    ("(range)", "lazy seq that is not fully realized"),
+    ("(map (fn* [x] x))", "is not a builtin and can not be saved"),
+])
+def test_values_that_can_not_be_saved(mal, tmp_path, value, message):
+    image = tmp_path / "bad.img"
+    lib = tmp_path / "bad.mal"
+    lib.write_text(f'(def! bad {value})\n(save-image "{image}")\n')
+    result = mal(str(lib))
+    assert f"can't save bad in an image" in result.stdout
+    assert message in result.stdout
+    assert not image.exists()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_engine_mismatch(mal, tmp_path):
+    image = tmp_path / "app.img"
+    lib = tmp_path / "lib.mal"
+    lib.write_text(f'(def! f (fn* [] 1))\n(save-image "{image}")\n')
+    mal(str(lib), MAL_ENGINE="tree")
+    result = mal("--image", str(image), MAL_ENGINE="vm", stdin="")
+    assert result.returncode == 1
+    assert result.stderr.strip() == f"can't load image: {image} was saved by the tree engine, not by vm"
+
+
+@pytest.mark.parametrize("contents", [None, b"not an image\n"])
+def test_bad_image_file(mal, tmp_path, contents):
+    image = tmp_path / "app.img"
+    if contents is not None:
+        image.write_bytes(contents)
+    result = mal("--image", str(image), stdin="")
+    assert result.returncode == 1
+    assert result.stderr.startswith("can't load image: ")
+    assert len(result.stderr.splitlines()) == 1
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+N = 1000000
+
+# Each walks a lazy seq of N elements; holding its head would keep all
+# of them alive, about 100MB
+CONSUMERS = [
+    f"(count (range {N}))",
+    f"(nth (range) {N})",
+    f"(reduce + 0 (map (fn* [x] x) (range {N})))",
+    f"(transduce (map (fn* [x] x)) + (range {N}))",
+    f"(count (into [] (filter (fn* [x] (= x 0))) (range {N})))",
+]
+
+
+def peak_rss_mb(status: str) -> int:
+    for line in status.splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) // 1024
+    raise AssertionError("no VmHWM in /proc/self/status")
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="needs /proc")
+@pytest.mark.parametrize("engine", ["tree", "analyze", "vm"])
+@pytest.mark.parametrize("form", CONSUMERS)
+def test_consumers_do_not_hold_the_head(mal, tmp_path, engine, form):
+    src = tmp_path / "walk.mal"
+    src.write_text(f'(def! walk (fn* [] {form}))\n(prn (walk))\n(println (slurp "/proc/self/status"))\n')
+    result = mal(str(src), MAL_ENGINE=engine)
+    value, status = result.stdout.split("\n", 1)
+    assert value != "" and "error" not in value.lower()
+    assert peak_rss_mb(status) < 60
@@ -0,0 +1,69 @@
+import gc
+
+from mal import core
+from mal.core import mal_memo_stats, mal_memoize
+from mal.types import keyword, mal_int
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def stats(f):
+    m = mal_memo_stats(f)
+    return {name: m.get(keyword(name)).value for name in ("hits", "misses", "evictions", "size")}
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.time, "monotonic", clock)
+    calls = []
+    f = mal_memoize(lambda x: calls.append(x) or x, keyword("ttl-ms"), mal_int(500))
+    f(mal_int(1))
+    clock.now += 0.4
+    f(mal_int(1))
+    assert calls == [mal_int(1)]
+    clock.now += 0.2
+    f(mal_int(1))
+    assert calls == [mal_int(1), mal_int(1)]
+    assert stats(f) == {"hits": 1, "misses": 2, "evictions": 1, "size": 1}
+
+
+def test_ttl_and_max_size_together(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.time, "monotonic", clock)
+    f = mal_memoize(lambda x: x, keyword("max-size"), mal_int(1), keyword("ttl-ms"), mal_int(100))
+    f(mal_int(1))
+    f(mal_int(2))
+    clock.now += 1
+    f(mal_int(2))
+    assert stats(f) == {"hits": 0, "misses": 3, "evictions": 2, "size": 1}
+
+
+def test_totals_forget_collected_functions():
+    before = mal_memo_stats().get(keyword("size")).value
+    f = mal_memoize(lambda x: x)
+    f(mal_int(1))
+    assert mal_memo_stats().get(keyword("size")).value == before + 1
+    del f
+    gc.collect()
+    assert mal_memo_stats().get(keyword("size")).value == before
+
+
+def test_expired_entries_are_swept_without_max_size(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.time, "monotonic", clock)
+    f = mal_memoize(lambda x: x, keyword("ttl-ms"), mal_int(95))
+    for i in range(1000):
+        f(mal_int(i))
+        clock.now += 0.01
+        assert stats(f)["size"] <= 10
+    assert stats(f) == {"hits": 0, "misses": 1000, "evictions": 990, "size": 10}
+    # Entries that have not expired are kept
+    f(mal_int(995))
+    assert stats(f)["hits"] == 1
@@ -0,0 +1,84 @@
+import pytest
+
+from mal.core import mal_assoc, mal_conj, mal_nth
+from mal.pvector import EMPTY, PVector
+from mal.types import EMPTY_VECTOR, MalVector, mal_int
+
+# Sizes on each side of the tail filling up (32), the root filling up
+# (1024 + 32) and the trie growing a third level
+SIZES = [0, 1, 31, 32, 33, 64, 65, 1023, 1024, 1025, 1056, 1057, 1088, 32800, 32801, 33000]
+
+
+def build(n):
+    vec = EMPTY
+    for i in range(n):
+        vec = vec.conj(i)
+    return vec
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_conj_and_from_list_agree(n):
+    vec = build(n)
+    assert len(vec) == n
+    assert list(vec) == list(range(n))
+    assert list(reversed(vec)) == list(reversed(range(n)))
+    assert all(vec[i] == i for i in range(n))
+    built = PVector.from_list(list(range(n)))
+    assert list(built) == list(range(n))
+    assert list(built.conj(n)) == list(range(n + 1))
+
+
+def test_conj_across_boundaries_keeps_old_versions():
+    versions = [EMPTY]
+    for i in range(1100):
+        versions.append(versions[-1].conj(i))
+    for n in [0, 32, 33, 1024, 1056, 1057, 1100]:
+        assert list(versions[n]) == list(range(n))
+
+
+@pytest.mark.parametrize("n", [33, 1025, 1057, 32801])
+def test_assoc_copies_only_its_version(n):
+    vec = PVector.from_list(list(range(n)))
+    for i in {0, 31, 32, 1023, 1024, n - 33, n - 32, n - 1} & set(range(n)):
+        changed = vec.assoc(i, "x")
+        assert changed[i] == "x"
+        assert vec[i] == i
+        assert [changed[j] for j in range(n) if j != i] == [j for j in range(n) if j != i]
+    assert list(vec.assoc(n, n)) == list(range(n + 1))
+    with pytest.raises(IndexError):
+        vec.assoc(n + 1, "x")
+
+
+@pytest.mark.parametrize("n", [33, 1025, 1057, 32801])
+def test_pop_back_across_boundaries(n):
+    vec = PVector.from_list(list(range(n)))
+    for m in range(n - 1, max(n - 70, -1), -1):
+        vec = vec.pop()
+        assert len(vec) == m
+        assert list(vec)[-1:] == list(range(m))[-1:]
+    assert list(vec) == list(range(len(vec)))
+    assert list(vec.conj("x")) == list(range(len(vec))) + ["x"]
+
+
+def test_indexes_out_of_range():
+    vec = build(40)
+    assert vec[-1] == 39
+    for i in (40, -41):
+        with pytest.raises(IndexError):
+            vec[i]
+    with pytest.raises(IndexError):
+        EMPTY.pop()
+
+
+def test_vector_builtins():
+    vec = EMPTY_VECTOR
+    for i in range(1030):
+        vec = mal_conj(vec, mal_int(i))
+    assert type(vec) is MalVector
+    assert mal_nth(vec, mal_int(1024)) == mal_int(1024)
+    changed = mal_assoc(vec, mal_int(31), mal_int(-1), mal_int(1030), mal_int(1030))
+    assert mal_nth(changed, mal_int(31)) == mal_int(-1)
+    assert mal_nth(changed, mal_int(1030)) == mal_int(1030)
+    assert mal_nth(vec, mal_int(31)) == mal_int(31)
+    with pytest.raises(IndexError):
+        mal_nth(vec, mal_int(1030))
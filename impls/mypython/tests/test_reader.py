@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+from mal import reader
+from mal.printer import pr_str
+from mal.reader import read_forms, read_forms_at, read_str
+from mal.types import MalString
+
+
+@pytest.mark.parametrize("src, message", [
+    ("(1 2", "unexpected EOF while reading. expected ')' (line 1, column 1)"),
+    ("(a ;c)\n", "unexpected EOF while reading. expected ')' (line 1, column 1)"),
+    ("(1\n  [2\n", "unexpected EOF while reading. expected ']' (line 2, column 3)"),
+    ("  (a\n\t{:k", "unexpected EOF while reading. expected '}' (line 2, column 2)"),
+    ('(a\n "abc', "unexpected EOF while reading. expected '\"' (line 2, column 2)"),
+    ("(a)\n  )", "unbalanced ) (line 2, column 3)"),
+    ("\n\n]", "unbalanced ] (line 3, column 1)"),
+    ("{:a 1\n :b}", "odd number of forms in a hashmap (line 1, column 1)"),
+    ("x @1", "unexpected token: 1 after @ (line 1, column 4)"),
+    ("(:", "unexpected EOF while reading keyword (line 1, column 3)"),
+])
+def test_errors_give_line_and_column(src, message):
+    with pytest.raises(SyntaxError) as e:
+        list(read_forms(src))
+    assert str(e.value) == message
+
+
+@pytest.mark.parametrize("src, message", [
+    ('"a\\qb"', "unknown escape \\q (line 1, column 3)"),
+    ('(x\n "ok" "a\\n\\qb")', "unknown escape \\q (line 2, column 11)"),
+    ('"\\\\\\t"', "unknown escape \\t (line 1, column 4)"),
+])
+def test_bad_escapes_point_at_the_escape(src, message):
+    with pytest.raises(SyntaxError) as e:
+        list(read_forms(src))
+    assert str(e.value) == message
+
+
+def test_escapes():
+    assert read_str(r'"a\nb\\c\"d"') == MalString('a\nb\\c"d')
+    assert read_str('"multi\nline"') == MalString("multi\nline")
+
+
+def test_multi_byte_chars_count_as_one_column():
+    with pytest.raises(SyntaxError, match=r"\(line 1, column 5\)"):
+        list(read_forms("é€\U0001f600 )"))
+
+
+SOURCE = '''; a comment
+(def! long-name-here "a string with \\"escapes\\" and é€\\n") ; trailing
+[1 -2 3.5 :keyword nil true]
+{"k" {:nested (1 2)}}  'quoted `(a ~b ~@c) @atom
+symbol-at-the-end'''
+
+
+def forms_at(source):
+    return [(line, pr_str(form, True)) for line, form in read_forms_at(source)]
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7, 16])
+def test_small_chunks_split_tokens_and_strings(monkeypatch, chunk):
+    expected = forms_at(SOURCE)
+    assert [line for line, _ in expected] == [2, 3, 4, 4, 4, 4, 5]
+    monkeypatch.setattr(reader, "READ_CHUNK", chunk)
+    assert forms_at(io.StringIO(SOURCE)) == expected
+    # Buffers are decoded a chunk of bytes at a time, so chars are split too
+    assert forms_at(SOURCE.encode()) == expected
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7, 16])
+@pytest.mark.parametrize("src, message", [
+    ("(a)\n  )", "unbalanced ) (line 2, column 3)"),
+    ('(a "é\\q")', "unknown escape \\q (line 1, column 6)"),
+    ("(x)\n(y\n  [z", "unexpected EOF while reading. expected ']' (line 3, column 3)"),
+    ('\n"abc', "unexpected EOF while reading. expected '\"' (line 2, column 1)"),
+])
+def test_small_chunks_keep_error_positions(monkeypatch, chunk, src, message):
+    monkeypatch.setattr(reader, "READ_CHUNK", chunk)
+    for source in (io.StringIO(src), src.encode()):
+        with pytest.raises(SyntaxError) as e:
+            list(read_forms(source))
+        assert str(e.value) == message
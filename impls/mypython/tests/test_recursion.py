@@ -0,0 +1,54 @@
+import pytest
+
+SUMDOWN = "(def! sumdown (fn* [n] (if (= n 0) 0 (+ n (sumdown (- n 1))))))\n"
+
+
+@pytest.mark.parametrize("engine", ["tree", "analyze"])
+def test_deep_recursion_is_a_call_depth_error(mal, tmp_path, engine):
+    src = tmp_path / "deep.mal"
+    src.write_text(SUMDOWN + "(prn (sumdown 50000))\n")
+    result = mal(str(src), MAL_ENGINE=engine)
+    assert result.stdout.startswith("maximum call depth exceeded\nin the form at ")
+    assert result.returncode == 0
+
+
+@pytest.mark.parametrize("engine", ["tree", "analyze", "vm"])
+def test_repl_goes_on_after_deep_recursion(mal, engine):
+    result = mal(MAL_ENGINE=engine, MAL_MAX_DEPTH="1000",
+                 stdin=SUMDOWN + "(sumdown 50000)\n(sumdown 100)\n")
+    assert "maximum call depth" in result.stdout
+    assert "RecursionError: maximum recursion depth" not in result.stdout
+    assert "user> 5050" in result.stdout
+
+
+def test_vm_runs_deep_recursion(mal, tmp_path):
+    src = tmp_path / "deep.mal"
+    src.write_text(SUMDOWN + "(prn (sumdown 50000))\n")
+    assert mal(str(src), MAL_ENGINE="vm").stdout == "1250025000\n"
+
+
+@pytest.mark.parametrize("engine", ["tree", "analyze", "vm"])
+def test_moderate_recursion_runs_on_every_engine(mal, tmp_path, engine):
+    # The depth the tree engine reached before the other engines existed
+    src = tmp_path / "sumdown.mal"
+    src.write_text(SUMDOWN + "(prn (sumdown 300))\n")
+    assert mal(str(src), MAL_ENGINE=engine).stdout == "45150\n"
+
+
+APPLY_DOWN = "(def! f (fn* [n] (if (= n 0) 0 (+ 1 (apply f [(- n 1)])))))\n"
+
+
+@pytest.mark.parametrize("engine", ["tree", "analyze", "vm"])
+def test_recursion_through_builtins_is_a_call_depth_error(mal, tmp_path, engine):
+    src = tmp_path / "apply.mal"
+    src.write_text(APPLY_DOWN + "(prn (f 100))\n(prn (f 5000))\n")
+    result = mal(str(src), MAL_ENGINE=engine)
+    assert result.stdout.startswith("100\nmaximum call depth exceeded\nin the form at ")
+
+
+def test_vm_depth_limit_spans_builtin_calls(mal, tmp_path):
+    src = tmp_path / "apply.mal"
+    src.write_text(APPLY_DOWN + "(prn (f 40))\n(prn (f 100))\n")
+    result = mal(str(src), MAL_ENGINE="vm", MAL_MAX_DEPTH="50")
+    assert result.stdout == ("40\nmaximum call depth of 50 exceeded\n"
+                             "in the form at %s:3: (prn (f 100))\n" % src)
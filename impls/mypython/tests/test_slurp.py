@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from mal import core
+from mal.core import mal_slurp
+from mal.types import MalString, keyword, mal_int
+
+
+def slurp(path, **opts):
+    args = []
+    for name, value in opts.items():
+        args += [keyword(name), mal_int(value)]
+    return mal_slurp(MalString(str(path)), *args).value
+
+
+def test_byte_ranges(tmp_path):
+    path = tmp_path / "h.txt"
+    path.write_bytes("héllo\r\n".encode())
+    assert slurp(path) == "héllo\n"
+    assert slurp(path, offset=1, length=2) == "é"
+    assert slurp(path, offset=3) == "llo\n"
+    assert slurp(path, offset=100) == ""
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7])
+def test_chunks_split_chars_and_newlines(tmp_path, monkeypatch, chunk):
+    monkeypatch.setattr(core, "SLURP_CHUNK", chunk)
+    path = tmp_path / "h.txt"
+    path.write_bytes("h\u00e9\r\n\u20ac\rx\r\r\ny\n".encode())
+    assert slurp(path) == "h\u00e9\n\u20ac\nx\n\ny\n"
+    assert slurp(path, offset=1, length=4) == "\u00e9\n"
+
+
+def test_offset_inside_a_char(tmp_path):
+    path = tmp_path / "h.txt"
+    path.write_bytes("héllo".encode())
+    with pytest.raises(ValueError, match="offset 2 is inside a UTF-8 character"):
+        slurp(path, offset=2)
+    with pytest.raises(ValueError, match="ends at byte 2"):
+        slurp(path, offset=1, length=1)
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    assert slurp(path) == ""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="needs /proc")
+def test_file_without_a_size():
+    assert slurp("/proc/self/status").startswith("Name:")
+
+
+def test_fifo(tmp_path):
+    path = tmp_path / "fifo"
+    os.mkfifo(path)
+    pid = os.fork()
+    if pid == 0:
+        with open(path, "w") as f:
+            f.write("through a pipe")
+        os._exit(0)
+    try:
+        assert slurp(path) == "through a pipe"
+    finally:
+        os.waitpid(pid, 0)
+
+
+def test_load_file_from_a_pipe(mal):
+    result = mal("/dev/stdin", stdin='(prn 42)\n(prn (+ 1 2))\n')
+    assert result.stdout.split() == ["42", "3"]
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="needs /proc")
+def test_mapped_pages_are_released(mal, tmp_path):
+    size = 50 * 2**20
+    path = tmp_path / "big.txt"
+    with open(path, "w") as f:
+        line = "x" * 99 + "\n"
+        for _ in range(size // len(line)):
+            f.write(line)
+    src = tmp_path / "slurp.mal"
+    src.write_text(f'(def! s (slurp "{path}"))\n(println (slurp "/proc/self/status"))\n')
+    status = mal(str(src)).stdout
+    peak = int(status.split("VmHWM:")[1].split()[0]) * 1024
+    # The text itself, the interpreter and some chunks; holding the mapping
+    # as well would add another size
+    assert peak < size + 40 * 2**20
@@ -0,0 +1,178 @@
+import pytest
+
+from mal.analyzer import analyze_eval
+from mal.core import core_env
+from mal.env import Env
+from mal.eval import mal_eval
+from mal.reader import read_forms, read_str
+from mal import formcache
+from mal.core import core_env, mal_cons, mal_rest
+from mal.image import load_image, save_image
+from mal.types import (
+    EMPTY_LIST, EMPTY_VECTOR, MalKeyword, MalList, MalString, MalSymbol, MalVector,
+    collection_hash, equal, false, hash_map, key_hash, keyword, lazy_from_iter, mal_int, nil, symbol,
+    true,
+)
+from mal.vm import vm_eval
+
+
+@pytest.mark.parametrize("evaluate", [mal_eval, analyze_eval, vm_eval])
+def test_shared_empty_collections_are_not_written(evaluate):
+    env = Env(core_env())
+    evaluate(env, read_str("(defmacro! m (fn* [] ()))"))
+    for src in ["()", "[]", "(list)", "(m)", "(rest [1])", "`()",
+                "(macroexpand ())", "(hash-map () 1 [] 2)", "(= () [])"]:
+        evaluate(env, read_str(src))
+    assert EMPTY_LIST.macro_cache is None
+    assert EMPTY_LIST.quasiquote_cache is None
+    assert EMPTY_LIST._hash == EMPTY_VECTOR._hash == collection_hash(MalList([]))
+
+
+def test_empty_collections_hash_alike():
+    m = hash_map([EMPTY_LIST, EMPTY_LIST])
+    assert m.get(MalVector([])) is EMPTY_LIST
+    assert hash(EMPTY_VECTOR) == hash(MalList([]))
+
+
+def is_realized(lst):
+    try:
+        object.__getattribute__(lst, "value")
+    except AttributeError:
+        return False
+    return True
+
+
+def ints(*values):
+    return [mal_int(v) for v in values]
+
+
+def test_cons_shares_the_list_it_extends():
+    base = MalList(ints(2, 3))
+    lst = base.cons(mal_int(1))
+    assert lst.rest() is base
+    assert lst.first() == mal_int(1)
+    assert lst.count() == 3
+    assert lst.nth(2) == mal_int(3)
+    assert not is_realized(lst)
+    assert lst.value == ints(1, 2, 3)
+    assert base.value == ints(2, 3)
+    assert mal_cons(mal_int(0), lst).rest() is lst
+
+
+def test_rest_is_a_view_of_the_same_items():
+    lst = MalList(ints(1, 2, 3))
+    rest = lst.rest()
+    assert rest._lazy == (lst.value, 1)
+    assert rest._lazy[0] is lst.value
+    assert rest.rest()._lazy[0] is lst.value
+    assert not is_realized(rest)
+    assert rest.count() == 2 and rest.first() == mal_int(2) and rest.nth(1) == mal_int(3)
+    assert rest == MalList(ints(2, 3))
+    empty = rest.rest().rest()
+    assert empty.count() == 0 and empty.first() is None
+    assert empty.rest() is empty
+    assert EMPTY_LIST.rest() is EMPTY_LIST
+    assert mal_rest(nil) is EMPTY_LIST
+
+
+def test_rest_of_cons_of_rest():
+    lst = MalList(ints(1, 2, 3))
+    lst = lst.rest().cons(mal_int(0)).rest().rest()
+    assert lst.value == ints(3)
+    assert mal_rest(lst).count() == 0
+
+
+def test_long_cons_chains_are_walked_without_recursion():
+    lst = EMPTY_LIST
+    for i in range(100000):
+        lst = lst.cons(mal_int(i))
+    assert lst.count() == 100000
+    assert lst.nth(99999) == mal_int(0)
+    assert lst == MalList(ints(*range(99999, -1, -1)))
+    assert collection_hash(lst) == collection_hash(MalVector(ints(*range(99999, -1, -1))))
+    for _ in range(99999):
+        lst = lst.rest()
+    assert lst.value == ints(0)
+
+
+DEPTH = 20000
+
+
+def nest(make, leaf):
+    x = leaf
+    for _ in range(DEPTH):
+        x = make(x)
+    return x
+
+
+@pytest.mark.parametrize("make", [
+    lambda x: MalList([mal_int(1), x]),
+    lambda x: MalVector([x, MalString("s")]),
+    lambda x: hash_map([keyword("k"), x]),
+])
+def test_deep_structures_hash_and_compare_without_recursion(make):
+    a = nest(make, mal_int(0))
+    b = nest(make, mal_int(0))
+    c = nest(make, mal_int(1))
+    assert collection_hash(a) == collection_hash(b)
+    assert equal(a, b)
+    assert not equal(a, c)
+    # A fresh copy compares without hashing first
+    assert equal(nest(make, mal_int(0)), b)
+
+
+def test_equal_sequences_hash_alike():
+    items = [mal_int(1), MalVector([MalString("x")]), hash_map([keyword("a"), mal_int(2)])]
+    seqs = [MalList(items), MalVector(items), lazy_from_iter(iter(items)), EMPTY_LIST.cons(items[2])]
+    for s in seqs[:3]:
+        assert equal(s, seqs[0])
+        assert key_hash(s) == key_hash(seqs[0])
+    assert not equal(seqs[3], seqs[0])
+    assert equal(MalList([]), EMPTY_VECTOR)
+
+
+def test_cached_hashes_reject_unequal_collections():
+    a = MalList([mal_int(1)])
+    b = MalList([mal_int(1)])
+    a._hash, b._hash = 1, 2
+    # Only a hash mismatch can make these compare unequal
+    assert not equal(a, b)
+    b._hash = 1
+    assert equal(a, b)
+
+
+def test_symbols_and_keywords_are_interned():
+    assert symbol("abc") is symbol("abc")
+    assert keyword("abc") is keyword("abc")
+    assert symbol("abc") is not keyword("abc")
+    assert type(symbol("abc")) is MalSymbol and type(keyword("abc")) is MalKeyword
+    assert (nil, true, false) == (symbol("nil"), symbol("true"), symbol("false"))
+
+
+def test_reader_interns_names():
+    a, b = read_forms("(f :k x) [x :k f]")
+    assert [id(x) for x in a.value] == [id(x) for x in reversed(b.value)]
+    assert a.value[0] is symbol("f") and a.value[1] is keyword("k")
+
+
+def test_cached_forms_are_interned(tmp_path, monkeypatch):
+    monkeypatch.setattr(formcache, "CACHE_DIR", str(tmp_path))
+    path = tmp_path / "src.mal"
+    path.write_text("(f :k)\n")
+    st = path.stat()
+    writer = formcache.Writer(str(path), st)
+    writer.add(1, read_str("(f :k)"))
+    writer.commit(formcache.digest(path.read_bytes()))
+    (_, form), = formcache.lookup(str(path), st)
+    assert form.value[0] is symbol("f") and form.value[1] is keyword("k")
+
+
+def test_images_restore_interned_names(tmp_path):
+    env = core_env()
+    builtins = env.bindings()
+    env["names"] = MalList([symbol("restored-name"), keyword("restored-key")])
+    save_image(str(tmp_path / "img"), env, builtins)
+    loaded = core_env()
+    load_image(str(tmp_path / "img"), loaded)
+    name, key = loaded.find(symbol("names")).value
+    assert name is symbol("restored-name") and key is keyword("restored-key")